@@ -1,6 +1,8 @@
 # Class that inherits from OpenPMDTimeSeries, and implements
 # some standard diagnostics (emittance, etc.)
 from opmd_viewer import OpenPMDTimeSeries, FieldMetaInformation
+from opmd_viewer.openpmd_timeseries.data_reader.utilities import \
+    reduce_constant
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.constants as const
@@ -8,7 +10,7 @@ import scipy.constants as const
 
 class LpaDiagnostics( OpenPMDTimeSeries ):
 
-    def __init__( self, path_to_dir ):
+    def __init__( self, path_to_dir, **kw ):
         """
         Initialize an OpenPMD time series with various methods to diagnose the
         data
@@ -20,8 +22,12 @@ class LpaDiagnostics( OpenPMDTimeSeries ):
             For the moment, only HDF5 files are supported. There should be
             one file per iteration, and the name of the files should end
             with the iteration number, followed by '.h5' (e.g. data0005000.h5)
+
+        **kw : dict, optional
+            Additional options to be passed to the constructor of
+            OpenPMDTimeSeries (e.g. `n_workers`)
         """
-        OpenPMDTimeSeries.__init__( self, path_to_dir )
+        OpenPMDTimeSeries.__init__( self, path_to_dir, **kw )
 
     def get_mean_gamma( self, t=None, iteration=None, species=None,
                         select=None ):
@@ -105,7 +111,9 @@ class LpaDiagnostics( OpenPMDTimeSeries ):
         w, q = self.get_particle( var_list=['w', 'charge'], species=species,
                                  select=select, t=t, iteration=iteration )
         # Calculate charge
-        charge = np.sum(w*q)
+        # (The charge is usually a constant record: its single value
+        # is then used, instead of an array with one value per particle)
+        charge = np.sum( w*reduce_constant(q) )
         # Return the result
         return( charge )
 
@@ -188,8 +196,8 @@ class LpaDiagnostics( OpenPMDTimeSeries ):
                                     t=t, iteration=iteration,
                                     species=species, select=select )
         # Calculate the necessary RMS values
-        x *= 1.e-6
-        y *= 1.e-6
+        x = x * 1.e-6
+        y = y * 1.e-6
         xsq = np.average( x ** 2, weights=w )
         ysq = np.average( y ** 2, weights=w )
         uxsq = np.average( ux ** 2, weights=w )
@@ -253,7 +261,8 @@ class LpaDiagnostics( OpenPMDTimeSeries ):
         vz = uz / gamma * const.c
         # Length to be seperated in bins
         len_z = np.max(z) - np.min(z)
-        vzq_sum, _ = np.histogram(z, bins=bins, weights=(vz*w*q))
+        vzq_sum, _ = np.histogram(z, bins=bins,
+                                  weights=(vz*w*reduce_constant(q)))
         # Calculete the current in each bin
         current = np.abs(vzq_sum * bins / (len_z * 1.e-6))
         # Info object with central position of the bins
@@ -263,7 +272,7 @@ class LpaDiagnostics( OpenPMDTimeSeries ):
         # Plot the result if needed
         if plot:
             iteration = self.iterations[ self.current_i ]
-            time_fs = 1.e15*self.t[ self.current_i ]
+            time_fs = 1.e15*self.current_t
             plt.plot( info.z, current, **kw)
             plt.title("Current at %.1f fs   (iteration %d)"
                 %(time_fs, iteration ), fontsize=self.plotter.fontsize)
@@ -714,7 +723,7 @@ class LpaDiagnostics( OpenPMDTimeSeries ):
         # Plot the result if needed
         if plot:
             iteration = self.iterations[ self.current_i ]
-            time_fs = 1.e15*self.t[ self.current_i ]
+            time_fs = 1.e15*self.current_t
             plt.imshow( spectrogram, extent=info.imshow_extent, aspect='auto',
                         **kw)
             plt.title("Spectrogram at %.1f fs   (iteration %d)" \
@@ -0,0 +1,432 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines the ArrayCache class, which keeps the arrays that were read
+(e.g. the particle quantities or the fields) in memory, up to a given
+number of bytes, so that they are not read again from the files.
+The arrays that are evicted from the cache can be kept compressed in memory
+(second tier), so that more data fits in the same memory.
+"""
+import os
+import time
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from .utilities import reduce_constant, get_file_stat
+# Use blosc for the compressed tier, if it is available
+# (faster than zlib, for both the compression and the decompression)
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+# Number of elements of an array that are compressed first, to check that
+# the array is compressible (i.e. that it shrinks to at most
+# `max_compressed_fraction` times its size)
+compression_sample_size = 16384
+max_compressed_fraction = 0.9
+
+
+class ArrayCache(object):
+    """
+    Least-recently-used cache of numpy arrays, with a budget in bytes
+
+    Each array is stored along with the modification time and size of the
+    files from which it was read (see `get_file_stamps`): an array is only
+    returned as long as these files have not been modified. The arrays are
+    made read-only when they are stored, so that the arrays that are
+    returned by the cache cannot be modified by mistake. (The arrays that
+    are passed to `put` are made read-only even when they are too large
+    to be stored, so that the readers return read-only arrays whenever
+    the cache is enabled, independently of the size of the data.)
+
+    Optionally, the arrays that are evicted are compressed and kept in a
+    second tier (with its own budget, in compressed bytes), from which
+    they are decompressed and moved back to the first tier when needed.
+    """
+
+    def __init__( self, max_bytes=0, compressed_bytes=0 ):
+        """
+        Initialize an empty cache
+
+        Parameter
+        ---------
+        max_bytes : int, optional
+            The maximal total size of the arrays in the cache, in bytes
+            (the least recently used arrays are removed beyond that).
+            When it is 0, the cache is disabled.
+
+        compressed_bytes : int, optional
+            The maximal total size of the compressed arrays in the second
+            tier, in bytes. When it is 0, the evicted arrays are dropped.
+        """
+        self.max_bytes = max_bytes
+        self.max_compressed_bytes = compressed_bytes
+        # Dictionary of (value, stamps, n_bytes), sorted from the least
+        # recently used to the most recently used array
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Second tier: dictionary of (compressed value, stamps,
+        # compressed size, uncompressed size), also sorted by use
+        self.compressed = OrderedDict()
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.compressed_hits = 0
+        self.compressed_evictions = 0
+        self.decompression_time = 0.
+        self.lock = threading.Lock()
+
+    @property
+    def enabled( self ):
+        "Whether the cache can store arrays"
+        return( self.max_bytes > 0 )
+
+    def get( self, key, stamps ):
+        """
+        Return the array that is stored for `key`, or None if there is
+        no such array or if the files have been modified since it was stored
+
+        Parameters
+        ----------
+        key : a hashable object
+            The identifier of the array
+            (e.g. a tuple (filename, iteration, species, quantity, ...))
+
+        stamps : tuple
+            The current stamps of the files (see `get_file_stamps`)
+        """
+        return( self.get_first( [ key ], stamps )[1] )
+
+    def get_first( self, keys, stamps ):
+        """
+        Return the first of the arrays stored for `keys` that is available
+        (e.g. a slice of a field, or else the full field from which the
+        slice can be extracted)
+
+        Parameters
+        ----------
+        keys : list of hashable objects
+            The identifiers of the arrays, by order of preference
+
+        stamps : tuple
+            The current stamps of the files (see `get_file_stamps`)
+
+        Returns
+        -------
+        A tuple (index of the key in `keys`, array), or (None, None) if
+        none of the arrays is available (which counts as a single miss)
+        """
+        with self.lock:
+            for i_key, key in enumerate( keys ):
+                entry = self.entries.pop( key, None )
+                if entry is None:
+                    continue
+                if entry[1] != stamps:
+                    # The files have been modified: forget the array
+                    self.n_bytes -= entry[2]
+                    continue
+                # Register the array as the most recently used
+                self.entries[ key ] = entry
+                self.hits += 1
+                return( i_key, entry[0] )
+            # Look for the arrays in the second tier
+            for i_key, key in enumerate( keys ):
+                entry = self.compressed.pop( key, None )
+                if entry is None:
+                    continue
+                self.compressed_bytes -= entry[2]
+                self.uncompressed_bytes -= entry[3]
+                if entry[1] == stamps:
+                    break
+            else:
+                self.misses += 1
+                return( None, None )
+
+        # Decompress the arrays (outside of the lock, so that other
+        # threads can use the cache in the meantime), and move them
+        # back to the first tier
+        start = time.time()
+        value = decompress_value( entry[0] )
+        duration = time.time() - start
+        self.put( key, stamps, value )
+        with self.lock:
+            self.compressed_hits += 1
+            self.decompression_time += duration
+        return( i_key, value )
+
+    def put( self, key, stamps, value ):
+        """
+        Store an array (which is made read-only, even if it is larger
+        than the budget and thus not stored), and remove the least
+        recently used arrays if the cache exceeds its budget
+
+        Parameters
+        ----------
+        key : a hashable object
+            The identifier of the array
+
+        stamps : tuple
+            The stamps of the files, taken before the array was read
+            (see `get_file_stamps`)
+
+        value : an np.ndarray, or a tuple
+            The array to be stored, or a tuple of objects to be stored
+            together (e.g. an array and its attributes), in which case
+            only the arrays are counted in the size and made read-only
+        """
+        for item in ( value if isinstance( value, tuple ) else ( value, ) ):
+            if isinstance( item, np.ndarray ):
+                item.flags.writeable = False
+        n_bytes = get_value_size( value )
+        if n_bytes > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop( key, None )
+            if previous is not None:
+                self.n_bytes -= previous[2]
+            self.entries[ key ] = ( value, stamps, n_bytes )
+            self.n_bytes += n_bytes
+            evicted = self._evict()
+        # Compress the evicted arrays (outside of the lock)
+        if self.max_compressed_bytes > 0:
+            for evicted_key, ( evicted_value, evicted_stamps, _ ) in evicted:
+                self._put_compressed( evicted_key, evicted_stamps,
+                                      evicted_value )
+
+    def _put_compressed( self, key, stamps, value ):
+        """
+        Compress an array (or a tuple of objects, see `put`) and store
+        it in the second tier, from which the least recently used arrays
+        are removed if it exceeds its budget
+        """
+        packed = compress_value( value )
+        n_compressed = get_value_size( packed )
+        n_uncompressed = get_value_size( value )
+        if n_compressed > self.max_compressed_bytes:
+            return
+        with self.lock:
+            previous = self.compressed.pop( key, None )
+            if previous is not None:
+                self.compressed_bytes -= previous[2]
+                self.uncompressed_bytes -= previous[3]
+            self.compressed[ key ] = \
+                ( packed, stamps, n_compressed, n_uncompressed )
+            self.compressed_bytes += n_compressed
+            self.uncompressed_bytes += n_uncompressed
+            while self.compressed_bytes > self.max_compressed_bytes:
+                _, entry = self.compressed.popitem( last=False )
+                self.compressed_bytes -= entry[2]
+                self.uncompressed_bytes -= entry[3]
+                self.compressed_evictions += 1
+
+    def clear( self ):
+        "Remove all the arrays from the cache"
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+            self.compressed.clear()
+            self.compressed_bytes = 0
+            self.uncompressed_bytes = 0
+
+    def stats( self ):
+        """
+        Return a dictionary with the number of hits and misses, the number
+        of arrays that were evicted, and the number and total size
+        (in bytes) of the arrays in the cache
+
+        For the second tier, it also contains the number of hits, the
+        compression ratio of the arrays that it contains, and the average
+        time (in seconds) spent decompressing the arrays at each hit.
+        """
+        with self.lock:
+            if self.compressed_bytes > 0:
+                ratio = self.uncompressed_bytes / float(self.compressed_bytes)
+            else:
+                ratio = None
+            if self.compressed_hits > 0:
+                latency = self.decompression_time / self.compressed_hits
+            else:
+                latency = None
+            return( { 'hits': self.hits, 'misses': self.misses,
+                      'evictions': self.evictions,
+                      'n_arrays': len( self.entries ),
+                      'n_bytes': self.n_bytes,
+                      'max_bytes': self.max_bytes,
+                      'compressed_hits': self.compressed_hits,
+                      'compressed_evictions': self.compressed_evictions,
+                      'n_compressed_arrays': len( self.compressed ),
+                      'compressed_bytes': self.compressed_bytes,
+                      'max_compressed_bytes': self.max_compressed_bytes,
+                      'compression_ratio': ratio,
+                      'compressed_hit_latency': latency } )
+
+    def _evict( self ):
+        """
+        Remove the least recently used arrays, until the total size
+        is within the budget (Should be called with self.lock acquired.)
+
+        Returns
+        -------
+        The list of the (key, entry) that were removed
+        """
+        evicted = []
+        while self.n_bytes > self.max_bytes:
+            key, entry = self.entries.popitem( last=False )
+            self.n_bytes -= entry[2]
+            self.evictions += 1
+            evicted.append( (key, entry) )
+        return( evicted )
+
+
+def get_file_stamps( filename ):
+    """
+    Return a tuple with the inode, modification time and size of the
+    file(s), which changes whenever the file(s) are modified or replaced
+
+    These are the same values as those with which the FilePool checks
+    that its open files are up-to-date (see `get_file_stat`). Since the
+    stamps are obtained before the file is acquired from the pool, a file
+    that was modified or replaced since it was opened by the pool is
+    always reopened before its data is read and stored with the stamps.
+
+    Parameter
+    ---------
+    filename : string or list of strings
+        The path to the file (or the list of files, when the iteration
+        is split across several files)
+    """
+    if not isinstance( filename, list ):
+        filename = [ filename ]
+    return( tuple( get_file_stat( name ) for name in filename ) )
+
+
+def get_file_key( filename ):
+    """
+    Return a hashable identifier of the file(s) `filename`
+    (the absolute path, or a tuple of absolute paths when the iteration
+    is split across several files)
+    """
+    if isinstance( filename, list ):
+        return( tuple( os.path.abspath( name ) for name in filename ) )
+    return( os.path.abspath( filename ) )
+
+
+def get_selection_key( select ):
+    """
+    Return a hashable version of the selection rules `select`
+    (see the docstring of `get_selection_mask`), or None
+    """
+    if not select:
+        return( None )
+    return( tuple( sorted( ( quantity, tuple( bounds ) ) \
+                           for quantity, bounds in select.items() ) ) )
+
+
+def get_value_size( value ):
+    """
+    Return the number of bytes used by the arrays of `value` (an array,
+    a compressed array, or a tuple of objects, see `ArrayCache.put`)
+    """
+    if isinstance( value, tuple ):
+        return( sum( get_value_size( item ) for item in value ) )
+    elif isinstance( value, CompressedArray ):
+        return( len( value.buffer ) )
+    elif isinstance( value, np.ndarray ):
+        return( get_memory_size( value ) )
+    return( 0 )
+
+
+def get_memory_size( array ):
+    """
+    Return the number of bytes that are actually used by an array
+    (i.e. a single element for the arrays of constant records,
+    see `get_constant_data`)
+    """
+    if np.ndim( reduce_constant( array ) ) == 0:
+        return( array.itemsize )
+    return( array.nbytes )
+
+
+
+def compress_value( value ):
+    """
+    Compress the arrays of `value` (an np.ndarray, or a tuple of objects
+    whose other elements are kept as is, see `ArrayCache.put`)
+
+    The bytes of the elements are shuffled (i.e. the first byte of all the
+    elements, then the second byte, etc.) before the compression, which
+    makes floating-point data much more compressible. The arrays of constant
+    records (see `get_constant_data`) and the arrays that do not compress
+    well are not compressed.
+
+    Returns
+    -------
+    The same structure as `value`, where the arrays are replaced by
+    CompressedArray objects (see `decompress_value`)
+    """
+    if isinstance( value, tuple ):
+        return( tuple( compress_value( item ) for item in value ) )
+    if (not isinstance( value, np.ndarray )) or \
+            np.ndim( reduce_constant( value ) ) == 0:
+        return( value )
+
+    data = np.ascontiguousarray( value )
+    # Keep the arrays that do not compress well (e.g. random data) as is,
+    # judging from their first elements, so that their compression and
+    # decompression are not spent in vain
+    sample = data.reshape( -1 )[ :compression_sample_size ]
+    if len( compress_bytes( sample ) ) > \
+            max_compressed_fraction * sample.nbytes:
+        return( value )
+    return( CompressedArray( compress_bytes( data ), data.dtype, data.shape ) )
+
+
+def compress_bytes( data ):
+    """
+    Compress the bytes of a contiguous array, after shuffling them
+    """
+    if blosc is not None:
+        return( blosc.compress( data.tobytes(), data.itemsize,
+                                shuffle=blosc.SHUFFLE ) )
+    shuffled = data.view( np.uint8 ).reshape(
+        ( data.size, data.itemsize ) ).T.tobytes()
+    return( zlib.compress( shuffled, 1 ) )
+
+
+def decompress_value( packed ):
+    """
+    Return the value that was compressed by `compress_value`
+    """
+    if isinstance( packed, tuple ):
+        return( tuple( decompress_value( item ) for item in packed ) )
+    if not isinstance( packed, CompressedArray ):
+        return( packed )
+
+    if blosc is not None:
+        data = np.frombuffer( blosc.decompress( packed.buffer ),
+                              dtype=packed.dtype )
+    else:
+        itemsize = packed.dtype.itemsize
+        shuffled = np.frombuffer( zlib.decompress( packed.buffer ),
+                                  dtype=np.uint8 ).reshape( ( itemsize, -1 ) )
+        # (Copying byte by byte is faster than transposing the array)
+        data = np.empty( ( shuffled.shape[1], itemsize ), dtype=np.uint8 )
+        for i_byte in range( itemsize ):
+            data[:, i_byte] = shuffled[ i_byte ]
+        data = data.view( packed.dtype )
+    return( data.reshape( packed.shape ) )
+
+
+class CompressedArray(object):
+    """
+    The compressed bytes of an array, along with its type and shape
+    """
+
+    def __init__( self, buffer, dtype, shape ):
+        self.buffer = buffer
+        self.dtype = dtype
+        self.shape = shape
@@ -4,25 +4,54 @@ This file is part of the openPMD viewer.
 It defines functions that can read the fields from an HDF5 file.
 """
 import os
-import h5py
 import numpy as np
-from .utilities import slice_dict, get_shape, get_data, get_bpath
+from .utilities import slice_dict, get_shape, get_data, get_buffer_view, \
+    apply_in_place, get_bpath
+from .file_pool import FilePool
 from .field_metainfo import FieldMetaInformation
+from .shards import ShardedDataset
+from .array_cache import get_file_stamps, get_file_key
 
-def read_field_2d( filename, field_path ):
+def read_field_2d( filename, field_path, file_pool=None, iteration=None,
+                   dtype=None, out=None, field_cache=None ):
     """
     Extract a given field from an HDF5 file in the OpenPMD format,
     when the geometry is 2d cartesian.
     
     Parameters
     ----------
-    filename : string
-       The absolute path to the HDF5 file
+    filename : string or list of strings
+       The absolute path to the HDF5 file (or the list of files, when
+       the iteration is split across several files)
        
     field_path : string
        The relative path to the requested field, from the openPMD meshes path
        (e.g. 'rho', 'E/r', 'B/x')
 
+    file_pool : a FilePool object, optional
+       The pool from which the open file(s) are obtained
+       (When None, the file(s) are opened and closed within this function.)
+
+    iteration : int, optional
+       The iteration to be read (only needed when the file contains
+       several iterations, i.e. groupBased encoding)
+
+    dtype : a numpy dtype, optional
+       The type of the returned field (e.g. 'float32', in which case the
+       unit conversion and the recombination of the modes are also done
+       in single precision). When None, the field is returned in
+       double precision.
+
+    out : an np.ndarray, optional
+       The buffer in which the field is written, instead of a new array
+       (it should have the shape of the returned field; its type is then
+       used instead of `dtype`). The data is read directly into it
+       whenever possible, and converted in place.
+
+    field_cache : an ArrayCache object, optional
+       The cache in which the data that is read is kept, and from which
+       it is obtained when it was already read (see `read_dataset`)
+
     Returns
     -------
     A tuple with
@@ -30,32 +59,28 @@ def read_field_2d( filename, field_path ):
        info : a FieldMetaInformation object
        (contains information about the grid; see the corresponding docstring)
     """
-    # Open the HDF5 file
-    dfile = h5py.File( filename, 'r' )
-    # Extract the dataset and and corresponding group
-    group, dset = find_dataset( dfile, field_path )
-    
     # Extract the data in 2D Cartesian
-    F = get_data( dset )
+    F, attrs = read_dataset( filename, field_path, file_pool=file_pool,
+        iteration=iteration, dtype=dtype, out=out, field_cache=field_cache )
 
     # Extract the metainformation
     info = FieldMetaInformation( { 0:'x', 1:'z' }, F.shape,
-        group.attrs['gridSpacing'], group.attrs['gridGlobalOffset'],
-        group.attrs['gridUnitSI'], dset.attrs['position'] )
+        attrs['gridSpacing'], attrs['gridGlobalOffset'],
+        attrs['gridUnitSI'], attrs['position'] )
 
-    # Close the file
-    dfile.close()
-    return( F, info )    
+    return( F, info )
 
-def read_field_circ( filename, field_path, m=0, theta=0. ) :
+def read_field_circ( filename, field_path, m=0, theta=0., file_pool=None,
+                     iteration=None, dtype=None, out=None, field_cache=None ):
     """
     Extract a given field from an HDF5 file in the OpenPMD format,
     when the geometry is 2d cartesian.
     
     Parameters
     ----------
-    filename : string
-       The absolute path to the HDF5 file
+    filename : string or list of strings
+       The absolute path to the HDF5 file (or the list of files, when
+       the iteration is split across several files)
        
     field_path : string
        The relative path to the requested field, from the openPMD meshes path
@@ -67,6 +92,30 @@ def read_field_circ( filename, field_path, m=0, theta=0. ) :
     theta : float, optional
        Angle of the plane of observation with respect to the x axis
 
+    file_pool : a FilePool object, optional
+       The pool from which the open file(s) are obtained
+       (When None, the file(s) are opened and closed within this function.)
+
+    iteration : int, optional
+       The iteration to be read (only needed when the file contains
+       several iterations, i.e. groupBased encoding)
+
+    dtype : a numpy dtype, optional
+       The type of the returned field (e.g. 'float32', in which case the
+       unit conversion and the recombination of the modes are also done
+       in single precision). When None, the field is returned in
+       double precision.
+
+    out : an np.ndarray, optional
+       The buffer in which the field is written, instead of a new array
+       (it should have the shape of the returned field; its type is then
+       used instead of `dtype`). The data is read directly into it
+       whenever possible, and converted in place.
+
+    field_cache : an ArrayCache object, optional
+       The cache in which the data that is read is kept, and from which
+       it is obtained when it was already read (see `read_dataset`)
+
     Returns
     -------
     A tuple with
@@ -74,19 +123,66 @@ def read_field_circ( filename, field_path, m=0, theta=0. ) :
        info : a FieldMetaInformation object
        (contains information about the grid; see the corresponding docstring)
     """
-    # Open the HDF5 file
-    dfile = h5py.File( filename, 'r' )
-    # Extract the dataset and and corresponding group
-    group, dset = find_dataset( dfile, field_path )
+    # With a cache, get all the modes (from the cache, when they were
+    # already read), so that the same data serves any `m` and `theta`
+    if (field_cache is not None) and field_cache.enabled:
+        modes, attrs = read_dataset( filename, field_path,
+            file_pool=file_pool, iteration=iteration, dtype=dtype,
+            field_cache=field_cache )
+        # (The modes are already converted to SI units)
+        return( combine_modes( modes, dict( attrs, unitSI=1. ), m, theta,
+                               dtype, out ) )
+
+    # Otherwise, read only the modes that are needed
+    if file_pool is None:
+        file_pool = FilePool( max_open_files=0 )
+    with file_pool.open( filename ) as dfile:
+        # Extract the dataset and its attributes
+        dset, attrs = extract_dataset( dfile, field_path, iteration,
+                                       file_pool.n_workers )
+        return( combine_modes( dset, attrs, m, theta, dtype, out ) )
+
+
+def combine_modes( dset, attrs, m=0, theta=0., dtype=None, out=None ):
+    """
+    Extract the azimuthal modes of a field and recombine them, for the
+    plane of observation at `theta`
 
+    Parameters
+    ----------
+    dset : an h5py.Dataset (or object with the same interface)
+       The modes of the field, with shape (Nm, Nr, Nz)
+       (or an np.ndarray, when the modes were already read)
+
+    attrs : dict
+       The attributes of the field (see `find_dataset`)
+
+    m, theta, dtype, out :
+       See the docstring of `read_field_circ`
+
+    Returns
+    -------
+    A tuple with
+       F : a 2darray containing the required field
+       info : a FieldMetaInformation object
+    """
     # Extract the metainformation
     Nm, Nr, Nz = get_shape( dset )
     info = FieldMetaInformation( { 0:'r', 1:'z' }, (Nr, Nz),
-        group.attrs['gridSpacing'], group.attrs['gridGlobalOffset'],
-        group.attrs['gridUnitSI'], dset.attrs['position'], thetaMode=True )
+        attrs['gridSpacing'], attrs['gridGlobalOffset'],
+        attrs['gridUnitSI'], attrs['position'], thetaMode=True )
 
     # Extract the modes and recombine them properly
-    F_total = np.zeros( (2*Nr, Nz ) )
+    # (The coefficients of the recombination have the type of the data,
+    # so that they do not promote it. The modes are read directly into
+    # the upper half of F_total, when possible.)
+    if out is not None:
+        F_total = get_buffer_view( out, (2*Nr, Nz) )
+        dtype = F_total.dtype
+    else:
+        if dtype is None:
+            dtype = np.float64
+        F_total = np.empty( (2*Nr, Nz ), dtype=dtype )
     if m=='all':
         # Sum of all the modes
         # - Prepare the multiplier arrays
@@ -97,41 +193,49 @@ def read_field_circ( filename, field_path, m=0, theta=0. ) :
             sin = np.sin( mode*theta )
             mult_above_axis += [cos, sin]
             mult_below_axis += [ (-1)**mode*cos, (-1)**mode*sin ]
-        mult_above_axis = np.array( mult_above_axis )
-        mult_below_axis = np.array( mult_below_axis )
+        mult_above_axis = np.array( mult_above_axis, dtype=dtype )
+        mult_below_axis = np.array( mult_below_axis, dtype=dtype )
         # - Sum the modes
-        F = get_data( dset ) # (Extracts all modes)
-        F_total[Nr:,:] = np.tensordot( mult_above_axis, F, axes=(0,0) )[:,:]
-        F_total[:Nr,:] = np.tensordot( mult_below_axis, F, axes=(0,0) )[::-1,:]
+        F = get_data( dset, unit_SI=attrs['unitSI'],
+                      dtype=dtype ) # (All modes)
+        F_total[Nr:,:] = np.tensordot( mult_above_axis, F,
+                                       axes=(0,0) )[:,:]
+        F_total[:Nr,:] = np.tensordot( mult_below_axis, F,
+                                       axes=(0,0) )[::-1,:]
     elif m==0:
         # Extract mode 0
-        F = get_data( dset, 0, 0 )
-        F_total[Nr:,:] = F[:,:]
+        F = get_data( dset, 0, 0, attrs['unitSI'], dtype,
+                      out=F_total[Nr:,:] )
         F_total[:Nr,:] = F[::-1,:]
     else:
         # Extract higher mode
-        cos = np.cos( m*theta )
-        sin = np.sin( m*theta )
-        F_cos = get_data( dset, 2*m-1, 0 )
-        F_sin = get_data( dset, 2*m, 0 )
-        F = cos*F_cos + sin*F_sin
-        F_total[Nr:,:] = F[:,:]
-        F_total[:Nr,:] = (-1)**m * F[::-1,:]
-
-    # Close the file
-    dfile.close()
+        cos = np.dtype( dtype ).type( np.cos( m*theta ) )
+        sin = np.dtype( dtype ).type( np.sin( m*theta ) )
+        F = get_data( dset, 2*m-1, 0, attrs['unitSI'], dtype,
+                      out=F_total[Nr:,:] )
+        F *= cos
+        F_sin = get_data( dset, 2*m, 0, attrs['unitSI'], dtype )
+        F += apply_in_place( np.multiply, F_sin, sin )
+        if m % 2 == 1:
+            np.negative( F[::-1,:], out=F_total[:Nr,:] )
+        else:
+            F_total[:Nr,:] = F[::-1,:]
+
     return( F_total, info )
 
 
-def read_field_3d( filename, field_path, slicing=0., slicing_dir='y' ) :
+def read_field_3d( filename, field_path, slicing=0., slicing_dir='y',
+                   file_pool=None, iteration=None, dtype=None, out=None,
+                   field_cache=None ) :
     """
     Extract a given field from an HDF5 file in the OpenPMD format,
     when the geometry is 3d cartesian.
     
     Parameters
     ----------
-    filename : string
-       The absolute path to the HDF5 file
+    filename : string or list of strings
+       The absolute path to the HDF5 file (or the list of files, when
+       the iteration is split across several files)
        
     field_path : string
        The relative path to the requested field, from the openPMD meshes path
@@ -151,6 +255,30 @@ def read_field_3d( filename, field_path, slicing=0., slicing_dir='y' ) :
         The direction along which to slice the data
         Either 'x', 'y' or 'z'
 
+    file_pool : a FilePool object, optional
+       The pool from which the open file(s) are obtained
+       (When None, the file(s) are opened and closed within this function.)
+
+    iteration : int, optional
+       The iteration to be read (only needed when the file contains
+       several iterations, i.e. groupBased encoding)
+
+    dtype : a numpy dtype, optional
+       The type of the returned field (e.g. 'float32', in which case the
+       unit conversion and the recombination of the modes are also done
+       in single precision). When None, the field is returned in
+       double precision.
+
+    out : an np.ndarray, optional
+       The buffer in which the field is written, instead of a new array
+       (it should have the shape of the returned field; its type is then
+       used instead of `dtype`). The data is read directly into it
+       whenever possible, and converted in place.
+
+    field_cache : an ArrayCache object, optional
+       The cache in which the data that is read is kept, and from which
+       it is obtained when it was already read (see `read_dataset`)
+
     Returns
     -------
     A tuple with
@@ -158,58 +286,185 @@ def read_field_3d( filename, field_path, slicing=0., slicing_dir='y' ) :
        info : a FieldMetaInformation object
        (contains information about the grid; see the corresponding docstring)
     """
-    # Open the HDF5 file
-    dfile = h5py.File( filename, 'r' )
-    # Extract the dataset and and corresponding group
-    group, dset = find_dataset( dfile, field_path )
-    
+    # Extract the data (the full grid, or a slice of it)
+    F, attrs = read_dataset( filename, field_path, slicing, slicing_dir,
+                file_pool, iteration, dtype, out, field_cache )
+
     # Dimensions of the grid
-    Nx, Ny, Nz = get_shape( dset )
-    dx, dy, dz = group.attrs['gridSpacing']
-    xmin, ymin, zmin = group.attrs['gridGlobalOffset']
-    # Slice selection
+    Nx, Ny, Nz = attrs['shape']
+    dx, dy, dz = attrs['gridSpacing']
+    xmin, ymin, zmin = attrs['gridGlobalOffset']
+    # Extract the metainformation
     if slicing is not None:
-        # Number of cells along the slicing direction
-        n_cells = dset.shape[ slice_dict[slicing_dir] ]
-        # Index of the slice (prevent stepping out of the array)
-        i_cell = int( 0.5*(slicing+1.)*n_cells )
-        i_cell = max( i_cell, 0 )
-        i_cell = min( i_cell, n_cells-1)
-        # Extraction of the data
         if slicing_dir=='x':
-            F = get_data( dset, i_cell, 0 )
             info = FieldMetaInformation( { 0:'y', 1:'z' }, (Ny, Nz),
-                        (dy, dz), (ymin, zmin), group.attrs['gridUnitSI'],
-                        dset.attrs['position'] )
+                        (dy, dz), (ymin, zmin), attrs['gridUnitSI'],
+                        attrs['position'] )
         elif slicing_dir=='y':
-            F = get_data( dset, i_cell, 1 )
             info = FieldMetaInformation( { 0:'x', 1:'z' }, (Nx, Nz),
-                        (dx, dz), (xmin, zmin), group.attrs['gridUnitSI'],
-                        dset.attrs['position'] )
+                        (dx, dz), (xmin, zmin), attrs['gridUnitSI'],
+                        attrs['position'] )
         elif slicing_dir=='z':
-            F = get_data( dset, i_cell, 2 )
             info = FieldMetaInformation( { 0:'x', 1:'y' }, (Nx, Ny),
-                        (dx, dy), (xmin, ymin), group.attrs['gridUnitSI'],
-                        dset.attrs['position'] )
+                        (dx, dy), (xmin, ymin), attrs['gridUnitSI'],
+                        attrs['position'] )
     else:
-        F = get_data( dset )
         info = FieldMetaInformation( { 0:'x', 1:'y', 2:'z' }, F.shape,
-            group.attrs['gridSpacing'], group.attrs['gridGlobalOffset'],
-            group.attrs['gridUnitSI'], dset.attrs['position'] )
+            attrs['gridSpacing'], attrs['gridGlobalOffset'],
+            attrs['gridUnitSI'], attrs['position'] )
 
-    # Close the file
-    dfile.close()
     return( F, info )
 
-        
-def find_dataset( dfile, field_path ):
+
+def read_dataset( filename, field_path, slicing=None, slicing_dir='y',
+                  file_pool=None, iteration=None, dtype=None, out=None,
+                  field_cache=None ):
+    """
+    Extract the data of a field (or a slice of it), along with its
+    attributes, either from the file(s) or from the cache
+
+    The data that is read is stored in `field_cache` (unless it is read
+    into a buffer), along with its attributes. The full data of a field
+    is then also used for any slice of it.
+
+    Parameters
+    ----------
+    filename : string or list of strings
+       The absolute path to the HDF5 file (or the list of files, when
+       the iteration is split across several files)
+
+    field_path : string
+       The relative path to the requested field, from the openPMD meshes path
+
+    slicing : float, optional
+       Where to slice the data, along the direction `slicing_dir`
+       (see the docstring of `read_field_3d`). If None, the full data
+       is returned.
+
+    slicing_dir : str, optional
+       The direction along which to slice the data ('x', 'y' or 'z')
+
+    file_pool, iteration, dtype, out, field_cache :
+       See the docstring of `read_field_2d`
+
+    Returns
+    -------
+    A tuple with
+       F : an np.ndarray (read-only, when the cache is enabled and
+       `out` is None)
+       attrs : a dictionary with the attributes of the field
+       (see `find_dataset`), and the shape of the full data (`shape`)
+    """
+    use_cache = (field_cache is not None) and field_cache.enabled
+    if use_cache:
+        # Look for the slice, and then for the full data
+        # (The stamps of the files are obtained before reading, so that
+        # the data of a file modified in the meantime is not used later.)
+        stamps = get_file_stamps( filename )
+        if dtype is not None:
+            dtype = np.dtype( dtype )
+        key = ( get_file_key( filename ), iteration, field_path, dtype )
+        keys = [ key + (None, None) ]
+        if slicing is not None:
+            keys.insert( 0, key + (slicing, slicing_dir) )
+        i_key, value = field_cache.get_first( keys, stamps )
+        if value is not None:
+            F, attrs = value
+            if (slicing is not None) and (i_key == 1):
+                axis = slice_dict[ slicing_dir ]
+                i_cell = get_slice_index( F.shape[axis], slicing )
+                F = F[ (slice(None),)*axis + (i_cell,) ]
+            if out is not None:
+                F_out = get_buffer_view( out, F.shape )
+                F_out[...] = F
+                F = F_out
+            return( F, attrs )
+
+    # Get the open HDF5 file(s)
+    if file_pool is None:
+        file_pool = FilePool( max_open_files=0 )
+    with file_pool.open( filename ) as dfile:
+        # Extract the dataset and its attributes
+        dset, attrs = extract_dataset( dfile, field_path, iteration,
+                                       file_pool.n_workers )
+        attrs = dict( attrs, shape=tuple( get_shape( dset ) ) )
+        # Extraction of the data
+        if slicing is not None:
+            axis = slice_dict[ slicing_dir ]
+            i_cell = get_slice_index( dset.shape[axis], slicing )
+            F = get_data( dset, i_cell, axis, attrs['unitSI'], dtype, out )
+        else:
+            F = get_data( dset, unit_SI=attrs['unitSI'], dtype=dtype,
+                          out=out )
+
+    if use_cache and (out is None):
+        field_cache.put( keys[0], stamps, ( F, attrs ) )
+    return( F, attrs )
+
+
+def get_slice_index( n_cells, slicing ):
+    """
+    Return the index of the slice at `slicing` (between -1 and 1, see the
+    docstring of `read_field_3d`), among `n_cells` cells
+    """
+    # Index of the slice (prevent stepping out of the array)
+    i_cell = int( 0.5*(slicing+1.)*n_cells )
+    i_cell = max( i_cell, 0 )
+    i_cell = min( i_cell, n_cells-1)
+    return( i_cell )
+
+
+def extract_dataset( dfile, field_path, iteration=None, n_workers=1 ):
+    """
+    Extract the dataset that corresponds to field_path, and its attributes,
+    from the open file(s) of an iteration
+
+    When the iteration is split across several files, the pieces of
+    the dataset are stitched together (see the class ShardedDataset).
+
+    Parameters
+    ----------
+    dfile : an h5py.File object or a list of h5py.File objects
+       The open file (or the list of open files, when the iteration
+       is split across several files)
+
+    field_path : string
+       The relative path to the requested field, from the openPMD meshes path
+       (e.g. 'rho', 'E/r', 'B/x')
+
+    iteration : int, optional
+       The iteration to be read (see the docstring of `get_bpath`)
+
+    n_workers : int, optional
+       The maximal number of files that are read concurrently
+       (when the iteration is split across several files)
+
+    Returns
+    -------
+    A tuple with:
+    - an h5py.Dataset object (or dataset-like object)
+    - a dictionary of attributes (see `find_dataset`)
+    """
+    if isinstance( dfile, list ):
+        dset = ShardedDataset(
+            [ find_dataset( piece_file, field_path, iteration ) \
+              for piece_file in dfile ], n_workers )
+        attrs = dset.attrs
+    else:
+        dset, attrs = find_dataset( dfile, field_path, iteration )
+
+    return( dset, attrs )
+
+
+def find_dataset( dfile, field_path, iteration=None ):
     """
     Extract the dataset that corresponds to field_path,
-    and the corresponding group
+    and the attributes of the corresponding record
 
-    (In the case of scalar records, the group and the dataset are identical.
-    In the case of vector records, the group contains all the components
-    and the dataset corresponds to one given component.)
+    (In the case of scalar records, the attributes of the grid and of the
+    data are those of the dataset. In the case of vector records, the
+    attributes of the grid are those of the group that contains all
+    the components.)
 
     Parameters
     ----------
@@ -220,22 +475,31 @@ def find_dataset( dfile, field_path ):
        The relative path to the requested field, from the openPMD meshes path
        (e.g. 'rho', 'E/r', 'B/x')
 
+    iteration : int, optional
+       The iteration to be read (see the docstring of `get_bpath`)
+
     Returns
     -------
     A tuple with:
-    - an h5py.Group object
     - an h5py.Dataset object
+    - a dictionary with the attributes 'gridSpacing', 'gridGlobalOffset',
+      'gridUnitSI', 'position' and 'unitSI'
     """
     # Find the meshes path
-    base_path = get_bpath( dfile )
+    base_path = get_bpath( dfile, iteration )
     relative_meshes_path = dfile.attrs["meshesPath"].decode()
+    meshes_path = os.path.join( base_path, relative_meshes_path )
 
     # Get the proper dataset
-    full_field_path = os.path.join(base_path, relative_meshes_path, field_path)
-    dset = dfile[ full_field_path ]
-    # Get the proper group
+    dset = dfile[ os.path.join( meshes_path, field_path ) ]
+
+    # Get the attributes of the grid and of the data
     group_path = field_path.split('/')[0]
-    full_group_path = os.path.join(base_path, relative_meshes_path, group_path)
-    group = dfile[ full_group_path ]
+    group = dfile[ os.path.join( meshes_path, group_path ) ]
+    attrs = {}
+    for name in [ 'gridSpacing', 'gridUnitSI', 'gridGlobalOffset' ]:
+        attrs[name] = group.attrs[name]
+    for name in [ 'position', 'unitSI' ]:
+        attrs[name] = dset.attrs[name]
 
-    return( group, dset )
+    return( dset, attrs )
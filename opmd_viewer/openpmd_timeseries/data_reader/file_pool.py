@@ -0,0 +1,176 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines the FilePool class, which keeps a bounded number of HDF5 files
+open, so that they are not reopened each time a record is read.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from .utilities import open_h5_file, get_file_stat
+
+
+class FilePool(object):
+    """
+    Pool of open h5py.File objects, shared by all the readers of a time series
+
+    The files are kept open after they have been read, up to
+    `max_open_files` files. Beyond that, the least recently used file is
+    closed. A file that is being read (i.e. between `acquire` and `release`)
+    is never closed by the pool, so that the pool can be shared by
+    several threads.
+
+    A file that was modified or replaced on disk since it was opened
+    (i.e. whose inode, modification time or size changed, see
+    `get_file_stat`) is reopened by `acquire`. The previous h5py.File
+    object is closed once the readers that are still using it release it.
+    """
+
+    def __init__( self, max_open_files=16, swmr=False, n_workers=1 ):
+        """
+        Initialize an empty pool
+
+        Parameters
+        ----------
+        max_open_files : int, optional
+            The maximal number of files that are kept open when they
+            are not being read. When it is 0, the files are closed as soon
+            as they have been read.
+
+        swmr : bool, optional
+            Whether to open the files in SWMR mode
+            (see the docstring of `open_h5_file`)
+
+        n_workers : int, optional
+            The maximal number of files that the readers read concurrently,
+            when an iteration is split across several files
+        """
+        self.max_open_files = max_open_files
+        self.swmr = swmr
+        self.n_workers = n_workers
+        # Dictionary of [h5py.File, number of readers, stat of the file],
+        # with the filename as key, sorted from the least recently used to
+        # the most recently used file
+        self.entries = OrderedDict()
+        # Entries of the files that were reopened while they were being
+        # read (closed when their last reader releases them)
+        self.retired_entries = []
+        self.lock = threading.Lock()
+
+    def acquire( self, filename ):
+        """
+        Return the open h5py.File object(s) for `filename`, and mark them
+        as being read (until `release` is called)
+
+        Parameter
+        ---------
+        filename : string or list of strings
+            The path to the file (or the list of files, when the iteration
+            is split across several files)
+
+        Returns
+        -------
+        An h5py.File object (or a list of h5py.File objects)
+        """
+        if isinstance( filename, list ):
+            return( [ self.acquire( name ) for name in filename ] )
+
+        stat = get_file_stat( filename )
+        with self.lock:
+            entry = self.entries.pop( filename, None )
+            if (entry is not None) and (entry[2] != stat):
+                # The file was modified or replaced since it was opened
+                self._retire( entry )
+                entry = None
+            if entry is None:
+                entry = [ open_h5_file( filename, self.swmr ), 0, stat ]
+            entry[1] += 1
+            # Register the file as the most recently used
+            self.entries[ filename ] = entry
+            return( entry[0] )
+
+    def release( self, filename, dfile=None ):
+        """
+        Mark the file(s) as not being read anymore, and close the least
+        recently used files if there are too many open files
+
+        Parameters
+        ----------
+        filename : string or list of strings
+            The argument that was passed to `acquire`
+
+        dfile : an h5py.File object (or a list of h5py.File objects), optional
+            The object that was returned by `acquire`. This is needed
+            to release a file that was reopened in the meantime.
+            (When None, the file that is currently in the pool is released.)
+        """
+        if isinstance( filename, list ):
+            if dfile is None:
+                dfile = [ None ] * len( filename )
+            for name, piece_file in zip( filename, dfile ):
+                self.release( name, piece_file )
+            return
+
+        with self.lock:
+            entry = self.entries.get( filename )
+            if (entry is not None) and \
+                    ( (dfile is None) or (entry[0] is dfile) ):
+                entry[1] -= 1
+            else:
+                # The file was reopened since it was acquired
+                for i, retired_entry in enumerate( self.retired_entries ):
+                    if retired_entry[0] is dfile:
+                        retired_entry[1] -= 1
+                        if retired_entry[1] == 0:
+                            self.retired_entries.pop( i )[0].close()
+                        break
+            self._evict()
+
+    @contextmanager
+    def open( self, filename ):
+        """
+        Context manager that yields the open h5py.File object(s)
+        for `filename` (see `acquire`), and releases them on exit
+        """
+        dfile = self.acquire( filename )
+        try:
+            yield dfile
+        finally:
+            self.release( filename, dfile )
+
+    def close( self ):
+        """
+        Close all the files of the pool
+
+        (This should not be called while files are being read.)
+        """
+        with self.lock:
+            for entry in list( self.entries.values() ) + self.retired_entries:
+                entry[0].close()
+            self.entries.clear()
+            self.retired_entries = []
+
+    def _retire( self, entry ):
+        """
+        Close the file of an entry that was removed from the pool, or keep it
+        open until it is released, if it is being read
+        (Should be called with self.lock acquired.)
+        """
+        if entry[1] == 0:
+            entry[0].close()
+        else:
+            self.retired_entries.append( entry )
+
+    def _evict( self ):
+        """
+        Close the least recently used files that are not being read,
+        until at most `max_open_files` files are open
+        (Should be called with self.lock acquired.)
+        """
+        n_excess = len( self.entries ) - self.max_open_files
+        if n_excess <= 0:
+            return
+        idle_files = [ filename for (filename, entry) \
+                       in self.entries.items() if entry[1] == 0 ]
+        for filename in idle_files[:n_excess]:
+            self.entries.pop( filename )[0].close()
@@ -4,10 +4,11 @@ This file is part of the openPMD viewer.
 It defines a function that can read standard parameters from an openPMD file.
 """
 import os
-import h5py
-from .utilities import is_scalar_record, get_shape, get_bpath
+from functools import partial
+from .utilities import is_scalar_record, get_shape, get_bpath, \
+     open_h5_file, pool_map
 
-def read_openPMD_params( filename ):
+def read_openPMD_params( filename, swmr=False, iteration=None ):
     """
     Extract the time and some openPMD parameters from a file
 
@@ -16,6 +17,100 @@ def read_openPMD_params( filename ):
     filename: string
         The path to the file from which parameters should be extracted
 
+    swmr: bool, optional
+        Whether to open the file in SWMR mode
+        (see the docstring of `open_h5_file`)
+
+    iteration: int, optional
+        The iteration for which to extract the parameters (only needed
+        when the file contains several iterations, i.e. groupBased encoding)
+
+    Returns
+    -------
+    A tuple with:
+    - A float corresponding to the time of this iteration in SI units
+    - A dictionary containing several parameters, such as the geometry, etc.
+    """
+    f = open_h5_file( filename, swmr )
+    t, params = extract_openPMD_params( f, get_bpath( f, iteration ) )
+    f.close()
+    return( t, params )
+
+
+def read_group_based_params( filename, iterations, swmr=False,
+                             skip_errors=False ):
+    """
+    Extract the time and some openPMD parameters of several iterations
+    of the same file (groupBased encoding), by opening the file only once
+
+    Parameter
+    ---------
+    filename: string
+        The path to the file from which parameters should be extracted
+
+    iterations: list of ints
+        The iterations for which to extract the parameters
+
+    swmr, skip_errors: bool, optional
+        See the docstring of `scan_openPMD_params`
+
+    Returns
+    -------
+    A list of tuples (t, params), in the same order as `iterations`
+    (see the docstring of `read_openPMD_params`)
+    """
+    try:
+        f = open_h5_file( filename, swmr )
+    except (IOError, OSError):
+        if skip_errors:
+            return( [ None ] * len(iterations) )
+        raise
+    results = []
+    for iteration in iterations:
+        try:
+            results.append( extract_openPMD_params(
+                f, get_bpath( f, iteration ) ) )
+        except (KeyError, RuntimeError):
+            if not skip_errors:
+                f.close()
+                raise
+            results.append( None )
+    f.close()
+    return( results )
+
+
+def list_file_iterations( filename, swmr=False ):
+    """
+    Return the sorted list of the iterations that are stored in a file
+    (i.e. the names of the groups under /data)
+
+    Parameter
+    ---------
+    filename: string
+        The path to the file
+
+    swmr: bool, optional
+        Whether to open the file in SWMR mode
+        (see the docstring of `open_h5_file`)
+    """
+    f = open_h5_file( filename, swmr )
+    iterations = sorted([ int(key) for key in f['/data'].keys() ])
+    f.close()
+    return( iterations )
+
+
+def extract_openPMD_params( f, bpath_name ):
+    """
+    Extract the time and some openPMD parameters from an open file
+
+    Parameter
+    ---------
+    f: an h5py.File object
+        The file from which parameters should be extracted
+
+    bpath_name: string
+        The base path of the iteration (see the docstring of `get_bpath`)
+
     Returns
     -------
     A tuple with:
@@ -23,18 +118,17 @@ def read_openPMD_params( filename ):
     - A dictionary containing several parameters, such as the geometry, etc.
     """
     params = {}
-            
-    # Open the file, and do a version check
-    f = h5py.File( filename, 'r')
+
+    # Do a version check
     version = f.attrs['openPMD'].decode()
     if version[:2] != '1.':
         raise ValueError(
             "File %s is not supported: Invalid openPMD version: "
-            "%s)" %( filename, version) )
+            "%s)" %( f.filename, version) )
     params['extension'] = f.attrs['openPMDextension']
 
     # Find the base path object, and extract the time
-    bpath = f[ get_bpath(f) ]
+    bpath = f[ bpath_name ]
     t = bpath.attrs["time"] * bpath.attrs["timeUnitSI"]
 
     # Find out whether fields are present and extract their geometry
@@ -106,11 +200,67 @@ def read_openPMD_params( filename ):
         # Particles are absent
         params['avail_species'] = None
 
-    # Close the file and return the parameters
-    f.close()
+    # Return the parameters
     return( t, params )
 
 
+def read_openPMD_params_or_none( filename, swmr=False ):
+    """
+    Same as `read_openPMD_params`, but return None when the file cannot
+    be read (e.g. because it is still being written by the simulation)
+    """
+    try:
+        return( read_openPMD_params( filename, swmr ) )
+    except (IOError, OSError, KeyError, RuntimeError):
+        return( None )
+
+
+def scan_openPMD_params( filenames, n_workers=1, pool_type='process',
+                         swmr=False, skip_errors=False ):
+    """
+    Extract the time and the openPMD parameters from a list of files,
+    possibly using several concurrent workers
+
+    Parameters
+    ----------
+    filenames: list of strings
+        The paths to the files from which parameters should be extracted
+
+    n_workers: int, optional
+        The number of files that are scanned concurrently.
+        When n_workers is 1, the files are scanned serially.
+
+    pool_type: string, optional
+        Either 'process' (the workers are separate processes, which open
+        and read the files concurrently) or 'thread' (the workers are
+        threads, but h5py serializes all the calls to HDF5 behind a global
+        lock, so that only the rest of the scan, i.e. the parsing of the
+        parameters in Python, is overlapped).
+        For instance, scanning 200 small files on one core takes 0.50s
+        serially and 0.39s with 2 or 4 threads, i.e. the threads do not
+        scale with the number of workers.
+
+    swmr: bool, optional
+        Whether to open the files in SWMR mode
+        (see the docstring of `open_h5_file`)
+
+    skip_errors: bool, optional
+        Whether to return None (instead of raising an exception) for the
+        files that cannot be read, e.g. because they are partially written
+
+    Returns
+    -------
+    A list of tuples (t, params), in the same order as `filenames`
+    (see the docstring of `read_openPMD_params`)
+    """
+    if skip_errors:
+        read_params = partial( read_openPMD_params_or_none, swmr=swmr )
+    else:
+        read_params = partial( read_openPMD_params, swmr=swmr )
+
+    return( pool_map( read_params, filenames, n_workers, pool_type ) )
+
+
 def simplify_quantities( quantities ):
     """
     Replace the names of some standard quantities by shorter names
@@ -1,24 +1,45 @@
 """
 This file is part of the OpenPMD viewer.
 
-It defines a function that reads particle data from an openPMD file
+It defines functions that read particle data from an openPMD file
 """
 import os
-import h5py
+import numpy as np
+from functools import partial
 from scipy import constants
-from .utilities import get_data, get_bpath
+from .utilities import get_data, get_selected_data, get_data_range, \
+    get_shape, get_block_size, get_buffer_view, reduce_constant, \
+    apply_in_place, pool_map, merge_ranges, intersect_ranges, \
+    get_candidates_mask, get_bpath
+from .file_pool import FilePool
+from .sorted_index import get_index_candidates
+from .zone_map import get_zone_map_candidates
 
-def read_particle( filename, species, quantity ) :
+# Translation of the quantities to the OpenPMD format
+dict_quantity = { 'x' : 'position/x',
+                  'y' : 'position/y',
+                  'z' : 'position/z',
+                  'ux' : 'momentum/x',
+                  'uy' : 'momentum/y',
+                  'uz' : 'momentum/z',
+                  'w' : 'weighting'}
+# Default number of particles of the blocks of `iter_particles`
+default_chunk_size = 1048576
+
+def read_particle( filename, species, quantity, file_pool=None,
+                   iteration=None, dtype=None ) :
     """
     Extract a given particle quantity
-    
+
     In the case of positions, the result is returned in microns
-    
+
     Parameters
     ----------
-    filename : string
-        The name of the file from which to extract data
-    
+    filename : string or list of strings
+        The name of the file from which to extract data (or the list of
+        files, when the iteration is split across several files; in this
+        case the files are read concurrently and the data is concatenated)
+
     species : string
         The name of the species to extract (in the OpenPMD file)
 
@@ -26,38 +47,500 @@ def read_particle( filename, species, quantity ) :
         The quantity to extract
         Either 'x', 'y', 'z', 'ux', 'uy', 'uz', or 'w'
 
+    file_pool : a FilePool object, optional
+        The pool from which the open file is obtained
+        (When None, the file is opened and closed within this function.)
+
+    iteration : int, optional
+        The iteration to be read (only needed when the file contains
+        several iterations, i.e. groupBased encoding)
+
+    dtype : a numpy dtype, optional
+        The type of the returned data (e.g. 'float32', in which case
+        the unit conversions are also done in single precision).
+        When None, the data is returned in double precision.
+
+    """
+    data, = read_particles( filename, species, [ quantity ],
+                            file_pool, iteration, dtype=dtype )
+    return( data )
+
+def read_particles( filename, species, quantities, file_pool=None,
+                    iteration=None, select=None, dtype=None, out=None ) :
+    """
+    Extract several quantities of a given species, in one pass
+
+    The species is opened only once, and the records that are needed for
+    the conversion of several quantities (e.g. the mass, for the momenta)
+    are read only once.
+
+    When a selection is given, the quantities of the selection rules are
+    read first, and the other quantities are then only read in the blocks
+    of the datasets that contain selected particles. In addition, when
+    the species has particle patches, the selection rules on positions
+    exclude the patches that are outside of the selected region, and when
+    the file has an up-to-date sorted index (see `write_sorted_index`)
+    for a quantity of the selection, the index gives the particles that
+    satisfy the corresponding rule. Similarly, when the file has up-to-date
+    zone maps (see `write_zone_map`), the blocks whose range does not
+    overlap with the selected range are excluded. Only the remaining
+    candidate particles are read.
+
+    Parameters
+    ----------
+    filename : string or list of strings
+        The name of the file from which to extract data
+        (see the docstring of `read_particle`)
+
+    species : string
+        The name of the species to extract (in the OpenPMD file)
+
+    quantities : list of strings
+        The quantities to extract
+        (see the docstring of `read_particle`)
+
+    file_pool : a FilePool object, optional
+        The pool from which the open file is obtained
+        (When None, the file is opened and closed within this function.)
+
+    iteration : int, optional
+        The iteration to be read (only needed when the file contains
+        several iterations, i.e. groupBased encoding)
+
+    select : dict, optional
+        Either None or a dictionary of rules to select the particles
+        (see the docstring of `OpenPMDTimeSeries.get_particle`)
+
+    dtype : a numpy dtype, optional
+        The type of the returned data (see the docstring of `read_particle`)
+
+    out : list of 1darrays (or None), optional
+        The buffers in which the quantities are written (one per element
+        of `quantities`; None for the quantities that should be returned
+        in new arrays). Each buffer should have at least as many elements
+        as the particles of the species, and its first elements (as many
+        as the selected particles) are returned.
+        The data is read directly into the buffers and converted in place
+        (in the type of the buffer), so that reading many iterations
+        with the same buffers does not allocate large arrays.
+
+    Returns
+    -------
+    A list of 1darrays (one per element of `quantities`, in the same order)
+    which only contain the selected particles
+    """
+    if out is None:
+        out = [ None ] * len(quantities)
+
+    # Iteration split across several files: read and concatenate all of them
+    if isinstance( filename, list ):
+        n_workers = 1 if file_pool is None else file_pool.n_workers
+        data_lists = pool_map( partial( read_particles, species=species,
+            quantities=quantities, file_pool=file_pool, iteration=iteration,
+            select=select, dtype=dtype ), filename, n_workers=n_workers )
+        return( [ concatenate_data(
+                    [ data_list[k] for data_list in data_lists ], out[k] ) \
+                  for k in range(len(quantities)) ] )
+
+    # Read all the particles as a single block
+    data_lists = list( iter_particles( filename, species, quantities,
+                        None, file_pool, iteration, select, dtype, out ) )
+    return( data_lists[0] )
+
+def iter_particles( filename, species, quantities, chunk_size,
+                    file_pool=None, iteration=None, select=None,
+                    dtype=None, out=None ) :
+    """
+    Iterate over the particles of a species, by blocks of `chunk_size`
+    particles, so that only one block is in memory at a time
+
+    The quantities of each block are converted (see `read_particle`)
+    and the selection rules are applied to each block.
+
+    Parameters
+    ----------
+    filename : string or list of strings
+        The name of the file from which to extract data
+        (When the iteration is split across several files, the files
+        are read one after the other.)
+
+    species : string
+        The name of the species to extract (in the OpenPMD file)
+
+    quantities : list of strings
+        The quantities to extract
+        (see the docstring of `read_particle`)
+
+    chunk_size : int or None
+        The number of particles of each block (before selection).
+        When None, all the particles are read as a single block.
+
+    file_pool, iteration, select, dtype : optional
+        See the docstring of `read_particles`
+
+    out : list of 1darrays (or None), optional
+        The buffers in which the quantities of each block are written
+        (see the docstring of `read_particles`). The arrays of a block are
+        then overwritten by the next block.
+
+    Yields
+    ------
+    For each block, a list of 1darrays (one per element of `quantities`,
+    in the same order) which only contain the selected particles
+    """
+    # Iteration split across several files: iterate over each of them
+    if isinstance( filename, list ):
+        for name in filename:
+            for data_list in iter_particles( name, species, quantities,
+                    chunk_size, file_pool, iteration, select, dtype, out ):
+                yield( data_list )
+        return
+
+    # Get the open HDF5 file
+    if file_pool is None:
+        file_pool = FilePool( max_open_files=0 )
+    with file_pool.open( filename ) as dfile:
+        species_grp = get_species_group( dfile, species, iteration )
+        def get_record( record_path, mask, block, buffer=None ):
+            """
+            Read the record `record_path` of the species, in SI units
+            (only the particles of `block`, i.e. a tuple (start, stop),
+            if it is not None, and only the particles selected by `mask`,
+            if it is not None), into `buffer` if it is not None
+            """
+            dset = species_grp[ record_path ]
+            unit_SI = dset.attrs['unitSI']
+            if block is None:
+                if mask is None:
+                    return( get_data( dset, unit_SI=unit_SI, dtype=dtype,
+                                      out=buffer ) )
+                else:
+                    return( get_selected_data( dset, mask, unit_SI,
+                                               dtype=dtype, out=buffer ) )
+            else:
+                if mask is None:
+                    return( get_data_range( dset, block[0], block[1],
+                                            unit_SI, dtype, buffer ) )
+                else:
+                    return( get_selected_data( dset, mask, unit_SI,
+                                               block[0], dtype, buffer ) )
+
+        # (The mass is read only once for all the momentum components,
+        # for a given selection of particles)
+        norm_factor = { 'mask': None, 'block': None, 'value': None }
+        def get_quantity( quantity, mask=None, block=None ):
+            "Read and convert a quantity (see the docstring of read_particle)"
+            data = get_record( dict_quantity.get( quantity, quantity ),
+                               mask, block, buffers.get( quantity ) )
+
+            # (The conversions are done in place when possible. Constant
+            # records, e.g. the offsets and the mass, are used through
+            # their single value, so that they are not allocated.)
+            # - Return positions in microns, with an offset
+            if quantity in ['x', 'y', 'z']:
+                offset = get_record( 'positionOffset/%s' %quantity,
+                                     mask, block )
+                data = apply_in_place( np.add, data,
+                            as_type_of( data, reduce_constant( offset ) ) )
+                data = apply_in_place( np.multiply, data, 1.e6 )
+            # - Return momentum in normalized units
+            elif quantity in ['ux', 'uy', 'uz' ]:
+                if (norm_factor['value'] is None) or \
+                        (norm_factor['mask'] is not mask) or \
+                        (norm_factor['block'] != block):
+                    norm_factor['mask'] = mask
+                    norm_factor['block'] = block
+                    mass = get_record( 'mass', mask, block )
+                    norm_factor['value'] = \
+                        1./( reduce_constant( mass ) * constants.c )
+                data = apply_in_place( np.multiply, data,
+                            as_type_of( data, norm_factor['value'] ) )
+            return( data )
+
+        # Buffers of the quantities
+        buffers = {}
+        if out is not None:
+            for quantity, buffer in zip( quantities, out ):
+                if (buffer is not None) and (quantity not in buffers):
+                    buffers[ quantity ] = buffer
+
+        # Find the particles that may be selected: ranges of particles
+        # (from the particle patches and the zone maps) and sorted indices
+        # of particles (from the sorted index, only when there are at
+        # most `chunk_size` of them), so that the memory that they use
+        # does not scale with the number of particles
+        candidate_ranges = None
+        candidate_indices = None
+        if select:
+            for ranges in [ get_patch_candidates( species_grp, select ),
+                    get_zone_map_candidates( filename, iteration, species,
+                                             select ) ]:
+                if candidate_ranges is None:
+                    candidate_ranges = ranges
+                elif ranges is not None:
+                    candidate_ranges = intersect_ranges(
+                        candidate_ranges, ranges )
+            candidate_indices = get_index_candidates( filename, iteration,
+                                    species, select, chunk_size )
+
+        # Divide the particles into blocks
+        if select:
+            first_quantity = list( select.keys() )[0]
+        else:
+            first_quantity = quantities[0]
+        n_particles = get_shape( species_grp[
+            dict_quantity.get( first_quantity, first_quantity ) ] )[0]
+        if chunk_size is None:
+            blocks = [ None ]
+        else:
+            blocks = [ ( start, min( start+chunk_size, n_particles ) ) \
+                       for start in range( 0, n_particles, chunk_size ) ]
+
+        for block in blocks:
+            if block is None:
+                block_candidates = get_candidates_mask( 0, n_particles,
+                                    candidate_ranges, candidate_indices )
+            else:
+                block_candidates = get_candidates_mask( block[0], block[1],
+                                    candidate_ranges, candidate_indices )
+
+            # Extract the quantities of the selection rules (for all the
+            # particles of the block, or only the candidates), and select
+            # the particles
+            extracted = {}
+            mask = None
+            if select:
+                for quantity in select.keys():
+                    extracted[ quantity ] = get_quantity( quantity,
+                                                block_candidates, block )
+                mask = get_selection_mask( select, extracted )
+                for quantity in select.keys():
+                    data = extracted[ quantity ]
+                    if quantity in buffers:
+                        # Keep the selected particles in the buffer
+                        n_selected = np.count_nonzero( mask )
+                        data[ :n_selected ] = data[ mask ]
+                        extracted[ quantity ] = data[ :n_selected ]
+                    else:
+                        extracted[ quantity ] = data[ mask ]
+                if block_candidates is not None:
+                    # Convert the mask to a mask over all the particles
+                    # of the block
+                    candidates_mask = mask
+                    mask = np.zeros( len(block_candidates), dtype='bool' )
+                    mask[ block_candidates ] = candidates_mask
+
+            # Extract each of the other quantities (only the selected
+            # particles, and only once if a quantity is requested
+            # several times)
+            for quantity in quantities:
+                if quantity not in extracted:
+                    extracted[ quantity ] = get_quantity( quantity,
+                                                          mask, block )
+
+            yield( [ extracted[ quantity ] for quantity in quantities ] )
+
+def as_type_of( data, value ):
+    """
+    Return the scalar `value` converted to the (floating point) type of
+    `data`, so that combining them does not promote the data (e.g. the
+    float32 data of a buffer, with numpy >= 2). Arrays are returned as is.
+    """
+    if np.ndim( value ) == 0 and np.issubdtype( data.dtype, np.floating ):
+        return( data.dtype.type( value ) )
+    return( value )
+
+def concatenate_data( arrays, out=None ):
     """
-    # Translate the quantity to the OpenPMD format
-    dict_quantity = { 'x' : 'position/x',
-                      'y' : 'position/y',
-                      'z' : 'position/z',
-                      'ux' : 'momentum/x',
-                      'uy' : 'momentum/y',
-                      'uz' : 'momentum/z',
-                      'w' : 'weighting'}
-    if quantity in dict_quantity:
-        opmd_quantity = dict_quantity[quantity]
-    else:
-        opmd_quantity = quantity
-
-    # Open the HDF5 file
-    dfile = h5py.File( filename, 'r' )
-    base_path =  get_bpath( dfile )
+    Concatenate the data of several files (into the buffer `out`,
+    if it is not None)
+
+    When the arrays are all constant with the same value (see
+    `get_constant_data`), the result is also constant (i.e. it does
+    not allocate memory).
+    """
+    if out is not None:
+        out = get_buffer_view( out, ( sum( len(a) for a in arrays ), ) )
+        return( np.concatenate( arrays, out=out ) )
+    values = [ reduce_constant( array ) for array in arrays \
+               if len( array ) > 0 ]
+    if (len( values ) > 0) and \
+            all( np.ndim( value ) == 0 for value in values ) and \
+            all( value == values[0] for value in values ):
+        return( np.broadcast_to( values[0],
+                    sum( len( array ) for array in arrays ) ) )
+    return( np.concatenate( arrays ) )
+
+def get_species_group( dfile, species, iteration=None ):
+    """
+    Return the h5py group of the species `species`, for the iteration
+    `iteration` (see the docstring of `read_particle`) of the file `dfile`
+    """
+    base_path = get_bpath( dfile, iteration )
     particles_path = dfile.attrs['particlesPath'].decode()
+    return( dfile[ os.path.join( base_path, particles_path, species ) ] )
 
-    # Find the right dataset
-    species_grp =  dfile[ os.path.join( base_path, particles_path, species ) ]
-    data = get_data( species_grp[ opmd_quantity ] )
-
-    # - Return positions in microns, with an offset
-    if quantity in ['x', 'y', 'z']:
-        offset = get_data( species_grp[ 'positionOffset/%s' %quantity ] )
-        data = 1.e6 * (data + offset)
-    # - Return momentum in normalized units
-    elif quantity in ['ux', 'uy', 'uz' ]: 
-        norm_factor = 1./( get_data( species_grp['mass'] ) * constants.c )
-        data = data * norm_factor
-
-    # Close the HDF5 file and return the data
-    dfile.close()
-    return( data )
+def get_block_sizes( filename, species, quantities, iteration=None ):
+    """
+    Return the number of particles of the blocks in which the record of
+    each quantity is read (i.e. the size of its chunks, see `get_block_size`)
+
+    Parameters
+    ----------
+    filename : string
+        The name of the file
+
+    species : string
+        The name of the species (in the OpenPMD file)
+
+    quantities : list of strings
+        The quantities (see the docstring of `read_particle`)
+
+    iteration : int, optional
+        The iteration (see the docstring of `read_particle`)
+
+    Returns
+    -------
+    A list of ints (one per element of `quantities`)
+    """
+    file_pool = FilePool( max_open_files=0 )
+    with file_pool.open( filename ) as dfile:
+        species_grp = get_species_group( dfile, species, iteration )
+        return( [ get_block_size( species_grp[
+                    dict_quantity.get( quantity, quantity ) ] ) \
+                  for quantity in quantities ] )
+
+def read_patch_range( filename, species, quantity, file_pool=None,
+                      iteration=None ):
+    """
+    Return the minimum and maximum of the region of the particle patches
+    of a species along a position (in microns), without reading the
+    particles (All the particles are in this region, but they do not
+    necessarily reach its bounds.)
+
+    Parameters
+    ----------
+    filename : string or list of strings
+        The name of the file(s) of the iteration
+
+    species : string
+        The name of the species (in the OpenPMD file)
+
+    quantity : string
+        The position: 'x', 'y' or 'z'
+
+    file_pool, iteration : optional
+        See the docstring of `read_particle`
+
+    Returns
+    -------
+    A tuple of two floats (NaN when there are no particles), or None
+    when a file has no particle patches for this position
+    """
+    if not isinstance( filename, list ):
+        filename = [ filename ]
+    if file_pool is None:
+        file_pool = FilePool( max_open_files=0 )
+    mins = []
+    maxs = []
+    for name in filename:
+        with file_pool.open( name ) as dfile:
+            species_grp = get_species_group( dfile, species, iteration )
+            if ('particlePatches/offset/%s' %quantity) not in species_grp:
+                return( None )
+            patches = species_grp['particlePatches']
+            # (Only the patches that contain particles)
+            non_empty = ( patches['numParticles'][...] > 0 )
+            patch_min = 1.e6 * get_data( patches['offset/%s' %quantity] )
+            patch_max = patch_min + 1.e6 * get_data(
+                                        patches['extent/%s' %quantity] )
+            mins.append( patch_min[ non_empty ] )
+            maxs.append( patch_max[ non_empty ] )
+    mins = np.concatenate( mins )
+    maxs = np.concatenate( maxs )
+    if len( mins ) == 0:
+        return( ( np.nan, np.nan ) )
+    return( ( mins.min(), maxs.max() ) )
+
+def get_patch_candidates( species_grp, select ):
+    """
+    Use the particle patches of a species (if any) to find the particles
+    that may satisfy the selection rules on positions
+
+    A patch is excluded when its region (i.e. its offset and extent)
+    does not overlap with the selected region.
+
+    Parameters
+    ----------
+    species_grp: an h5py.Group object
+        The group of the species
+
+    select: dict
+        A dictionary of rules to select the particles
+        (see the docstring of `get_selection_mask`)
+
+    Returns
+    -------
+    A list of tuples (start, stop): the ranges of the particles of the
+    patches that overlap with the selected region (see `merge_ranges`),
+    or None when the species has no particle patches or when there is
+    no selection rule on positions
+    """
+    spatial_rules = [ quantity for quantity in select.keys() \
+                      if quantity in ['x', 'y', 'z'] ]
+    if ('particlePatches' not in species_grp) or (len(spatial_rules) == 0):
+        return( None )
+    patches = species_grp['particlePatches']
+
+    # Find the patches that overlap with the selected region
+    num_particles = patches['numParticles'][...].astype( np.int64 )
+    num_offset = patches['numParticlesOffset'][...].astype( np.int64 )
+    overlap = np.ones( len(num_particles), dtype='bool' )
+    for quantity in spatial_rules:
+        # Bounds of the patches, in microns
+        patch_min = 1.e6 * get_data( patches['offset/%s' %quantity] )
+        patch_max = patch_min + 1.e6 * get_data(
+                                    patches['extent/%s' %quantity] )
+        lower, upper = select[quantity]
+        if lower is not None:
+            overlap = np.logical_and( overlap, patch_max >= lower )
+        if upper is not None:
+            overlap = np.logical_and( overlap, patch_min <= upper )
+
+    # Return the ranges of the particles of these patches
+    return( merge_ranges( num_offset[ overlap ],
+                          num_offset[ overlap ] + num_particles[ overlap ] ) )
+
+def get_selection_mask( select, data_dict ):
+    """
+    Return an array that determines whether each particle is selected,
+    based on the selection rules in `select`
+
+    Parameters
+    ----------
+    select: dict
+        A dictionary of rules to select the particles
+        'x' : [-4., 10.]   (Particles having x between -4 and 10 microns)
+        'ux' : [-0.1, 0.1] (Particles having ux between -0.1 and 0.1 mc)
+        'uz' : [5., None]  (Particles with uz above 5 mc)
+
+    data_dict: dict
+        A dictionary with the array of each quantity of `select`
+        (all for the same particles)
+
+    Returns
+    -------
+    A 1darray of bools
+    """
+    select_array = None
+    for quantity in select.keys():
+        q = data_dict[ quantity ]
+        if select_array is None:
+            select_array = np.ones( len(q), dtype='bool' )
+        # Check lower bound
+        if select[quantity][0] is not None:
+            select_array = np.logical_and(select_array, q>select[quantity][0])
+        # Check upper bound
+        if select[quantity][1] is not None:
+            select_array = np.logical_and(select_array, q<select[quantity][1])
+    return( select_array )
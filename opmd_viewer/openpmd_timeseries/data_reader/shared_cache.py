@@ -0,0 +1,762 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines the SharedArrayCache class, which keeps the arrays that were
+read in shared memory segments, so that all the processes of the user
+(e.g. several notebook kernels, or worker processes) can use them without
+reading them again, and without copying them.
+"""
+import os
+import stat
+import atexit
+import weakref
+import time
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+import numpy as np
+from .utilities import reduce_constant
+# The shared memory segments require Python 3.8 or later, and
+# the lock of the registry requires a POSIX system
+try:
+    import fcntl
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+else:
+    class Segment( shared_memory.SharedMemory ):
+        """
+        Shared memory segment that can be garbage-collected while the
+        arrays obtained from it are still in use (e.g. when the
+        interpreter exits), without raising a BufferError
+        """
+        def close( self ):
+            """
+            Detach the segment, or raise a BufferError if some arrays
+            obtained from it are still in use (the segment then remains
+            usable, e.g. to obtain new arrays from it)
+            """
+            try:
+                super( Segment, self ).close()
+            except BufferError:
+                # (SharedMemory.close releases the buffer of the segment
+                # before finding out that its memory map is still in use)
+                if self._buf is None:
+                    self._buf = memoryview( self._mmap )
+                raise
+
+        def __del__( self ):
+            try:
+                self.close()
+            except BufferError:
+                pass
+
+# Name of the directory (in the temporary directory) that contains
+# the registries of the shared memory segments (followed by the user id)
+REGISTRY_DIR = 'opmd_viewer_shared_cache'
+# Alignment of the arrays in the segments, in bytes
+ALIGNMENT = 64
+
+
+class SharedArrayCache(object):
+    """
+    Cache of numpy arrays in shared memory, with the same interface as
+    ArrayCache (see the corresponding docstring)
+
+    Each array (or tuple of objects, see `ArrayCache.put`) is stored in
+    a shared memory segment whose name is derived from its key and from the
+    stamps of its files, so that any process of the machine that uses the
+    same key (e.g. the same file, iteration and quantity) attaches to it,
+    and obtains read-only arrays that are views of the segment (without
+    copying the data).
+
+    The segments are listed in a registry file (protected by a file lock),
+    with their key, their size, the time of their last use and the
+    processes that currently use them (reference counting), along with
+    the processes that use the cache. A segment that is used by a process
+    is never removed:
+    - When the total size exceeds the budget, the least recently used
+      segments that are not used by any process are removed.
+    - The segments of a key whose files were modified since they were
+      stored (i.e. with other stamps) are removed as soon as they are
+      not used anymore.
+    - When the last process that uses the cache closes it (see `close`,
+      which is also called when the process exits), all the segments
+      are removed, so that no segment is left in shared memory.
+    A process stops using a segment as soon as the arrays that it obtained
+    from the segment are deleted. The registry file is only read when a
+    segment that this process is not attached to is requested, and only
+    written when its content changes.
+
+    The segments and the registry are private to the current user: the
+    registry directory is only writable by this user, the names of the
+    segments depend on the user id, and the segments of other users are
+    never attached. The content of a segment is described by a JSON header
+    (see `get_segment_layout`), so that reading a segment never executes
+    code, even if its content is corrupted.
+    """
+
+    def __init__( self, max_bytes=0, name='arrays', registry_dir=None ):
+        """
+        Initialize the cache (the segments that were stored by other
+        processes, with the same `name`, are available right away)
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            The maximal total size of the segments, in bytes, for all the
+            processes of the machine. When it is 0, the cache is disabled.
+
+        name : string, optional
+            The name of the cache (the caches with different names have
+            separate segments and budgets, e.g. 'particles' and 'fields')
+
+        registry_dir : string, optional
+            The directory of the registry file (shared by all the
+            processes of the user). When None, a directory that is specific
+            to the user is created in the temporary directory of the system.
+            It should be owned by the user, and not writable by others.
+        """
+        if shared_memory is None:
+            raise ValueError( 'The shared memory cache requires Python 3.8 '
+                              'or later, on a POSIX system.' )
+        self.max_bytes = max_bytes
+        self.name = name
+        registry_dir = get_registry_dir( registry_dir )
+        self.registry_file = os.path.join( registry_dir, '%s.json' %name )
+        # Segments that are attached by this process, and time of their
+        # last use by this process (written to the registry when they
+        # are released)
+        self.segments = {}
+        self.last_used = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Remove the segments when the process exits, if it is the last
+        # process that uses the cache
+        atexit.register( close_cache, weakref.ref( self ) )
+
+    @property
+    def enabled( self ):
+        "Whether the cache can store arrays"
+        return( self.max_bytes > 0 )
+
+    def get( self, key, stamps ):
+        """
+        Return the array that is stored for `key`, or None if there is
+        no such array or if the files have been modified since it was stored
+
+        Parameters
+        ----------
+        key : a hashable object
+            The identifier of the array
+            (e.g. a tuple (filename, iteration, species, quantity, ...))
+
+        stamps : tuple
+            The current stamps of the files (see `get_file_stamps`)
+        """
+        return( self.get_first( [ key ], stamps )[1] )
+
+    def get_first( self, keys, stamps ):
+        """
+        Return the first of the arrays stored for `keys` that is available
+        (see `ArrayCache.get_first`)
+
+        Parameters
+        ----------
+        keys : list of hashable objects
+            The identifiers of the arrays, by order of preference
+
+        stamps : tuple
+            The current stamps of the files (see `get_file_stamps`)
+
+        Returns
+        -------
+        A tuple (index of the key in `keys`, array), or (None, None)
+        """
+        with self.lock:
+            self._release_unused()
+            for i_key, key in enumerate( keys ):
+                value = self._attach( key, stamps )
+                if value is not None:
+                    self.hits += 1
+                    return( i_key, value )
+            self.misses += 1
+            return( None, None )
+
+    def put( self, key, stamps, value ):
+        """
+        Copy an array (or a tuple of objects, see `ArrayCache.put`) to
+        a new shared memory segment, after removing the least recently used
+        segments if needed (The array is made read-only, even if it is not
+        stored, as for ArrayCache.)
+
+        Parameters
+        ----------
+        key : a hashable object
+            The identifier of the array
+
+        stamps : tuple
+            The stamps of the files, taken before the array was read
+            (see `get_file_stamps`)
+
+        value : an np.ndarray, or a tuple
+            The array to be stored, or a tuple of objects to be stored
+            together (e.g. an array and its attributes)
+        """
+        for item in ( value if isinstance( value, tuple ) else ( value, ) ):
+            if isinstance( item, np.ndarray ):
+                item.flags.writeable = False
+        key_hash = get_key_hash( self.name, key )
+        segment_name = get_segment_name( key_hash, stamps )
+
+        with self.lock:
+            self._release_unused()
+            try:
+                header, blocks, n_bytes = get_segment_layout( stamps, value )
+            except (TypeError, ValueError):
+                # (The value contains objects that cannot be described
+                # in the header; it is not stored.)
+                return
+            if n_bytes > self.max_bytes:
+                return
+            with self._registry() as registry:
+                add_pid( registry['processes'] )
+                segments = registry['segments']
+                # Remove the unused segments of the same key with other
+                # stamps (whose data is outdated)
+                free_outdated( segments, key_hash, segment_name )
+                if segment_name in segments:
+                    # (e.g. stored by another process in the meantime)
+                    return
+                # Make room for the new segment
+                if not self._evict( segments, self.max_bytes - n_bytes ):
+                    return
+                try:
+                    write_segment( segment_name, n_bytes, header, blocks )
+                except (OSError, ValueError):
+                    # (e.g. the shared memory of the machine is full)
+                    return
+                segments[ segment_name ] = { 'key': key_hash,
+                    'n_bytes': n_bytes, 'last_used': time.time(),
+                    'pids': [], 'outdated': False }
+
+    def clear( self ):
+        """
+        Remove all the segments of the cache (for all the processes)
+
+        (The arrays that were already obtained from the cache remain valid.)
+        """
+        with self.lock:
+            with self._registry() as registry:
+                for segment_name in list( registry['segments'].keys() ):
+                    unlink_segment( segment_name )
+                registry['segments'] = {}
+
+    def close( self ):
+        """
+        Detach the segments that are no longer used by this process, and
+        stop using the cache. When no other process uses the cache, all the
+        segments are removed (the arrays that were already obtained from
+        the cache remain valid).
+
+        The cache can still be used after this call. This is called
+        automatically when the process exits.
+        """
+        with self.lock:
+            self._release_unused()
+            if not os.path.exists( self.registry_file ):
+                return
+            with self._registry() as registry:
+                processes = registry['processes']
+                if os.getpid() in processes:
+                    processes.remove( os.getpid() )
+                processes[:] = [ pid for pid in processes \
+                                 if is_running( pid ) ]
+                if len( processes ) == 0:
+                    for segment_name in list( registry['segments'].keys() ):
+                        unlink_segment( segment_name )
+                    registry['segments'] = {}
+
+    def stats( self ):
+        """
+        Return a dictionary with the number of hits and misses (of this
+        process), and the number and total size (in bytes) of the segments
+        (of all the processes)
+        """
+        with self.lock:
+            with self._registry() as registry:
+                segments = registry['segments']
+                return( { 'hits': self.hits, 'misses': self.misses,
+                    'n_arrays': len( segments ),
+                    'n_bytes': sum( entry['n_bytes'] for entry \
+                                    in segments.values() ),
+                    'max_bytes': self.max_bytes,
+                    'n_attached': len( self.segments ) } )
+
+    @contextmanager
+    def _registry( self ):
+        """
+        Context manager that yields the registry (a dictionary with the
+        list of the processes that use the cache, in `processes`, and one
+        entry per segment, in `segments`), with the lock of the registry
+        file acquired, and writes it back on exit if it was modified
+        (Should be called with self.lock acquired.)
+        """
+        with open( self.registry_file, 'a+' ) as f:
+            fcntl.flock( f, fcntl.LOCK_EX )
+            try:
+                f.seek( 0 )
+                content = f.read()
+                try:
+                    registry = json.loads( content )
+                except ValueError:
+                    # (e.g. a new registry file)
+                    registry = {}
+                registry.setdefault( 'processes', [] )
+                registry.setdefault( 'segments', {} )
+                yield registry
+                new_content = json.dumps( registry )
+                if new_content != content:
+                    f.seek( 0 )
+                    f.truncate()
+                    f.write( new_content )
+                    f.flush()
+            finally:
+                fcntl.flock( f, fcntl.LOCK_UN )
+
+    def _attach( self, key, stamps ):
+        """
+        Return the value stored for `key` with the stamps `stamps`, or None
+        if there is no such segment
+        (Should be called with self.lock acquired.)
+        """
+        key_hash = get_key_hash( self.name, key )
+        segment_name = get_segment_name( key_hash, stamps )
+        # The registry is only needed for the segments that this process
+        # is not attached to (the others cannot be removed in the meantime,
+        # since this process is registered as one of their users)
+        if segment_name not in self.segments:
+            with self._registry() as registry:
+                segments = registry['segments']
+                free_outdated( segments, key_hash, segment_name )
+                entry = segments.get( segment_name )
+                if entry is None:
+                    return( None )
+                # Register this process as a user of the segment
+                # (This prevents other processes from removing it.)
+                try:
+                    self.segments[ segment_name ] = \
+                        open_segment( segment_name )
+                except (OSError, ValueError):
+                    # (e.g. the segment was removed in the meantime)
+                    del segments[ segment_name ]
+                    return( None )
+                add_pid( registry['processes'] )
+                add_pid( entry['pids'] )
+                entry['last_used'] = time.time()
+        self.last_used[ segment_name ] = time.time()
+
+        try:
+            segment_stamps, value = read_segment(
+                self.segments[ segment_name ] )
+        except (ValueError, TypeError, KeyError, IndexError):
+            # (e.g. a corrupted segment)
+            return( None )
+        if segment_stamps != tuple( tuple( s ) for s in stamps ):
+            # (The segment is released at the next call, since `value`
+            # is not used)
+            return( None )
+        return( value )
+
+    def _release_unused( self ):
+        """
+        Detach the segments whose arrays are no longer used by this process
+        and unregister this process as a user of these segments (The
+        outdated segments that are not used anymore are then removed.)
+        (Should be called with self.lock acquired.)
+        """
+        released = []
+        for segment_name, segment in list( self.segments.items() ):
+            try:
+                segment.close()
+            except BufferError:
+                # Some arrays of this segment are still in use
+                continue
+            del self.segments[ segment_name ]
+            released.append( segment_name )
+        if len( released ) == 0:
+            return
+        with self._registry() as registry:
+            segments = registry['segments']
+            for segment_name in released:
+                last_used = self.last_used.pop( segment_name )
+                entry = segments.get( segment_name )
+                if entry is None:
+                    continue
+                if os.getpid() in entry['pids']:
+                    entry['pids'].remove( os.getpid() )
+                entry['last_used'] = max( entry['last_used'], last_used )
+                if entry['outdated'] and (len( entry['pids'] ) == 0):
+                    unlink_segment( segment_name )
+                    del segments[ segment_name ]
+
+    def _evict( self, segments, max_bytes ):
+        """
+        Remove the least recently used segments that are not used by any
+        (running) process, until the total size is at most `max_bytes`
+
+        Returns
+        -------
+        Whether the total size is now at most `max_bytes`
+        """
+        n_bytes = sum( entry['n_bytes'] for entry in segments.values() )
+        segment_names = sorted( segments.keys(),
+                                key=lambda name: segments[name]['last_used'] )
+        for segment_name in segment_names:
+            if n_bytes <= max_bytes:
+                break
+            entry = segments[ segment_name ]
+            if not is_used( entry ):
+                unlink_segment( segment_name )
+                del segments[ segment_name ]
+                n_bytes -= entry['n_bytes']
+        return( n_bytes <= max_bytes )
+
+
+def close_cache( cache_ref ):
+    """
+    Close a SharedArrayCache (given by a weak reference), if it still exists
+    (This is called when the process exits.)
+    """
+    cache = cache_ref()
+    if cache is not None:
+        try:
+            cache.close()
+        except (OSError, ValueError):
+            # (e.g. the registry directory was removed)
+            pass
+
+
+def free_outdated( segments, key_hash, segment_name ):
+    """
+    Remove the segments of the key `key_hash` other than `segment_name`
+    (i.e. with other stamps, whose data is outdated) that are not used
+    by any process, and flag the others, so that they are removed as
+    soon as they are not used anymore (see `_release_unused`)
+    """
+    for name, entry in list( segments.items() ):
+        if (entry['key'] != key_hash) or (name == segment_name):
+            continue
+        if is_used( entry ):
+            entry['outdated'] = True
+        else:
+            unlink_segment( name )
+            del segments[ name ]
+
+
+def is_used( entry ):
+    """
+    Return whether the segment of the registry entry `entry` is used by
+    a running process (after removing the processes that are not running)
+    """
+    entry['pids'] = [ pid for pid in entry['pids'] if is_running( pid ) ]
+    return( len( entry['pids'] ) > 0 )
+
+
+def add_pid( pids ):
+    "Add the current process to the list `pids`, if it is not in it"
+    if os.getpid() not in pids:
+        pids.append( os.getpid() )
+
+
+def get_registry_dir( registry_dir=None ):
+    """
+    Return the directory of the registry files, after creating it
+    if needed (with permissions 0700)
+
+    Raises a ValueError if the directory is not owned by the current user,
+    or if it is writable by other users (since the registry determines
+    which segments are attached).
+
+    Parameter
+    ---------
+    registry_dir : string or None
+        The requested directory, or None for the default directory of
+        the user (in the temporary directory of the system)
+    """
+    if registry_dir is None:
+        registry_dir = os.path.join( tempfile.gettempdir(),
+                                     '%s-%d' %(REGISTRY_DIR, os.getuid()) )
+    try:
+        os.makedirs( registry_dir, 0o700 )
+    except OSError:
+        # (e.g. the directory was created before, possibly by another process)
+        pass
+    # (`lstat` does not follow symbolic links, so that a link to a directory
+    # of another user is rejected)
+    dir_stat = os.lstat( registry_dir )
+    if (not stat.S_ISDIR( dir_stat.st_mode )) or \
+            (dir_stat.st_uid != os.getuid()) or (dir_stat.st_mode & 0o022):
+        raise ValueError( 'The registry directory of the shared memory '
+            'cache (%s) should be a directory owned by the current user, '
+            'and not writable by other users.' %registry_dir )
+    return( registry_dir )
+
+
+def get_key_hash( cache_name, key ):
+    """
+    Return an identifier of `key` (the same in all the processes of the
+    current user)
+    """
+    return( hashlib.md5( ( '%d:%s:%r' %( os.getuid(), cache_name, key )
+                         ).encode() ).hexdigest() )
+
+
+def get_segment_name( key_hash, stamps ):
+    """
+    Return the name of the shared memory segment of a key (given by
+    `get_key_hash`), for the stamps `stamps` of its files
+    """
+    stamps = tuple( tuple( s ) for s in stamps )
+    segment_hash = hashlib.md5( ( '%s:%r' %( key_hash, stamps )
+                                ).encode() ).hexdigest()
+    return( 'opmd_%s' %segment_hash[:24] )
+
+
+def get_segment_layout( stamps, value ):
+    """
+    Return the layout of the segment that stores `value`
+
+    The segment starts with the size of the header (8 bytes) and the
+    header, i.e. a JSON document with the stamps and the description of
+    the items of `value` (the non-array items are encoded in the header,
+    see `encode_object`, and the arrays of constant records are stored as
+    a single value), along with the offsets of the other arrays, which
+    follow the header (at aligned offsets).
+
+    Raises a TypeError if `value` contains objects that cannot be encoded.
+
+    Returns
+    -------
+    A tuple with the header (bytes), the list of (offset, array) blocks,
+    and the total size of the segment in bytes
+    """
+    items = value if isinstance( value, tuple ) else ( value, )
+    descriptions = []
+    arrays = []
+    for item in items:
+        if isinstance( item, np.ndarray ):
+            check_dtype( item.dtype )
+            constant = reduce_constant( item )
+            if (np.ndim( constant ) == 0) and (item.dtype.kind in 'biuf'):
+                descriptions.append( [ 'constant', item.dtype.str,
+                                       list( item.shape ), constant.item() ] )
+            else:
+                descriptions.append( [ 'array', item.dtype.str,
+                                       list( item.shape ) ] )
+                arrays.append( item )
+        else:
+            descriptions.append( [ 'object', encode_object( item ) ] )
+    # Offsets of the arrays, from the (aligned) end of the header
+    offsets = []
+    n_array_bytes = 0
+    for array in arrays:
+        offsets.append( n_array_bytes )
+        n_array_bytes = align( n_array_bytes + array.nbytes )
+    header = json.dumps( { 'stamps': [ list( s ) for s in stamps ],
+        'is_tuple': isinstance( value, tuple ),
+        'items': descriptions, 'offsets': offsets } ).encode()
+    start = align( 8 + len( header ) )
+    blocks = [ ( start + offset, array ) \
+               for offset, array in zip( offsets, arrays ) ]
+    return( header, blocks, start + n_array_bytes )
+
+
+def write_segment( segment_name, n_bytes, header, blocks ):
+    """
+    Create the segment `segment_name`, and write the header and the
+    arrays of `get_segment_layout` into it
+    """
+    try:
+        segment = open_segment( segment_name, n_bytes )
+    except FileExistsError:
+        # (e.g. a segment that was left by a process that crashed)
+        unlink_segment( segment_name )
+        segment = open_segment( segment_name, n_bytes )
+    try:
+        segment.buf[ :8 ] = np.array( [ len( header ) ], '<u8' ).tobytes()
+        segment.buf[ 8:8+len( header ) ] = header
+        for offset, array in blocks:
+            view = np.frombuffer( segment.buf, dtype=array.dtype,
+                count=array.size, offset=offset ).reshape( array.shape )
+            view[...] = array
+            del view
+    except Exception:
+        segment.close()
+        segment.unlink()
+        raise
+    segment.close()
+
+
+def read_segment( segment ):
+    """
+    Return the stamps and the value stored in an attached segment
+    (the arrays are read-only views of the segment)
+
+    Raises a ValueError (or TypeError, KeyError, IndexError) if the
+    content of the segment is invalid.
+    """
+    header_size = int( np.frombuffer( segment.buf, '<u8', 1 )[0] )
+    if 8 + header_size > segment.size:
+        raise ValueError( 'Invalid segment header' )
+    header = json.loads( bytes( segment.buf[ 8:8+header_size ] ).decode() )
+    start = align( 8 + header_size )
+    offsets = iter( header['offsets'] )
+    items = []
+    for description in header['items']:
+        if description[0] == 'array':
+            _, dtype, shape = description
+            dtype = check_dtype( np.dtype( dtype ) )
+            # (`frombuffer` checks that the array is within the segment)
+            item = np.frombuffer( segment.buf, dtype=dtype,
+                count=int( np.prod( shape ) ),
+                offset=start + int( next( offsets ) ) )
+            item = item.reshape( shape )
+            item.flags.writeable = False
+        elif description[0] == 'constant':
+            _, dtype, shape, constant = description
+            dtype = check_dtype( np.dtype( dtype ) )
+            item = np.broadcast_to( dtype.type( constant ), tuple( shape ) )
+        else:
+            item = decode_object( description[1] )
+        items.append( item )
+    stamps = tuple( tuple( s ) for s in header['stamps'] )
+    if header['is_tuple']:
+        return( stamps, tuple( items ) )
+    return( stamps, items[0] )
+
+
+def encode_object( obj ):
+    """
+    Return a representation of `obj` that can be written in JSON
+    (see `decode_object`)
+
+    The supported objects are None, booleans, numbers, strings, bytes,
+    tuples, lists and dictionaries of supported objects, numpy scalars and
+    numpy arrays of numbers or strings (e.g. the attributes of a field).
+    Other objects raise a TypeError.
+    """
+    if isinstance( obj, np.ndarray ):
+        check_dtype( obj.dtype )
+        if obj.dtype.kind not in 'biufU':
+            raise TypeError( 'Unsupported array type: %s' %obj.dtype )
+        return( { 'ndarray': [ obj.dtype.str, list( obj.shape ),
+                               obj.ravel().tolist() ] } )
+    elif isinstance( obj, np.generic ):
+        return( { 'scalar': encode_object( np.asarray( obj ) ) } )
+    elif (obj is None) or isinstance( obj, (bool, int, float, str) ):
+        return( obj )
+    elif isinstance( obj, bytes ):
+        return( { 'bytes': obj.decode( 'latin-1' ) } )
+    elif isinstance( obj, tuple ):
+        return( { 'tuple': [ encode_object( item ) for item in obj ] } )
+    elif isinstance( obj, list ):
+        return( { 'list': [ encode_object( item ) for item in obj ] } )
+    elif isinstance( obj, dict ):
+        return( { 'dict': [ [ encode_object( k ), encode_object( v ) ] \
+                            for k, v in obj.items() ] } )
+    raise TypeError( 'Unsupported object type: %s' %type( obj ).__name__ )
+
+
+def decode_object( data ):
+    """
+    Return the object that is represented by `data`
+    (the output of `encode_object`, read from JSON)
+    """
+    if not isinstance( data, dict ):
+        return( data )
+    (kind, content), = data.items()
+    if kind == 'ndarray':
+        dtype, shape, values = content
+        dtype = check_dtype( np.dtype( dtype ) )
+        return( np.array( values, dtype=dtype ).reshape( shape ) )
+    elif kind == 'scalar':
+        return( decode_object( content )[()] )
+    elif kind == 'bytes':
+        return( content.encode( 'latin-1' ) )
+    elif kind == 'tuple':
+        return( tuple( decode_object( item ) for item in content ) )
+    elif kind == 'list':
+        return( [ decode_object( item ) for item in content ] )
+    elif kind == 'dict':
+        return( dict( ( decode_object( k ), decode_object( v ) ) \
+                      for k, v in content ) )
+    raise ValueError( 'Invalid object in the segment header' )
+
+
+def check_dtype( dtype ):
+    """
+    Return `dtype`, after checking that it does not contain Python objects
+    (which cannot be shared between processes)
+    """
+    if dtype.hasobject:
+        raise TypeError( 'Arrays of Python objects cannot be shared.' )
+    return( dtype )
+
+
+def open_segment( segment_name, n_bytes=0 ):
+    """
+    Attach to the segment `segment_name`, or create it if `n_bytes` > 0
+
+    The segment is not tracked by the resource tracker of Python, so that
+    it is not removed when this process exits (the segments are removed
+    by `SharedArrayCache._evict` instead). An OSError is raised if the
+    segment belongs to another user.
+    """
+    create = ( n_bytes > 0 )
+    try:
+        segment = Segment( segment_name, create, n_bytes, track=False )
+    except TypeError:
+        # (Python < 3.13, where the segments are always tracked)
+        segment = Segment( segment_name, create, n_bytes )
+        resource_tracker.unregister( segment._name, 'shared_memory' )
+    # Only use the segments of the current user
+    # (e.g. not a segment created by another user with the same name)
+    if os.fstat( segment._fd ).st_uid != os.getuid():
+        segment.close()
+        raise OSError( errno.EPERM,
+                       'The segment %s belongs to another user' %segment_name )
+    return( segment )
+
+
+def unlink_segment( segment_name ):
+    """
+    Remove the segment `segment_name` (the processes that are attached
+    to it can still use it, until they detach)
+    """
+    try:
+        # (Attaching and unlinking the segment with the default
+        # tracking keeps the resource tracker consistent)
+        segment = shared_memory.SharedMemory( segment_name )
+    except (OSError, ValueError):
+        return
+    segment.close()
+    segment.unlink()
+
+
+def align( offset ):
+    "Return the first multiple of ALIGNMENT that is not below `offset`"
+    return( ( offset + ALIGNMENT - 1 ) // ALIGNMENT * ALIGNMENT )
+
+
+def is_running( pid ):
+    "Return whether the process `pid` is running"
+    try:
+        os.kill( pid, 0 )
+    except OSError as e:
+        return( e.errno == errno.EPERM )
+    return( True )
@@ -0,0 +1,214 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines functions that write and use sorted particle indices, i.e.
+sidecar files that store the order of the particles of a species sorted
+along a given quantity, so that a range selection on this quantity does
+not need to read this quantity for the whole species.
+
+The data files themselves are not reordered: the selected particles are
+still scattered in the datasets of the data file, and they are read
+block by block (see `get_selected_data`).
+"""
+import os
+import h5py
+import numpy as np
+from .utilities import open_h5_file
+
+# Default number of particles per bin of the index
+default_bin_size = 4096
+
+
+def get_index_filename( filename, kind='sorted_index' ):
+    """
+    Return the path of the sidecar file that holds the sorted indices
+    (or another kind of index, e.g. 'zone_map') of the data file
+    `filename` (a hidden file in the same directory)
+    """
+    dir_name, base_name = os.path.split( filename )
+    return( os.path.join( dir_name, '.%s.%s' %(base_name, kind) ) )
+
+
+def write_sorted_index( filename, stat, iteration, species, key, values,
+                        bin_size=default_bin_size ):
+    """
+    Write the sorted index of the quantity `key` of a species,
+    for one iteration of a data file
+
+    The index consists of:
+    - `order`: the permutation that sorts the particles along `key`
+    - `values`: the sorted values of `key`
+    - `bin_edges`: the first value of each bin of `bin_size` particles
+      (which is small enough to be read entirely at each selection)
+    The inode, size and modification time of the data file are stored
+    along with the index, so that an outdated index is never used (even
+    when the file was replaced on disk, e.g. by a rename).
+
+    Parameters
+    ----------
+    filename : string
+        The path to the data file
+
+    stat : os.stat_result
+        The result of `os.stat` for the data file, before `key` was read
+
+    iteration : int
+        The iteration of the data
+
+    species : string
+        The name of the species
+
+    key : string
+        The quantity along which the particles are sorted (e.g. 'z', 'uz')
+
+    values : 1darray
+        The value of `key` for each particle
+
+    bin_size : int, optional
+        The number of particles per bin of the index
+    """
+    index_filename = get_index_filename( filename )
+
+    # Reuse the existing index file only if it corresponds
+    # to the current version of the data file
+    mode = 'w'
+    if os.path.exists( index_filename ):
+        with h5py.File( index_filename, 'r' ) as index_file:
+            if is_up_to_date( index_file, stat ):
+                mode = 'a'
+    with h5py.File( index_filename, mode ) as index_file:
+        index_file.attrs['source_inode'] = stat.st_ino
+        index_file.attrs['source_size'] = stat.st_size
+        index_file.attrs['source_mtime'] = stat.st_mtime
+        order = np.argsort( values, kind='mergesort' )
+        values = values[ order ]
+
+        path = '%d/%s/%s' %(iteration, species, key)
+        if path in index_file:
+            del index_file[ path ]
+        group = index_file.create_group( path )
+        group.attrs['bin_size'] = bin_size
+        group.create_dataset( 'order', data=order )
+        group.create_dataset( 'values', data=values )
+        group.create_dataset( 'bin_edges', data=values[::bin_size] )
+
+
+def is_up_to_date( index_file, stat ):
+    """
+    Return whether the open index file corresponds to the version
+    of the data file whose `os.stat` result is `stat`
+    """
+    return( (index_file.attrs.get('source_inode') == stat.st_ino) and
+            (index_file.attrs.get('source_size') == stat.st_size) and
+            (index_file.attrs.get('source_mtime') == stat.st_mtime) )
+
+
+def get_index_candidates( filename, iteration, species, select,
+                          max_candidates=None ):
+    """
+    Use the sorted index of the data file (if any, and if it is up to date)
+    to find the particles that may satisfy the selection rules
+
+    Only the bins of the bounds of the selected range and the part of
+    `order` that corresponds to this range are read from the index.
+    However, since the data file is not sorted, the result is made of the
+    indices of the particles in the data file: the candidates are in general
+    scattered, and the quantities are then read in all the blocks of the
+    datasets that contain at least one candidate (not as one contiguous
+    range). The index thus saves the most when the selected particles
+    are clustered in the data file, or when they are few.
+
+    Parameters
+    ----------
+    filename : string
+        The path to the data file
+
+    iteration : int
+        The iteration to be read
+
+    species : string
+        The name of the species
+
+    select : dict
+        A dictionary of rules to select the particles
+        (see the docstring of `get_selection_mask`)
+
+    max_candidates : int, optional
+        When not None, the index of a quantity is not used if more than
+        `max_candidates` particles satisfy its rule (e.g. to keep the
+        indices smaller than a block of particles, in `iter_particles`)
+
+    Returns
+    -------
+    A sorted 1darray of ints (the indices of the particles that satisfy
+    the rules on the sorted quantities, bounds included), or None when
+    there is no usable index for the quantities of `select`
+    """
+    index_filename = get_index_filename( filename )
+    if (iteration is None) or (not os.path.exists( index_filename )):
+        return( None )
+    try:
+        index_file = open_h5_file( index_filename )
+    except (IOError, OSError):
+        # (e.g. the index is being written)
+        return( None )
+    if not is_up_to_date( index_file, os.stat( filename ) ):
+        index_file.close()
+        return( None )
+
+    candidates = None
+    for key in select.keys():
+        path = '%d/%s/%s' %(iteration, species, key)
+        if path not in index_file:
+            continue
+        group = index_file[ path ]
+        start, stop = find_sorted_range( group, *select[key] )
+        if (max_candidates is not None) and (stop - start > max_candidates):
+            continue
+        key_candidates = np.sort( group['order'][start:stop] )
+        if candidates is None:
+            candidates = key_candidates
+        else:
+            candidates = np.intersect1d( candidates, key_candidates,
+                                         assume_unique=True )
+    index_file.close()
+    return( candidates )
+
+
+def find_sorted_range( group, lower, upper ):
+    """
+    Find the range of the sorted values that are between `lower` and `upper`
+    (bounds included), by reading only the bins of the bounds
+
+    Parameters
+    ----------
+    group : an h5py.Group object
+        The group of the index (see `write_sorted_index`)
+
+    lower, upper : floats or None
+        The bounds of the selection (None for no bound)
+
+    Returns
+    -------
+    A tuple (start, stop) of indices in the sorted values
+    """
+    bin_edges = group['bin_edges'][...]
+    bin_size = int( group.attrs['bin_size'] )
+    values = group['values']
+
+    def find_position( bound, side ):
+        "Position of `bound` in the sorted values"
+        i_bin = max( np.searchsorted( bin_edges, bound, side=side ) - 1, 0 )
+        start = i_bin * bin_size
+        bin_values = values[ start:start+bin_size ]
+        return( start + np.searchsorted( bin_values, bound, side=side ) )
+
+    if lower is None:
+        start = 0
+    else:
+        start = find_position( lower, 'left' )
+    if upper is None:
+        stop = values.shape[0]
+    else:
+        stop = find_position( upper, 'right' )
+    return( start, max( start, stop ) )
@@ -4,14 +4,57 @@ This file is part of the OpenPMD viewer.
 It defines a set of helper data and functions which
 are used by the other files.
 """
+import os
 import h5py
 import numpy as np
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 # General dictionaries
 slice_dict = { 'x':0, 'y':1, 'z':2 }
+# Number of elements of the blocks in which a (non-chunked) 1d dataset is
+# divided, when reading only some of its elements (see `get_selected_data`)
+default_block_size = 65536
 
 
-def get_bpath( f ):
+def open_h5_file( filename, swmr=False ):
+    """
+    Open an HDF5 file in read-only mode
+
+    Parameters:
+    -----------
+    filename: string
+        The path to the file
+
+    swmr: bool, optional
+        Whether to open the file in SWMR (single-writer/multiple-reader)
+        mode, so that files that are still being written by a
+        simulation can be read consistently (requires HDF5 >= 1.10)
+
+    Returns:
+    --------
+    An h5py.File object
+    """
+    if swmr:
+        return( h5py.File( filename, 'r', swmr=True ) )
+    else:
+        return( h5py.File( filename, 'r' ) )
+
+def get_file_stat( filename ):
+    """
+    Return a tuple with the inode, modification time and size of a file,
+    which changes whenever the file is modified or replaced on disk
+    (e.g. by writing a new file and renaming it to `filename`)
+
+    Parameters:
+    -----------
+    filename: string
+        The path to the file
+    """
+    stat = os.stat( filename )
+    return( ( stat.st_ino, stat.st_mtime, stat.st_size ) )
+
+def get_bpath( f, iteration=None ):
     """
     Return a string that corresponds to the base path of the data.
 
@@ -22,7 +65,16 @@ def get_bpath( f ):
     Parameters:
     -----------
     f: am h5py.File object
+
+    iteration: int, optional
+        The requested iteration (needed when the file contains several
+        iterations, i.e. groupBased encoding). When it is None or
+        not present in the file, the first iteration of the file is used.
     """
+    if iteration is not None:
+        bpath = '/data/%d' %iteration
+        if bpath in f:
+            return( bpath )
     iteration = list(f['/data'].keys())[0]
     return( '/data/%s' %iteration )
 
@@ -47,7 +99,8 @@ def is_scalar_record( record ):
     return(scalar)
 
 
-def get_data( dset, i_slice=None, pos_slice=None ) :
+def get_data( dset, i_slice=None, pos_slice=None, unit_SI=None,
+              dtype=None, out=None ) :
     """
     Extract the data from a (possibly constant) dataset
     Slice the data according to the parameters i_slice and pos_slice
@@ -64,33 +117,496 @@ def get_data( dset, i_slice=None, pos_slice=None ) :
        The position at which to slice the array
        When None, no slice is performed
 
+    unit_SI: float, optional
+       The conversion factor to SI units
+       When None, it is read from the attribute `unitSI` of the dataset
+
+    dtype: a numpy dtype, optional
+       The type of the returned data (e.g. 'float32'), including the unit
+       conversion. When None, the type results from the unit conversion.
+
+    out: an np.ndarray, optional
+       The buffer in which the data is written (see `get_buffer_view`),
+       instead of a new array. The data is then read directly into it
+       (for an h5py.Dataset), and converted in place, in the type of `out`.
+
     Returns:
     --------
-    An np.ndarray (non-constant dataset) or a single double (constant dataset)
+    An np.ndarray (for a constant dataset, a read-only array that does not
+    allocate memory; see `get_constant_data`)
     """
     # Case of a constant dataset
     if type(dset) is h5py.Group:
-        shape = dset.attrs['shape']
+        shape = tuple( dset.attrs['shape'] )
         # Restrict the shape if slicing is enabled
         if pos_slice is not None:
             shape = shape[:pos_slice] + shape[pos_slice+1:]
-        # Create the corresponding dataset
-        data = dset.attrs['value'] * np.ones( shape )
+        data = get_constant_data( dset, shape, unit_SI, dtype )
+        if out is None:
+            return( data )
+        out = get_buffer_view( out, shape )
+        out[...] = data
+        return( out )
     # Case of a non-constant dataset
-    elif type(dset) is h5py.Dataset:
+    # (h5py.Dataset, or object with the same interface, e.g. ShardedDataset)
+    else:
         if pos_slice is None:
-            data = dset[...]
+            key = (Ellipsis,)
         elif pos_slice==0:
-            data = dset[i_slice,...]
+            key = (i_slice, Ellipsis)
         elif pos_slice==1:
-            data = dset[:,i_slice,...]
+            key = (slice(None), i_slice, Ellipsis)
         elif pos_slice==2:
-            data = dset[:,:,i_slice]
+            key = (slice(None), slice(None), i_slice)
+        if out is None:
+            data = dset[ key ]
+        else:
+            data = read_into( dset, key, out )
+            dtype = data.dtype
             
     # Scale by the conversion factor
-    data = data * dset.attrs['unitSI']
+    if unit_SI is None:
+        unit_SI = dset.attrs['unitSI']
+    return( convert_data( data, unit_SI, dtype ) )
+
+def get_selected_data( dset, mask, unit_SI=None, start=0, dtype=None,
+                       out=None ) :
+    """
+    Extract the elements of a 1d (possibly constant) dataset
+    that are selected by `mask`
+
+    Only the blocks of the dataset that contain selected elements are read
+    (these blocks are the chunks of the dataset, for chunked datasets),
+    so that a highly selective mask only reads a fraction of the dataset.
+
+    Parameters:
+    -----------
+    dset: an h5py.Dataset or h5py.Group (when constant)
+        The object from which the data is extracted
+
+    mask: 1darray of bools
+        Whether each element of the dataset is selected
+
+    unit_SI: float, optional
+       The conversion factor to SI units
+       When None, it is read from the attribute `unitSI` of the dataset
+
+    start: int, optional
+       The index of the element of the dataset that corresponds to the
+       first element of `mask` (when the mask only covers the elements
+       between `start` and `start+len(mask)`)
+
+    dtype: a numpy dtype, optional
+       The type of the returned data (see the docstring of `get_data`)
+
+    out: a 1darray, optional
+       The buffer in which the data is written
+       (see the docstring of `get_data`)
+
+    Returns:
+    --------
+    A 1darray with the selected elements
+    """
+    n_selected = np.count_nonzero( mask )
+    # Case of a constant dataset
+    if type(dset) is h5py.Group:
+        data = get_constant_data( dset, n_selected, unit_SI, dtype )
+        if out is None:
+            return( data )
+        out = get_buffer_view( out, (n_selected,) )
+        out[...] = data
+        return( out )
+    # Case of a non-constant dataset: read the blocks with selected elements
+    else:
+        ranges = get_selected_ranges( mask, get_block_size(dset), start )
+        if out is None:
+            data = np.empty( n_selected, dtype=dset.dtype )
+        else:
+            data = get_buffer_view( out, (n_selected,) )
+            dtype = data.dtype
+        i_data = 0
+        for (i_min, i_max) in ranges:
+            selected = dset[ i_min:i_max ][ mask[ i_min-start:i_max-start ] ]
+            data[ i_data:i_data+len(selected) ] = selected
+            i_data += len(selected)
+
+    # Scale by the conversion factor
+    if unit_SI is None:
+        unit_SI = dset.attrs['unitSI']
+    return( convert_data( data, unit_SI, dtype ) )
+
+def get_data_range( dset, start, stop, unit_SI=None, dtype=None,
+                    out=None ) :
+    """
+    Extract the elements of a 1d (possibly constant) dataset,
+    between the indices `start` and `stop`
+
+    Parameters:
+    -----------
+    dset: an h5py.Dataset or h5py.Group (when constant)
+        The object from which the data is extracted
+
+    start, stop: ints
+        The range of elements to be extracted
+
+    unit_SI: float, optional
+       The conversion factor to SI units
+       When None, it is read from the attribute `unitSI` of the dataset
+
+    dtype: a numpy dtype, optional
+       The type of the returned data (see the docstring of `get_data`)
+
+    out: a 1darray, optional
+       The buffer in which the data is written
+       (see the docstring of `get_data`)
+
+    Returns:
+    --------
+    A 1darray with `stop-start` elements
+    """
+    # Case of a constant dataset
+    if type(dset) is h5py.Group:
+        data = get_constant_data( dset, stop-start, unit_SI, dtype )
+        if out is None:
+            return( data )
+        out = get_buffer_view( out, (stop-start,) )
+        out[...] = data
+        return( out )
+    # Case of a non-constant dataset
+    else:
+        if out is None:
+            data = dset[ start:stop ]
+        else:
+            data = read_into( dset, (slice(start, stop),), out )
+            dtype = data.dtype
+
+    # Scale by the conversion factor
+    if unit_SI is None:
+        unit_SI = dset.attrs['unitSI']
+    return( convert_data( data, unit_SI, dtype ) )
+
+def read_into( dset, key, out ) :
+    """
+    Read the part `key` of a dataset into the buffer `out`
+
+    For an h5py.Dataset, the data is read directly into the buffer (with
+    `read_direct`, which also converts it to the type of the buffer),
+    so that no intermediate array is allocated.
+
+    Parameters:
+    -----------
+    dset: an h5py.Dataset (or object with the same interface)
+        The dataset from which the data is read
+
+    key: tuple of integers, slices and Ellipsis
+        The part of the dataset to be read
+
+    out: an np.ndarray
+        The buffer (see `get_buffer_view`)
+
+    Returns:
+    --------
+    The part of `out` that contains the data
+    """
+    out = get_buffer_view( out, get_key_shape( dset.shape, key ) )
+    if (type(dset) is h5py.Dataset) and out.flags.c_contiguous \
+            and (out.size > 0):
+        dset.read_direct( out, source_sel=key )
+    else:
+        out[...] = dset[ key ]
+    return( out )
+
+def get_key_shape( shape, key ) :
+    """
+    Return the shape of the part `key` of an array of shape `shape`
+
+    Parameters:
+    -----------
+    shape: tuple of ints
+        The shape of the array
+
+    key: tuple of integers, slices and (at most one) Ellipsis
+    """
+    # Replace the Ellipsis by full slices
+    if Ellipsis in key:
+        i = key.index( Ellipsis )
+        n_full = len(shape) - len(key) + 1
+        key = key[:i] + (slice(None),)*n_full + key[i+1:]
+    key = key + (slice(None),)*( len(shape) - len(key) )
+    # Keep the axes that are not indexed by an integer
+    return( tuple( len( range( *k.indices(n) ) ) \
+                   for (n, k) in zip( shape, key ) if isinstance(k, slice) ) )
+
+def get_buffer_view( out, shape ) :
+    """
+    Return the part of the buffer `out` that receives data of shape `shape`
+
+    A 1d buffer can be longer than the data (its first elements are then
+    used, e.g. so that the same buffer can receive a varying number of
+    particles). Otherwise, the buffer should have the shape of the data.
+
+    Parameters:
+    -----------
+    out: an np.ndarray
+        The buffer
+
+    shape: tuple of ints
+        The shape of the data
+    """
+    if (out.ndim == 1) and (len(shape) == 1) and (len(out) >= shape[0]):
+        return( out[ :shape[0] ] )
+    elif out.shape == tuple(shape):
+        return( out )
+    else:
+        raise ValueError( 'The buffer `out` has shape %s, but the data '
+            'has shape %s.' %( str(out.shape), str(tuple(shape)) ) )
+
+def get_constant_data( dset, shape, unit_SI=None, dtype=None ) :
+    """
+    Return the data of a constant dataset (i.e. a record whose elements
+    all have the same value), as an array of the given shape
+
+    The value is not repeated in memory: the array is a read-only view
+    of a single element (with zero strides), so that e.g. the charge of
+    10^9 particles does not allocate any memory. (Operations that need
+    a writeable array should be done on a copy, and `reduce_constant`
+    can be used to operate on the single value.)
 
-    return(data)
+    Parameters:
+    -----------
+    dset: an h5py.Group
+        The constant record
+
+    shape: int or tuple of ints
+        The shape of the returned array
+
+    unit_SI: float, optional
+       The conversion factor to SI units
+       When None, it is read from the attribute `unitSI` of the dataset
+
+    dtype: a numpy dtype, optional
+       The type of the returned data (see the docstring of `get_data`)
+
+    Returns:
+    --------
+    A read-only np.ndarray
+    """
+    if unit_SI is None:
+        unit_SI = dset.attrs['unitSI']
+    value = np.asarray( dset.attrs['value'] * unit_SI, dtype=dtype )
+    return( np.broadcast_to( value, shape ) )
+
+def reduce_constant( data ) :
+    """
+    Return the single value of `data` if it is a constant array
+    (as returned by `get_constant_data`), and `data` itself otherwise
+
+    This allows to combine a constant record with other arrays
+    (e.g. `w * reduce_constant(charge)`) without allocating it.
+
+    Parameters:
+    -----------
+    data: an np.ndarray
+    """
+    if isinstance( data, np.ndarray ) and (data.ndim > 0) \
+            and (data.size > 0) and (not any( data.strides )):
+        return( data[ (0,)*data.ndim ] )
+    else:
+        return( data )
+
+def convert_data( data, unit_SI, dtype=None ) :
+    """
+    Scale the data by the conversion factor `unit_SI`, and convert it
+    to the type `dtype`
+
+    The scaling is done in place (i.e. `data` should be an array that was
+    just read, and that is not used elsewhere), unless it changes the type
+    of the data (e.g. for integer data).
+
+    Parameters:
+    -----------
+    data: an np.ndarray
+        The data to be converted
+
+    unit_SI: float
+        The conversion factor to SI units
+
+    dtype: a numpy dtype, optional
+        The type of the returned data (e.g. 'float32'). When None, the
+        type results from the multiplication of `data` by `unit_SI`.
+
+    Returns:
+    --------
+    An np.ndarray
+    """
+    if dtype is not None:
+        data = data.astype( dtype, copy=False )
+        # (Convert the factor, so that it does not promote the data)
+        unit_SI = np.dtype( dtype ).type( unit_SI )
+    if (unit_SI != 1) or (np.result_type( data, unit_SI ) != data.dtype):
+        data = apply_in_place( np.multiply, data, unit_SI )
+
+    return( data )
+
+def apply_in_place( ufunc, data, operand ) :
+    """
+    Return `ufunc( data, operand )` (e.g. with ufunc=np.multiply),
+    computed in place in `data` when it is writeable (i.e. not a constant
+    array) and when this does not change its type
+
+    Parameters:
+    -----------
+    ufunc: a numpy ufunc with two inputs
+
+    data: an np.ndarray
+        An array that is not used elsewhere (e.g. that was just read)
+
+    operand: a scalar or an np.ndarray
+    """
+    if isinstance( data, np.ndarray ) and data.flags.writeable and \
+            ( np.result_type( data, operand ) == data.dtype ):
+        return( ufunc( data, operand, out=data ) )
+    else:
+        return( ufunc( data, operand ) )
+
+def get_block_size( dset ) :
+    """
+    Return the number of elements of the blocks in which a 1d dataset
+    is read, when reading only some of its elements
+    (i.e. the size of its chunks, for a chunked dataset)
+
+    Parameters:
+    -----------
+    dset: an h5py.Dataset or h5py.Group (when constant)
+    """
+    if getattr( dset, 'chunks', None ) is not None:
+        return( dset.chunks[0] )
+    else:
+        return( default_block_size )
+
+def get_selected_ranges( mask, block_size, start=0 ) :
+    """
+    Return the ranges of indices that contain all the selected elements
+    of `mask`, made of whole blocks of `block_size` elements
+    (Consecutive blocks are merged into a single range.)
+
+    Parameters:
+    -----------
+    mask: 1darray of bools
+        Whether each element is selected
+
+    block_size: int
+        The number of elements of each block
+
+    start: int, optional
+        The index of the first element of `mask` (the blocks are aligned
+        on multiples of `block_size`, and the ranges are clipped to the
+        elements of `mask`)
+
+    Returns:
+    --------
+    A list of tuples (start, stop)
+    """
+    N = len(mask)
+    if N == 0:
+        return( [] )
+    # Find the blocks that contain at least one selected element
+    first_block = start // block_size
+    block_edges = np.arange( first_block*block_size, start+N, block_size )
+    block_starts = np.maximum( block_edges, start ) - start
+    selected = np.logical_or.reduceat( mask, block_starts )
+    # Find the runs of consecutive selected blocks
+    edges = np.diff( np.concatenate( ([0], selected.astype(int), [0]) ) )
+    run_starts = np.flatnonzero( edges == 1 ) + first_block
+    run_ends = np.flatnonzero( edges == -1 ) + first_block
+    return( [ ( max( i_start*block_size, start ),
+                min( i_end*block_size, start+N ) ) \
+              for (i_start, i_end) in zip( run_starts, run_ends ) ] )
+
+def merge_ranges( starts, stops ) :
+    """
+    Return the sorted list of disjoint ranges of indices that covers
+    the ranges [start, stop) given by `starts` and `stops` (in any order)
+
+    Returns:
+    --------
+    A list of tuples (start, stop)
+    """
+    ranges = []
+    for start, stop in sorted( zip( starts, stops ) ):
+        if stop <= start:
+            continue
+        if (len(ranges) > 0) and (start <= ranges[-1][1]):
+            ranges[-1] = ( ranges[-1][0], max( ranges[-1][1], stop ) )
+        else:
+            ranges.append( ( start, stop ) )
+    return( ranges )
+
+def intersect_ranges( ranges_1, ranges_2 ) :
+    """
+    Return the intersection of two sorted lists of disjoint ranges
+    of indices (see `merge_ranges`)
+
+    Returns:
+    --------
+    A list of tuples (start, stop)
+    """
+    ranges = []
+    i_1 = 0
+    i_2 = 0
+    while (i_1 < len(ranges_1)) and (i_2 < len(ranges_2)):
+        start = max( ranges_1[i_1][0], ranges_2[i_2][0] )
+        stop = min( ranges_1[i_1][1], ranges_2[i_2][1] )
+        if start < stop:
+            ranges.append( ( start, stop ) )
+        if ranges_1[i_1][1] < ranges_2[i_2][1]:
+            i_1 += 1
+        else:
+            i_2 += 1
+    return( ranges )
+
+def get_candidates_mask( start, stop, ranges=None, indices=None ) :
+    """
+    Return whether each of the elements between `start` and `stop` is a
+    candidate, i.e. is in one of the `ranges` and in `indices`, so that
+    the memory that is used is that of the elements of this block only
+
+    Parameters:
+    -----------
+    start, stop: ints
+        The indices of the first element and after the last element
+
+    ranges: list of tuples (start, stop), or None
+        Sorted, disjoint ranges of candidates (see `merge_ranges`),
+        or None if they do not restrict the candidates
+
+    indices: 1darray of ints, or None
+        Sorted indices of candidates, or None if they do not restrict
+        the candidates
+
+    Returns:
+    --------
+    A 1darray of bools with `stop - start` elements, or None when both
+    `ranges` and `indices` are None
+    """
+    if (ranges is None) and (indices is None):
+        return( None )
+    if ranges is None:
+        mask = np.ones( stop - start, dtype='bool' )
+    else:
+        mask = np.zeros( stop - start, dtype='bool' )
+        for range_start, range_stop in ranges:
+            if range_start >= stop:
+                break
+            if range_stop > start:
+                mask[ max( range_start, start ) - start :
+                      min( range_stop, stop ) - start ] = True
+    if indices is not None:
+        i_start, i_stop = np.searchsorted( indices, [ start, stop ] )
+        indices_mask = np.zeros( stop - start, dtype='bool' )
+        indices_mask[ indices[ i_start:i_stop ] - start ] = True
+        mask = np.logical_and( mask, indices_mask )
+    return( mask )
 
 def get_shape( dset ) :
     """
@@ -109,7 +625,60 @@ def get_shape( dset ) :
     if type(dset) is h5py.Group:
         shape = dset.attrs['shape']
     # Case of a non-constant dataset
-    elif type(dset) is h5py.Dataset:
+    else:
         shape = dset.shape
 
     return(shape)
+
+def pool_map( function, items, n_workers=1, pool_type='thread' ):
+    """
+    Apply `function` to each element of `items`, possibly using
+    several concurrent workers
+
+    Parameters:
+    -----------
+    function: callable
+        The function to apply (when pool_type is 'process', it should be
+        a module-level function, or a functools.partial of such a function)
+
+    items: list
+        The arguments with which `function` is called
+
+    n_workers: int, optional
+        The number of concurrent workers.
+        When n_workers is 1, the function is applied serially.
+
+    pool_type: string, optional
+        Either 'thread' or 'process' (the workers are separate processes).
+        Note that h5py holds a global lock during each call to HDF5
+        (opening a file, reading a dataset or an attribute, ...), so that
+        threads do not read HDF5 files concurrently: they only overlap
+        the work that is done outside of HDF5 (e.g. in numpy or Python).
+        HDF5 files are only read concurrently by a pool of processes.
+
+    Returns:
+    --------
+    A list of the results, in the same order as `items`
+    """
+    # Serial execution
+    if (n_workers <= 1) or (len(items) <= 1):
+        return( [ function( item ) for item in items ] )
+
+    # Concurrent execution
+    n_workers = min( n_workers, len(items) )
+    if pool_type == 'thread':
+        pool = ThreadPool( n_workers )
+    elif pool_type == 'process':
+        pool = Pool( n_workers )
+    else:
+        raise ValueError(
+            "Invalid pool_type: %s (should be either 'thread' "
+            "or 'process')" %pool_type )
+    try:
+        # (`map` returns the results in the order of `items`)
+        results = pool.map( function, items )
+    finally:
+        pool.close()
+        pool.join()
+
+    return( results )
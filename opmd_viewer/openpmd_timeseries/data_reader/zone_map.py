@@ -0,0 +1,214 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines functions that write and use zone maps, i.e. sidecar files that
+store the minimum, maximum and number of particles of each block of the
+particle records, so that the blocks that cannot satisfy a selection are
+not read.
+"""
+import os
+import h5py
+import numpy as np
+from .utilities import open_h5_file, merge_ranges, intersect_ranges
+from .sorted_index import get_index_filename, is_up_to_date
+
+
+def write_zone_map( filename, stat, iteration, species, quantity,
+                    block_stats, block_size ):
+    """
+    Write the zone map of a particle quantity, for one iteration
+    of a data file
+
+    The zone map consists of the minimum (`min`), maximum (`max`) and
+    number of particles (`count`) of each block of `block_size` particles
+    (see `get_block_stats`). The inode, size and modification time of the
+    data file are stored along with the zone map, so that an outdated zone
+    map is never used (even when the file was replaced on disk).
+
+    Parameters
+    ----------
+    filename : string
+        The path to the data file
+
+    stat : os.stat_result
+        The result of `os.stat` for the data file, before it was read
+
+    iteration : int
+        The iteration of the data
+
+    species, quantity : string
+        The name of the species and of the particle quantity
+
+    block_stats : tuple of 1darrays
+        The minimum, maximum and number of particles of each block
+        (see `get_block_stats`)
+
+    block_size : int
+        The number of particles per block (usually the size of the chunks
+        of the record, see `get_block_size`)
+    """
+    index_filename = get_index_filename( filename, 'zone_map' )
+
+    # Reuse the existing file only if it corresponds
+    # to the current version of the data file
+    mode = 'w'
+    if os.path.exists( index_filename ):
+        with h5py.File( index_filename, 'r' ) as index_file:
+            if is_up_to_date( index_file, stat ):
+                mode = 'a'
+    with h5py.File( index_filename, mode ) as index_file:
+        index_file.attrs['source_inode'] = stat.st_ino
+        index_file.attrs['source_size'] = stat.st_size
+        index_file.attrs['source_mtime'] = stat.st_mtime
+
+        path = '%d/%s/%s' %(iteration, species, quantity)
+        if path in index_file:
+            del index_file[ path ]
+        group = index_file.create_group( path )
+        group.attrs['block_size'] = block_size
+        for name, data in zip( [ 'min', 'max', 'count' ], block_stats ):
+            group.create_dataset( name, data=data )
+
+
+def get_block_stats( values, block_size ):
+    """
+    Return the minimum, maximum and number of particles of each block
+    of `block_size` particles of `values` (NaN values are ignored)
+
+    Since the blocks are independent, the statistics of a quantity can be
+    computed chunk by chunk (with chunks of whole blocks) and concatenated.
+
+    Parameters
+    ----------
+    values : 1darray
+        The value of a quantity for each particle (of a chunk)
+
+    block_size : int
+        The number of particles per block
+
+    Returns
+    -------
+    A tuple of three 1darrays (one element per block)
+    """
+    block_starts = np.arange( 0, len(values), block_size )
+    counts = np.diff( np.append( block_starts, len(values) ) )
+    if len(values) == 0:
+        return( np.zeros(0), np.zeros(0), counts )
+    return( np.fmin.reduceat( values, block_starts ),
+            np.fmax.reduceat( values, block_starts ), counts )
+
+
+def open_zone_map( filename ):
+    """
+    Open the zone map file of the data file `filename`
+
+    Returns
+    -------
+    An h5py.File object, or None if there is no zone map file or
+    if it does not correspond to the current version of the data file
+    """
+    index_filename = get_index_filename( filename, 'zone_map' )
+    if not os.path.exists( index_filename ):
+        return( None )
+    try:
+        index_file = open_h5_file( index_filename )
+    except (IOError, OSError):
+        # (e.g. the zone map is being written)
+        return( None )
+    if not is_up_to_date( index_file, os.stat( filename ) ):
+        index_file.close()
+        return( None )
+    return( index_file )
+
+
+def get_zone_map_candidates( filename, iteration, species, select ):
+    """
+    Use the zone maps of the data file (if any, and if they are up to date)
+    to find the blocks of particles that may satisfy the selection rules
+
+    Parameters
+    ----------
+    filename : string
+        The path to the data file
+
+    iteration : int
+        The iteration to be read
+
+    species : string
+        The name of the species
+
+    select : dict
+        A dictionary of rules to select the particles
+        (see the docstring of `get_selection_mask`)
+
+    Returns
+    -------
+    A list of tuples (start, stop): the ranges of the particles of the
+    blocks whose range overlaps with the selected range, for each quantity
+    that has a zone map (see `merge_ranges`), or None when there is no
+    usable zone map for the quantities of `select`
+    """
+    if iteration is None:
+        return( None )
+    index_file = open_zone_map( filename )
+    if index_file is None:
+        return( None )
+
+    candidates = None
+    for quantity in select.keys():
+        path = '%d/%s/%s' %(iteration, species, quantity)
+        if path not in index_file:
+            continue
+        group = index_file[ path ]
+        # Find the blocks that overlap with the selected range
+        overlap = group['count'][...] > 0
+        lower, upper = select[quantity]
+        if lower is not None:
+            overlap = np.logical_and( overlap, group['max'][...] > lower )
+        if upper is not None:
+            overlap = np.logical_and( overlap, group['min'][...] < upper )
+        # Find the ranges of the particles of these blocks
+        counts = group['count'][...].astype( np.int64 )
+        stops = np.cumsum( counts )
+        quantity_candidates = merge_ranges( stops[ overlap ] -
+                                counts[ overlap ], stops[ overlap ] )
+        if candidates is None:
+            candidates = quantity_candidates
+        else:
+            candidates = intersect_ranges( candidates, quantity_candidates )
+    index_file.close()
+    return( candidates )
+
+
+def get_zone_map_range( filename, iteration, species, quantity ):
+    """
+    Return the global minimum and maximum of a particle quantity, from the
+    zone map of the data file, or None if there is no usable zone map
+
+    Parameters
+    ----------
+    filename : string
+        The path to the data file
+
+    iteration : int
+        The iteration
+
+    species, quantity : string
+        The name of the species and of the particle quantity
+    """
+    index_file = open_zone_map( filename )
+    if index_file is None:
+        return( None )
+    path = '%d/%s/%s' %(iteration, species, quantity)
+    if path in index_file:
+        group = index_file[ path ]
+        mins = group['min'][...]
+        maxs = group['max'][...]
+        if len(mins) > 0:
+            value_range = ( np.nanmin( mins ), np.nanmax( maxs ) )
+        else:
+            value_range = ( np.nan, np.nan )
+    else:
+        value_range = None
+    index_file.close()
+    return( value_range )
@@ -149,6 +149,17 @@ class InteractiveViewer(object):
                 self.current_t= self.t[self.current_i]
             slider.value = self.current_t*1.e15
 
+        def update_slider_range() :
+            "Extend the range of the slider when new outputs are found"
+            slider.max = math.ceil(1.e15*self.tmax)
+            slider.min = math.ceil(1.e15*self.tmin)
+            slider.step = math.ceil(1.e15*(self.tmax-self.tmin))/20.
+
+        def check_new_outputs(b) :
+            "Add the outputs that were written since the last check"
+            n_new = self.refresh()
+            print("Found %d new output(s)." %n_new)
+
         # ---------------
         # Define widgets
         # ---------------
@@ -160,6 +171,14 @@ class InteractiveViewer(object):
             step=math.ceil(1.e15*(self.tmax-self.tmin))/20.,
             description="t (fs)")
         slider.on_trait_change( change_t, 'value' )
+        # (`refresh` extends the range of the slider when new outputs arrive;
+        # the callback of the previous slider is replaced, so that calling
+        # `slider` several times does not accumulate callbacks)
+        previous_callback = getattr( self, '_slider_callback', None )
+        if previous_callback in self._refresh_callbacks:
+            self._refresh_callbacks.remove( previous_callback )
+        self._slider_callback = update_slider_range
+        self._refresh_callbacks.append( update_slider_range )
 
         # Forward button
         button_p = widgets.Button(description="+")
@@ -169,8 +188,13 @@ class InteractiveViewer(object):
         button_m = widgets.Button(description="-")
         button_m.on_click(step_bw)
 
+        # Button to look for new outputs (e.g. for a running simulation)
+        button_new = widgets.Button(description="Check for new outputs")
+        button_new.on_click(check_new_outputs)
+
         # Display the time widgets
-        container = widgets.HBox(children=[ button_m, button_p, slider ])
+        container = widgets.HBox(
+            children=[ button_m, button_p, slider, button_new ])
         display(container)
 
         # Field widgets
@@ -0,0 +1,91 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines the IterationIndex class, which is used to find the output
+that corresponds to a given iteration or time.
+"""
+import numpy as np
+
+
+class IterationIndex(object):
+    """
+    Index of the outputs of a time series, by iteration and by time
+
+    Iterations are looked up in a dictionary (O(1)), and times are looked
+    up by a binary search in the sorted array of times (O(log N)).
+    """
+
+    def __init__( self, iterations ):
+        """
+        Build the index of the iterations
+
+        Parameter
+        ---------
+        iterations : list of ints
+            The iteration of each output of the series
+        """
+        self.iterations = np.array( iterations, dtype=int )
+        self.positions = dict( (iteration, i) for (i, iteration) \
+                               in enumerate(iterations) )
+        # The index of the times is built only when needed
+        # (see `set_times`), since the times may not be known yet
+        self.t_order = None
+        self.sorted_t = None
+
+    def has_times( self ):
+        "Return whether the index of the times has been built"
+        return( self.sorted_t is not None )
+
+    def set_times( self, t ):
+        """
+        Build the index of the times
+
+        Parameter
+        ---------
+        t : 1darray of floats
+            The time of each output of the series
+        """
+        # (The stable sort keeps outputs with the same time in order)
+        self.t_order = np.argsort( t, kind='mergesort' )
+        self.sorted_t = t[ self.t_order ]
+
+    def find_iteration( self, iteration ):
+        """
+        Return the index of the output that corresponds to `iteration`,
+        or None if this iteration is not in the series
+        """
+        return( self.positions.get( iteration ) )
+
+    def find_time( self, t ):
+        """
+        Return the index of the last output whose time is lower or equal
+        to `t` (the first one, if several outputs have this time).
+        `t` should be within the range of the times of the series.
+        """
+        i_sorted = np.searchsorted( self.sorted_t, t, side='right' ) - 1
+        i_sorted = np.searchsorted( self.sorted_t, self.sorted_t[i_sorted],
+                                    side='left' )
+        return( int( self.t_order[ i_sorted ] ) )
+
+    def select_time_range( self, t0=None, t1=None, stride=1 ):
+        """
+        Return the indices of the outputs whose time is between `t0` and
+        `t1` (included), sorted by time, keeping one output every `stride`
+
+        Parameters
+        ----------
+        t0, t1 : floats (in seconds), optional
+            The bounds of the time range (None for no bound)
+
+        stride : int, optional
+            Keep one output every `stride` outputs
+        """
+        if t0 is None:
+            i_start = 0
+        else:
+            i_start = np.searchsorted( self.sorted_t, t0, side='left' )
+        if t1 is None:
+            i_end = len( self.sorted_t )
+        else:
+            i_end = np.searchsorted( self.sorted_t, t1, side='right' )
+        return( self.t_order[ i_start:i_end:stride ] )
@@ -5,10 +5,26 @@ It defines the main OpenPMDTimeSeries class.
 """
 import os
 import re
+import time
 import numpy as np
-from .plotter import Plotter
-from .data_reader.params_reader import read_openPMD_params
-from .data_reader.particle_reader import read_particle
+from functools import partial
+from itertools import groupby
+from collections import OrderedDict
+from .plotter import Plotter, get_block_ranges, accumulate_histogram
+from .metadata_index import MetadataIndex
+from .iteration_index import IterationIndex
+from .data_reader.file_pool import FilePool
+from .data_reader.params_reader import scan_openPMD_params, \
+     read_group_based_params, list_file_iterations
+from .data_reader.particle_reader import read_particles, iter_particles, \
+    get_block_sizes, read_patch_range, default_chunk_size
+from .data_reader.sorted_index import write_sorted_index, default_bin_size
+from .data_reader.zone_map import write_zone_map, get_zone_map_range, \
+    get_block_stats
+from .data_reader.utilities import pool_map
+from .data_reader.array_cache import ArrayCache, get_file_stamps, \
+    get_file_key, get_selection_key
+from .data_reader.shared_cache import SharedArrayCache
 from .data_reader.field_reader import read_field_2d, \
      read_field_circ, read_field_3d
 
@@ -24,6 +40,33 @@ except ImportError:
         'The opmd_viewer API is nonetheless working.')
     parent_class = object
 
+# Use the fast directory listing of Python >= 3.5, when available
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # Minimal replacement, based on os.listdir
+        class DirEntry(object):
+            "Object with the same interface as the entries of os.scandir"
+            def __init__( self, dir_path, name ):
+                self.name = name
+                self.path = os.path.join( dir_path, name )
+            def is_dir( self ):
+                return( os.path.isdir( self.path ) )
+
+        def scandir( dir_path ):
+            "Return the entries of the directory `dir_path`"
+            return( [ DirEntry( dir_path, name ) \
+                      for name in os.listdir( dir_path ) ] )
+
+# Regular expression that extracts the iteration from the name of a file,
+# when no pattern is given by the user (e.g. data00001000.h5, or
+# data00001000_r0003.h5 when each MPI rank writes its own file, in which
+# case the group `rank` is the rank suffix)
+default_file_regex = re.compile( r'(\d+)(?P<rank>_r\d+)?\.h[df]*5$' )
+
 # Define a custom Exception
 class OpenPMDException(Exception):
     "Exception raised for invalid use of the openPMD-viewer API"
@@ -42,7 +85,13 @@ class OpenPMDTimeSeries(parent_class) :
     - slider
     """
 
-    def __init__( self, path_to_dir ) :
+    def __init__( self, path_to_dir, n_workers=1, pool_type='process',
+                  metadata_index=None, check_all_files=True,
+                  swmr=False, file_pattern=None, recursive=False,
+                  max_open_files=16, dtype=None,
+                  particle_cache_size=0, field_cache_size=0,
+                  compressed_cache_size=0, cache_backend='memory',
+                  verbose=False ) :
         """
         Initialize an openPMD time series
 
@@ -56,9 +105,154 @@ class OpenPMDTimeSeries(parent_class) :
             For the moment, only HDF5 files are supported. There should be
             one file per iteration, and the name of the files should end
             with the iteration number, followed by '.h5' (e.g. data0005000.h5)
+            Alternatively, this can be the path to a single file that
+            contains all the iterations (groupBased encoding).
+
+        n_workers : int, optional
+            The number of files that are scanned concurrently when
+            extracting the openPMD parameters of the series.
+            (Scanning concurrently can be much faster on parallel
+            filesystems, for series with many iterations.)
+            This is also the maximal number of files that are read
+            concurrently, when an iteration is split across several files
+            (these reads use threads, which only overlap the work that is
+            done outside of HDF5, see `pool_map`).
+
+        pool_type : string, optional
+            Only used when n_workers is larger than 1
+            Either 'process' or 'thread', depending on whether the files
+            should be scanned by a pool of processes or of threads
+            (see `scan_openPMD_params`)
+
+        metadata_index : string or None, optional
+            Where to store the index of the openPMD parameters of each file,
+            which avoids scanning the files again when the series is reopened
+            (only the new or modified files are then scanned).
+            Either 'cache' (in the user cache directory), 'sidecar' (as a
+            hidden file in `path_to_dir`) or None (no index is used, and
+            nothing is written to disk when the series is opened)
+
+        check_all_files : bool, optional
+            Whether to scan all the files of the series when opening it
+            (in order to extract their time, and to check that they have
+            the same openPMD parameters as the first file).
+            If False, only the first file is opened: the time of the other
+            files is extracted only when needed (e.g. when requesting an
+            output by its time `t`), and the consistency check can be
+            done by calling `validate()`.
+
+        swmr : bool, optional
+            Whether to open the files in SWMR (single-writer/multiple-reader)
+            mode. This is useful when analyzing a simulation that is still
+            writing its output with SWMR (see also the method `refresh`).
+
+        file_pattern : string, optional
+            The pattern of the names of the files, either with %T standing
+            for the iteration (e.g. 'data%T.h5') or as a regular expression
+            whose first group is the iteration.
+            (see the docstring of `list_h5_files`)
+
+        recursive : bool, optional
+            Whether to also look for files in the subdirectories of
+            `path_to_dir` (e.g. for sharded layouts such as hdf5/000xx/*.h5)
+            The files of different subdirectories are never grouped into
+            one output: when several subdirectories contain the same
+            iteration (e.g. restarted runs), only the first one is used.
+
+        max_open_files : int, optional
+            The maximal number of files that are kept open between two
+            reads, so that they do not need to be opened again at each read
+            (the least recently used files are closed first).
+            The files can be closed explicitly by calling `close()`.
+
+        dtype : a numpy dtype, optional
+            The default type of the fields and particle quantities that
+            are returned (e.g. 'float32' for data that was written in
+            single precision, in which case the unit conversion and
+            the recombination of the modes are also done in single
+            precision, which halves the memory and bandwidth).
+            When None, the data is returned in double precision.
+            This can be overridden by the argument `dtype` of each read.
+
+        particle_cache_size : int, optional
+            The maximal memory (in bytes) used to keep the particle
+            quantities that were read, so that reading them again (e.g.
+            for another plot of the same iteration) does not access the
+            files. The least recently used quantities are removed first,
+            and the quantities of a file are read again when it is
+            modified. The returned arrays are then always read-only
+            (including those that are too large to be kept), unless
+            they are read into buffers (`out`).
+            When 0, the particle quantities are not kept in memory.
+            (see `particle_cache.stats()` for the number of hits/misses)
+
+        field_cache_size : int, optional
+            The maximal memory (in bytes) used to keep the fields that
+            were read, as for `particle_cache_size`. The full 3D fields
+            (`slicing=None`) are then also used for any slice, and in
+            thetaMode, all the modes of a field are read at once, so
+            that they can be recombined for any `m` and `theta`.
+            (see `field_cache.stats()` for the number of hits/misses)
+
+        compressed_cache_size : int, optional
+            The maximal memory (in bytes) used by each of the caches above
+            to keep the data that they evict, in compressed form (with
+            blosc if it is installed, and otherwise with zlib). Decompressing
+            this data is usually much faster than reading it again, and more
+            iterations can be kept in memory this way. When 0, the evicted
+            data is dropped. (The compression ratio and the time spent
+            decompressing are given by `stats()`.)
+
+        cache_backend : string, optional
+            Where the caches above keep the data: either 'memory' (in the
+            memory of this process) or 'shared' (in shared memory segments,
+            which requires Python 3.8 or later). With 'shared', all the
+            processes of the current user that open the same files (e.g.
+            other notebook kernels or worker processes) use the data read
+            by the others, without copying it. `particle_cache_size` and
+            `field_cache_size` are then the budgets for all the processes,
+            and `compressed_cache_size` is not used. The segments are
+            removed when the last process that uses them exits.
+
+        verbose : bool, optional
+            Whether to print the time spent listing and scanning the files
         """
+        # Register the options that are used when listing
+        # and scanning the files
+        self._check_pool_options( n_workers, pool_type )
+        if metadata_index not in [ None, 'cache', 'sidecar' ]:
+            raise OpenPMDException( "Invalid metadata_index: %s (should be "
+                "either 'cache', 'sidecar' or None)" %metadata_index )
+        self.path_to_dir = path_to_dir
+        self.file_pattern = file_pattern
+        self.recursive = recursive
+        self.n_workers = n_workers
+        self.pool_type = pool_type
+        self.swmr = swmr
+        self.dtype = dtype
+        # Pool of open files, shared by all the readers
+        self.file_pool = FilePool( max_open_files, swmr, n_workers )
+        # Caches of the particle quantities and of the fields that were read
+        # (in this process, with a compressed tier for the data that they
+        # evict, or in shared memory)
+        if cache_backend == 'memory':
+            self.particle_cache = ArrayCache( particle_cache_size,
+                                              compressed_cache_size )
+            self.field_cache = ArrayCache( field_cache_size,
+                                           compressed_cache_size )
+        elif cache_backend == 'shared':
+            self.particle_cache = SharedArrayCache( particle_cache_size,
+                                                    'particles' )
+            self.field_cache = SharedArrayCache( field_cache_size, 'fields' )
+        else:
+            raise OpenPMDException( "Invalid cache backend: %s (should be "
+                "either 'memory' or 'shared')" %cache_backend )
+        # When path_to_dir is a file, all the iterations are in this file
+        self.group_based = os.path.isfile( path_to_dir )
+
         # Extract the files and the iterations
-        self.h5_files, self.iterations = list_h5_files( path_to_dir )
+        self.h5_files, self.iterations = self._list_outputs( verbose )
+        self._index = IterationIndex( self.iterations )
 
         # Check that there are HDF5 files in this directory
         if len(self.h5_files) == 0:
@@ -66,14 +260,31 @@ class OpenPMDTimeSeries(parent_class) :
                 "Please check that this is the path to the HDF5 files.")
             return(None)
 
+        # (The metadata index is not used for groupBased series, since
+        # their parameters are all extracted with a single open)
+        if (metadata_index is not None) and (not self.group_based):
+            self.metadata_index = MetadataIndex( path_to_dir, metadata_index )
+        else:
+            self.metadata_index = None
+
         # Go through the files of the series, extract the time
         # and a few parameters.
+        # (The times that are not known yet are stored as NaN)
         N_files = len(self.h5_files)
-        self.t = np.zeros( N_files )
+        self._t = np.empty( N_files )
+        self._t[:] = np.nan
+        start_time = time.time()
+        if check_all_files:
+            scanned_params = self._scan_params( range(N_files) )
+        else:
+            scanned_params = self._scan_params( [0] )
+        if verbose:
+            print('Extracted the openPMD parameters of %d files in %.3f s' \
+                %(len(scanned_params), time.time() - start_time) )
 
         # - Extract parameters from the first file
-        t, params0 = read_openPMD_params( self.h5_files[0] )
-        self.t[0] = t
+        t, params0 = scanned_params[0]
+        self._params0 = params0
         self.avail_fields = params0['avail_fields']
         self.extension = params0['extension']
         if self.avail_fields is not None:
@@ -84,27 +295,279 @@ class OpenPMDTimeSeries(parent_class) :
             self.avail_ptcl_quantities = params0['avail_ptcl_quantities']
 
         # - Check that the other files have the same parameters
-        for k in range( 1, N_files ):
-            t, params = read_openPMD_params( self.h5_files[k] )
-            self.t[k] = t
-            for key in params0.keys():
-                if params != params0:
-                    print("Warning: File %s has different openPMD parameters "
-                        "than the rest of the time series." %self.h5_files[k])
+        if check_all_files:
+            self._check_params( scanned_params )
 
         # - Set the current iteration and time
         self.current_i = 0
-        self.current_t = self.t[0]
-        # - Find the min and the max of the time
-        self.tmin = self.t.min()
-        self.tmax = self.t.max()
+        self.current_t = self._t[0]
 
         # - Initialize a plotter object, which holds information about the time
-        self.plotter = Plotter( self.t, self.iterations )
+        # (The plotter shares the array self._t, which is filled in place)
+        self.plotter = Plotter( self._t, self.iterations )
+        # - Functions to be called when new outputs are found by `refresh`
+        # (e.g. to extend the range of the slider)
+        self._refresh_callbacks = []
+
+    @property
+    def t( self ):
+        """
+        Array of the time (in seconds) of each iteration of the series
+        (When the series was opened with `check_all_files=False`,
+        the times are extracted from the files when first accessed.)
+        """
+        if np.isnan( self._t ).any():
+            self._scan_params( np.flatnonzero( np.isnan(self._t) ) )
+        return( self._t )
+
+    @property
+    def tmin( self ):
+        "Time (in seconds) of the first output of the series"
+        return( self._time_index().sorted_t[0] )
+
+    @property
+    def tmax( self ):
+        "Time (in seconds) of the last output of the series"
+        return( self._time_index().sorted_t[-1] )
+
+    def _time_index( self ):
+        """
+        Return the index of the iterations, after making sure that
+        the index of their times is built
+        """
+        if not self._index.has_times():
+            self._index.set_times( self.t )
+        return( self._index )
+
+    def iterations_between( self, t0=None, t1=None, stride=1 ):
+        """
+        Return the iterations whose time is between `t0` and `t1`
+        (included), sorted by time, keeping one iteration every `stride`
+
+        Parameters
+        ----------
+        t0, t1 : floats (in seconds), optional
+            The bounds of the time range
+            (By default, the range starts at tmin and ends at tmax.)
+
+        stride : int, optional
+            Keep one iteration every `stride` iterations
+            (e.g. stride=10 to select a tenth of the iterations of the range)
+
+        Returns
+        -------
+        A 1darray of ints
+        """
+        if stride < 1:
+            raise OpenPMDException("`stride` should be a positive integer.")
+        index = self._time_index()
+        return( index.iterations[ index.select_time_range(t0, t1, stride) ] )
+
+    def validate( self ):
+        """
+        Check that all the files of the series have the same openPMD
+        parameters (geometry, fields, species, etc.) as the first file,
+        and print a warning for each file that does not.
+
+        (This check is done by the constructor by default, but is skipped
+        when the series is opened with `check_all_files=False`.)
+
+        Returns
+        -------
+        A boolean indicating whether all the files are consistent
+        """
+        scanned_params = self._scan_params( range(len(self.h5_files)) )
+        return( self._check_params( scanned_params ) )
+
+    def _check_params( self, scanned_params ):
+        """
+        Print a warning for each file whose parameters differ
+        from those of the first file
+
+        Parameter
+        ---------
+        scanned_params : list of tuples (t, params)
+            The output of `_scan_params` for all the files of the series
+
+        Returns
+        -------
+        A boolean indicating whether all the files are consistent
+        """
+        consistent = True
+        for k in range( 1, len(scanned_params) ):
+            _, params = scanned_params[k]
+            if params != self._params0:
+                consistent = False
+                print("Warning: File %s has different openPMD parameters "
+                    "than the rest of the time series."
+                    %first_file( self.h5_files[k] ) )
+        return( consistent )
+
+    def refresh( self ):
+        """
+        Look for new files in the directory of the series (e.g. when the
+        simulation is still running) and add them to the series.
+
+        Only the files that are not yet part of the series are opened.
+        Files that cannot be read yet (e.g. because they are still being
+        written) are skipped, and are considered again at the next call.
+        If a slider is displayed, its range is extended accordingly.
+
+        Returns
+        -------
+        The number of outputs that were added to the series
+        """
+        # Close the files that are kept open (since they may have been
+        # modified), and list the files of the series again
+        self.file_pool.close()
+        h5_files, iterations = self._list_outputs()
+        # Update the files of the known iterations (e.g. when new files
+        # were written for an iteration split across several files)
+        files_of_iteration = dict( zip( iterations, h5_files ) )
+        for i, iteration in enumerate( self.iterations ):
+            if iteration in files_of_iteration:
+                self.h5_files[i] = files_of_iteration[iteration]
+        # Find the iterations that are not yet part of the series
+        known_iterations = set( self.iterations )
+        new_outputs = [ (iteration, filename) for (iteration, filename) \
+                        in zip( iterations, h5_files ) \
+                        if iteration not in known_iterations ]
+        if len(new_outputs) == 0:
+            return( 0 )
+
+        # Extract their time and check their parameters
+        scanned_params = self._scan_files(
+            [ first_file(filename) for (_, filename) in new_outputs ],
+            [ iteration for (iteration, _) in new_outputs ],
+            skip_errors=True )
+        added_outputs = []
+        for (iteration, filename), result in zip(new_outputs, scanned_params):
+            if result is None:
+                continue
+            t, params = result
+            if params != self._params0:
+                print("Warning: File %s has different openPMD parameters "
+                    "than the rest of the time series." %first_file(filename))
+            added_outputs.append( (iteration, filename, t) )
+        if len(added_outputs) == 0:
+            return( 0 )
+
+        # Merge them with the existing outputs (sorted by iteration),
+        # and keep the cursor on the same iteration
+        current_iteration = self.iterations[ self.current_i ]
+        outputs = list( zip( self.iterations, self.h5_files, self._t ) )
+        outputs = sorted( outputs + added_outputs, key=lambda x: x[0] )
+        self.iterations = [ iteration for (iteration, _, _) in outputs ]
+        self.h5_files = [ filename for (_, filename, _) in outputs ]
+        self._t = np.array([ t for (_, _, t) in outputs ])
+        self._index = IterationIndex( self.iterations )
+        self.current_i = self._index.find_iteration( current_iteration )
+        self.plotter.t = self._t
+        self.plotter.iterations = self.iterations
+
+        for callback in self._refresh_callbacks:
+            callback()
+        return( len(added_outputs) )
+
+    def close( self ):
+        """
+        Close the files of the series that are kept open
+        (They are reopened automatically by the next read.)
+        """
+        self.file_pool.close()
+
+    def _list_outputs( self, verbose=False ):
+        """
+        List the outputs of the series
+
+        Parameter
+        ---------
+        verbose : bool, optional
+            Whether to print the time spent listing the files
+
+        Returns
+        -------
+        A tuple with:
+        - a list with the file(s) of each iteration (see `h5_files`)
+        - a list of integers which correspond to each iteration
+        """
+        if self.group_based:
+            # All the iterations are in the same file
+            iterations = list_file_iterations( self.path_to_dir, self.swmr )
+            filename = os.path.abspath( self.path_to_dir )
+            return( [ filename ] * len(iterations), iterations )
+        else:
+            # (When an iteration is split across several files, e.g. one
+            # file per MPI rank, the corresponding element of h5_files
+            # is the list of these files)
+            filenames, iterations = list_h5_files( self.path_to_dir,
+                self.file_pattern, self.recursive, verbose )
+            return( group_files_by_iteration( filenames, iterations,
+                                              self.file_pattern ) )
+
+    def _scan_params( self, indices ):
+        """
+        Extract the time and the openPMD parameters of the files
+        whose indices are given, and register their time in self._t
+
+        Parameter
+        ---------
+        indices : list of ints
+            The indices of the files (within self.h5_files) to be scanned
+
+        Returns
+        -------
+        A list of tuples (t, params), one per element of `indices`
+        """
+        indices = list( indices )
+        # Only remove the obsolete entries of the metadata index
+        # when scanning the full series
+        scanned_params = self._scan_files(
+            [ first_file( self.h5_files[k] ) for k in indices ],
+            [ self.iterations[k] for k in indices ],
+            prune=(len(indices) == len(self.h5_files)) )
+        for k, (t, params) in zip( indices, scanned_params ):
+            self._t[k] = t
+        return( scanned_params )
+
+    def _scan_files( self, filenames, iterations,
+                     prune=False, skip_errors=False ):
+        """
+        Extract the time and the openPMD parameters of the given files,
+        using the metadata index when available
+
+        Parameters
+        ----------
+        filenames : list of strings
+            The absolute paths of the files to be scanned
+
+        iterations : list of ints
+            The iteration of each file
+
+        prune, skip_errors : bool, optional
+            See the docstring of `MetadataIndex.scan`
+
+        Returns
+        -------
+        A list of tuples (t, params), one per element of `filenames`
+        (or None for the files that cannot be read, if skip_errors is True)
+        """
+        if self.group_based:
+            # Open the file only once, for all the requested iterations
+            return( read_group_based_params( filenames[0], iterations,
+                swmr=self.swmr, skip_errors=skip_errors ) )
+        elif self.metadata_index is not None:
+            return( self.metadata_index.scan( filenames, iterations,
+                n_workers=self.n_workers, pool_type=self.pool_type,
+                swmr=self.swmr, skip_errors=skip_errors, prune=prune ) )
+        else:
+            return( scan_openPMD_params( filenames,
+                n_workers=self.n_workers, pool_type=self.pool_type,
+                swmr=self.swmr, skip_errors=skip_errors ) )
 
     def get_particle( self, var_list=None, species=None, t=None,
             iteration=None, select=None, output=True,
-            plot=False, nbins=150, **kw ) :
+            plot=False, nbins=150, dtype=None, out=None, **kw ) :
         """
         Extract a list of particle variables
         from an HDF5 file in the OpenPMD format.
@@ -151,105 +614,119 @@ class OpenPMDTimeSeries(parent_class) :
         nbins : int, optional
            Number of bins for the histograms
 
+        dtype : a numpy dtype, optional
+           The type of the returned data (e.g. 'float32')
+           When None, the `dtype` of the time series is used
+           (see the docstring of the constructor).
+
+        out : list of 1darrays, optional
+           Buffers in which the particle variables are written (one per
+           element of `var_list`, or None for the variables that should be
+           returned in new arrays). Each buffer should have at least as many
+           elements as the particles of the species, and the returned arrays
+           are views of its first elements. The data is read directly into
+           the buffers and converted in place, so that loops over many
+           iterations that reuse the same buffers do not allocate
+           large arrays.
+
         **kw : dict, otional
            Additional options to be passed to matplotlib's
-           hist or hist2d.
+           hist (one quantity) or hist2d (two quantities).
+           (The option `range` sets the range of the bins.)
+
+        When `output` is False and the range of the bins is known
+        without reading the particles (i.e. given by the option `range`,
+        or obtained from the zone maps, see `build_zone_maps`, or from
+        the region of the particle patches, for the positions), the
+        particles are not kept in memory: the histogram is accumulated
+        while the particles are read block by block (see `iter_particles`).
+        (When the particle cache is enabled, the particles are read at once
+        instead, so that they are stored in the cache.)
 
         Returns
         -------
         A list of 1darray corresponding to the data requested in `var_list`
         (one 1darray per element of 'var_list', returned in the same order)
+        The quantities that are constant openPMD records (e.g. 'charge'
+        and 'mass', usually) are returned as read-only arrays that do not
+        allocate memory (see `get_constant_data`).
+        When the particle cache is enabled (see `particle_cache_size` in
+        the docstring of the constructor), all the returned arrays are
+        read-only (whether or not they fit in the cache), except when they
+        are read into buffers (`out`): use `np.copy` to modify them.
         """
-        # Check that the species and quantity required are present
-        if self.avail_species is None:
-            raise OpenPMDException('No particle data in this time series')
-        if (species in self.avail_species)==False:
-            species_list = '\n - '.join( self.avail_species )
-            raise OpenPMDException(
-                "The argument `species` is missing or erroneous.\n"
-                "The available species are: \n - %s\nPlease set the "
-                "argument `species` accordingly." %species_list)
-
-        # Check the list of variables
-        valid_var_list = True
-        if type(var_list) != list:
-            valid_var_list = False
-        else:
-            for quantity in var_list:
-                if (quantity in self.avail_ptcl_quantities) == False:
-                    valid_var_list = False
-        if valid_var_list == False:
-            quantity_list = '\n - '.join( self.avail_ptcl_quantities )
-            raise OpenPMDException(
-                "The argument `var_list` is missing or erroneous.\n"
-                "It should be a list of strings representing particle "
-                "quantities.\n The available quantities are: "
-                "\n - %s\nPlease set the argument `var_list` "
-                "accordingly." %quantity_list )
-
-        # Check the selection quantities
-        if select is not None:
-            valid_select_list = True
-            if type(select) != dict:
-                valid_select_list = False
-            else:
-                for quantity in select.keys():
-                    if (quantity in self.avail_ptcl_quantities) == False:
-                        valid_select_list = False
-            if valid_select_list == False:
-                quantity_list = '\n - '.join( self.avail_ptcl_quantities )
-                raise OpenPMDException(
-                    "The argument `select` is erroneous.\n"
-                    "It should be a dictionary whose keys represent particle "
-                    "quantities.\n The available quantities are: "
-                    "\n - %s\nPlease set the argument `select` "
-                    "accordingly." %quantity_list )
+        # Check the arguments
+        self._check_particle_args( var_list, species, select )
+        self._check_buffers( out, var_list )
 
         # Find the output that corresponds to the requested time/iteration
         # (Modifies self.current_i and self.current_t)
         self._find_output( t, iteration )
-        # Get the corresponding filename
-        filename = self.h5_files[ self.current_i ]
 
         # Extract the list of particle quantities
-        data_list = []
-        for quantity in var_list:
-            data_list.append(read_particle( filename, species, quantity ))
-        # Apply selection if needed
-        if select is not None:
-            data_list = apply_selection( data_list, select, species, filename )
+        # (When plotting, the weights are extracted in the same pass,
+        # if they are available)
+        read_weights = plot and ('w' in self.avail_ptcl_quantities)
+        if read_weights:
+            read_list = var_list + ['w']
+            if out is not None:
+                out = out + [ None ]
+        else:
+            read_list = var_list
+        if output:
+            data_list = self._read_particle_data( self.current_i,
+                                read_list, species, select, dtype, out )
 
         # Plotting
-        if plot :
-
-            # Extract the weights, if they are available
-            if 'w' in self.avail_ptcl_quantities:
-                w = read_particle( filename, species, 'w' )
-                if select is not None:
-                    w, = apply_selection( [w], select, species, filename )
-            # Otherwise consider that all particles have a weight of 1
+        if plot and (len(var_list) in [1, 2]):
+            # Get the blocks of particles to be histogrammed, in a single
+            # pass over the data: when the particles are not returned and
+            # the range of the bins is known beforehand, the particles are
+            # read block by block, so that they never need to fit in
+            # memory. Otherwise (or when the particle cache is enabled, so
+            # that plotting the same output again does not read the files),
+            # they are read at once (or the particles that were already
+            # extracted are used), and the range of the bins is by default
+            # the range of the particles.
+            ranges = self._get_bin_ranges( self.current_i, var_list,
+                                species, select, kw.pop( 'range', None ) )
+            if output or (None in ranges) or self.particle_cache.enabled:
+                if not output:
+                    data_list = self._read_particle_data( self.current_i,
+                                        read_list, species, select, dtype )
+                blocks = [ data_list ]
+                ranges = [ value_range if value_range is not None \
+                           else data_range for (value_range, data_range) \
+                           in zip( ranges, get_block_ranges( blocks,
+                                                        len(var_list) ) ) ]
             else:
-                w = np.ones_like( data_list[0] )
+                blocks = iter_particles( self.h5_files[self.current_i],
+                    species, read_list, default_chunk_size, self.file_pool,
+                    self.iterations[self.current_i], select,
+                    self._get_dtype( dtype ) )
+            hist, edges = accumulate_histogram( blocks, ranges,
+                                                nbins, read_weights )
 
             # - In the case of only one quantity
-            if len(data_list) == 1:
+            if len(var_list) == 1:
                 # Do the plotting
-                self.plotter.hist1d( data_list[0], w, var_list[0], species,
-                                     self.current_i, nbins, **kw )
+                self.plotter.hist1d( hist, edges, var_list[0], species,
+                                     self.current_i, **kw )
             # - In the case of two quantities
-            elif len(data_list) == 2:
+            elif len(var_list) == 2:
                 # Do the plotting
-                self.plotter.hist2d( data_list[0], data_list[1], w,
-                                     var_list[0], var_list[1], species,
-                                     self.current_i, nbins, **kw )
+                self.plotter.hist2d( hist, edges, var_list[0], var_list[1],
+                                     species, self.current_i, **kw )
         # Output
         if output :
+            if read_weights:
+                data_list.pop()
             return( data_list )
 
 
     def get_field(self, field=None, coord=None, t=None, iteration=None,
                   m='all', theta=0., slicing=0., slicing_dir='y',
-                  output=True, plot=False, **kw ) :
+                  output=True, plot=False, dtype=None, out=None, **kw ) :
         """
         Extract a given field from an HDF5 file in the OpenPMD format.
 
@@ -302,6 +779,19 @@ class OpenPMDTimeSeries(parent_class) :
         plot : bool, optional
            Whether to plot the requested quantity
 
+        dtype : a numpy dtype, optional
+           The type of the returned field (e.g. 'float32')
+           When None, the `dtype` of the time series is used
+           (see the docstring of the constructor).
+
+        out : an np.ndarray, optional
+           A buffer in which the field is written, instead of a new array.
+           It should have the shape of the returned field, and its type
+           is used instead of `dtype`. The data is read directly into it
+           whenever possible and converted in place, so that loops over
+           many iterations that reuse the same buffer do not allocate
+           large arrays.
+
         **kw : dict, otional
            Additional options to be passed to matplotlib's imshow.
 
@@ -311,6 +801,440 @@ class OpenPMDTimeSeries(parent_class) :
            F : a 2darray containing the required field
            info : a FieldMetaInformation object
            (see the corresponding docstring)
+        When the field cache is enabled (see `field_cache_size` in the
+        docstring of the constructor), F is read-only (whether or not it
+        fits in the cache), except when it is read into a buffer (`out`):
+        use `np.copy` to modify it.
+        """
+        # Check the arguments
+        self._check_field_args( field, coord, m )
+
+        # Find the output that corresponds to the requested time/iteration
+        # (Modifies self.current_i and self.current_t)
+        self._find_output( t, iteration )
+
+        # Get the field data
+        F, info = self._read_field_data( self.current_i, field, coord, m,
+                                theta, slicing, slicing_dir, dtype, out )
+        if self.avail_fields[field] == 'scalar':
+            field_label = field
+        else:
+            field_label = field + coord
+
+        # Plot the resulting field
+        # Deactivate plotting when there is no slice selection
+        if (self.geometry=="3dcartesian") and (slicing is None):
+            plot = False
+        if plot==True:
+            self.plotter.show_field( F, info, slicing_dir, m,
+                        field_label, self.geometry, self.current_i, **kw )
+
+        # Return the result
+        return( F, info )
+
+
+    def get_particle_at( self, iteration, var_list, species, select=None,
+                         dtype=None, out=None ):
+        """
+        Extract a list of particle variables at a given iteration,
+        without modifying the current iteration of the time series
+        (i.e. `current_i` and `current_t`).
+
+        Unlike `get_particle`, this method does not plot and does not
+        modify the state of the time series. It can thus be called
+        concurrently, e.g. from several threads that read different
+        iterations (as long as `refresh` is not called at the same time).
+
+        Parameters
+        ----------
+        iteration : int
+            The iteration at which to obtain the data
+
+        var_list, species, select, dtype, out :
+            See the docstring of `get_particle`
+
+        Returns
+        -------
+        A list of 1darray corresponding to the data requested in `var_list`
+        (one 1darray per element of 'var_list', returned in the same order)
+        """
+        self._check_particle_args( var_list, species, select )
+        self._check_buffers( out, var_list )
+        return( self._read_particle_data( self._find_iteration( iteration ),
+                            var_list, species, select, dtype, out ) )
+
+    def get_field_at( self, iteration, field, coord=None, m='all',
+                      theta=0., slicing=0., slicing_dir='y', dtype=None,
+                      out=None ):
+        """
+        Extract a given field at a given iteration, without modifying
+        the current iteration of the time series (i.e. `current_i` and
+        `current_t`).
+
+        Unlike `get_field`, this method does not plot and does not
+        modify the state of the time series. It can thus be called
+        concurrently, e.g. from several threads that read different
+        iterations (as long as `refresh` is not called at the same time).
+
+        Parameters
+        ----------
+        iteration : int
+            The iteration at which to obtain the data
+
+        field, coord, m, theta, slicing, slicing_dir, dtype, out :
+            See the docstring of `get_field`
+
+        Returns
+        -------
+        A tuple with
+           F : a 2darray containing the required field
+           info : a FieldMetaInformation object
+           (see the corresponding docstring)
+        """
+        self._check_field_args( field, coord, m )
+        return( self._read_field_data( self._find_iteration( iteration ),
+                field, coord, m, theta, slicing, slicing_dir, dtype, out ) )
+
+    def iter_particles( self, var_list, species, iteration,
+                        chunk_size=default_chunk_size, select=None,
+                        dtype=None, out=None ):
+        """
+        Iterate over the particles of a species at a given iteration,
+        by blocks of `chunk_size` particles
+
+        Only one block is read and kept in memory at a time, so that
+        species that do not fit in memory can be processed (e.g. summed
+        or histogrammed block by block).
+
+        Parameters
+        ----------
+        var_list : list of string
+            A list of the particle variables to extract
+            (see the docstring of `get_particle`)
+
+        species : string
+            The name of the species
+
+        iteration : int
+            The iteration at which to obtain the data
+
+        chunk_size : int, optional
+            The number of particles of each block (before selection)
+
+        select : dict, optional
+            A dictionary of rules to select the particles, which is
+            applied to each block (see the docstring of `get_particle`)
+
+        dtype : a numpy dtype, optional
+            The type of the returned data (see the docstring of
+            `get_particle`)
+
+        out : list of 1darrays, optional
+            Buffers in which the particle variables of each block are
+            written (see the docstring of `get_particle`; here, each buffer
+            should have at least `chunk_size` elements). The arrays of
+            a block are then overwritten by the next block.
+
+        Yields
+        ------
+        For each block, a list of 1darrays (one per element of `var_list`)
+        with the selected particles of the block, in the units of
+        `get_particle`
+        """
+        self._check_particle_args( var_list, species, select )
+        self._check_buffers( out, var_list )
+        if chunk_size < 1:
+            raise OpenPMDException(
+                "`chunk_size` should be a positive integer.")
+        i = self._find_iteration( iteration )
+        return( iter_particles( self.h5_files[i], species, var_list,
+                    chunk_size, self.file_pool, self.iterations[i], select,
+                    self._get_dtype( dtype ), out ) )
+
+    def build_sorted_index( self, species, key, iterations=None,
+                            n_workers=None, pool_type=None,
+                            bin_size=default_bin_size ):
+        """
+        Write a sorted index of the particles of a species along the
+        quantity `key`, for each file of the series (as a hidden file
+        next to it).
+
+        Once the index is written, a selection on `key` in `get_particle`
+        (e.g. `select={'uz':[50., None]}`) uses it automatically, so that
+        `key` is not read for all the particles. The data file is not
+        reordered, so the other quantities are read in the blocks of the
+        datasets that contain selected particles (see the docstring of
+        `get_index_candidates`). An index is only used as long as the
+        corresponding file is not modified. (With `iter_particles`, it is
+        only used when the selected range of `key` holds at most
+        `chunk_size` particles, so that the memory remains bounded by
+        the size of the blocks.)
+
+        Parameters
+        ----------
+        species : string
+            The name of the species
+
+        key : string
+            The particle quantity along which the particles are sorted
+            (e.g. 'z' or 'uz')
+
+        iterations : list of ints, optional
+            The iterations for which to write the index
+            (By default, the index is written for all the iterations.)
+
+        n_workers, pool_type : optional
+            The number and type of workers that write the index of
+            different files concurrently (see the docstring of the
+            constructor). By default, the values of the time series are used.
+
+        bin_size : int, optional
+            The number of particles per bin of the index
+        """
+        self._check_particle_args( [ key ], species, None )
+        if n_workers is None:
+            n_workers = self.n_workers
+        if pool_type is None:
+            pool_type = self.pool_type
+        self._check_pool_options( n_workers, pool_type )
+        pool_map( partial( build_sorted_index_file, species=species,
+                           key=key, bin_size=bin_size ),
+                  self._group_by_file( iterations ), n_workers, pool_type )
+
+    def build_zone_maps( self, species, quantities=None, iterations=None,
+                         n_workers=None, pool_type=None ):
+        """
+        Write the zone maps of the particle quantities of a species, i.e.
+        the minimum, maximum and number of particles of each chunk of the
+        records, for each file of the series (as a hidden file next to it).
+
+        Once the zone maps are written, a selection in `get_particle`
+        uses them automatically, so that the chunks that do not contain
+        any selected particle are not read, and `get_particle_range`
+        returns the range of a quantity without reading the particles.
+        A zone map is only used as long as the corresponding file is
+        not modified.
+
+        Parameters
+        ----------
+        species : string
+            The name of the species
+
+        quantities : list of strings, optional
+            The particle quantities for which to write the zone maps
+            (By default, the zone maps are written for all the available
+            quantities of the species.)
+
+        iterations : list of ints, optional
+            The iterations for which to write the zone maps
+            (By default, the zone maps are written for all the iterations.)
+
+        n_workers, pool_type : optional
+            The number and type of workers that write the zone maps of
+            different files concurrently (see the docstring of the
+            constructor). By default, the values of the time series are used.
+        """
+        if quantities is None:
+            quantities = list( self.avail_ptcl_quantities )
+        self._check_particle_args( quantities, species, None )
+        if n_workers is None:
+            n_workers = self.n_workers
+        if pool_type is None:
+            pool_type = self.pool_type
+        self._check_pool_options( n_workers, pool_type )
+        pool_map( partial( build_zone_map_file, species=species,
+                           quantities=quantities ),
+                  self._group_by_file( iterations ), n_workers, pool_type )
+
+    def get_particle_range( self, quantity, species, iteration ):
+        """
+        Return the minimum and maximum of a particle quantity
+
+        When the zone maps of the quantity are up to date (see
+        `build_zone_maps`), the range is obtained from them, without
+        reading the particles. Otherwise, the quantity is read block
+        by block.
+
+        Parameters
+        ----------
+        quantity : string
+            The particle quantity (e.g. 'z' or 'uz')
+
+        species : string
+            The name of the species
+
+        iteration : int
+            The iteration at which to obtain the range
+
+        Returns
+        -------
+        A tuple of two floats (NaN when there are no particles)
+        """
+        self._check_particle_args( [ quantity ], species, None )
+        i = self._find_iteration( iteration )
+        value_range, = self._get_particle_ranges( i, [ quantity ],
+                                                  species, None )
+        return( value_range )
+
+    def _get_particle_ranges( self, i, var_list, species, select,
+                              read_missing=True ):
+        """
+        Return the minimum and maximum of each particle quantity of
+        `var_list`, for the particles of the output `i` that satisfy
+        the selection rules `select`
+
+        Without selection, the ranges are obtained from the zone maps
+        (when they are available for all the files of the output).
+        Otherwise, the particles are read block by block, or (when
+        `read_missing` is False) the range is None.
+
+        Returns
+        -------
+        A list of tuples (min, max), with (nan, nan) when there are
+        no particles
+        """
+        filenames = self.h5_files[i]
+        if not isinstance( filenames, list ):
+            filenames = [ filenames ]
+
+        # Use the zone maps, if possible
+        value_ranges = [ None ] * len(var_list)
+        if not select:
+            for k, quantity in enumerate( var_list ):
+                file_ranges = [ get_zone_map_range( filename,
+                    self.iterations[i], species, quantity ) \
+                    for filename in filenames ]
+                if None not in file_ranges:
+                    mins, maxs = zip( *file_ranges )
+                    if np.all( np.isnan( mins ) ):
+                        value_ranges[k] = ( np.nan, np.nan )
+                    else:
+                        value_ranges[k] = ( np.nanmin( mins ),
+                                            np.nanmax( maxs ) )
+
+        # Otherwise, read the missing quantities block by block
+        missing = [ k for k in range(len(var_list)) \
+                    if value_ranges[k] is None ]
+        if (len(missing) > 0) and read_missing:
+            blocks = iter_particles( self.h5_files[i], species,
+                        [ var_list[k] for k in missing ], default_chunk_size,
+                        self.file_pool, self.iterations[i], select )
+            for k, value_range in zip( missing,
+                                get_block_ranges( blocks, len(missing) ) ):
+                value_ranges[k] = value_range
+
+        return( value_ranges )
+
+    def _get_bin_ranges( self, i, var_list, species, select, hist_range ):
+        """
+        Return the range of the bins of the histograms of `get_particle`,
+        for the output `i`, when it is known without reading the particles
+
+        The range is either given by the user (`hist_range`, as the
+        option `range` of matplotlib's hist or hist2d), or obtained
+        from the zone maps or (for the positions) from the region of the
+        particle patches, when there is no selection.
+
+        Returns
+        -------
+        A list of tuples (min, max), with None for the quantities
+        whose range is unknown
+        """
+        ranges = self._get_particle_ranges( i, var_list, species, select,
+                                            read_missing=False )
+        if not select:
+            for k, quantity in enumerate( var_list ):
+                if (ranges[k] is None) and (quantity in ['x', 'y', 'z']):
+                    ranges[k] = read_patch_range( self.h5_files[i],
+                        species, quantity, self.file_pool,
+                        self.iterations[i] )
+        if hist_range is not None:
+            if len( var_list ) == 1:
+                hist_range = [ hist_range ]
+            for k, user_range in enumerate( hist_range ):
+                if user_range is not None:
+                    ranges[k] = tuple( user_range )
+        return( ranges )
+
+    def _group_by_file( self, iterations=None ):
+        """
+        Return a sorted list of tuples (filename, list of iterations), with
+        the iterations of `iterations` (or all of them, when None) that are
+        stored in each file
+
+        (Each file of an iteration split across several files is listed
+        separately, and all the iterations of a groupBased series are
+        gathered in the same tuple.)
+        """
+        if iterations is None:
+            indices = range( len(self.iterations) )
+        else:
+            indices = [ self._find_iteration( iteration ) \
+                        for iteration in iterations ]
+        file_iterations = {}
+        for i in indices:
+            filenames = self.h5_files[i]
+            if not isinstance( filenames, list ):
+                filenames = [ filenames ]
+            for filename in filenames:
+                file_iterations.setdefault( filename, [] ).append(
+                    self.iterations[i] )
+        return( sorted( file_iterations.items() ) )
+
+    def _check_particle_args( self, var_list, species, select ):
+        """
+        Check that the arguments of `get_particle` correspond to
+        quantities that are available in the time series
+        """
+        # Check that the species and quantity required are present
+        if self.avail_species is None:
+            raise OpenPMDException('No particle data in this time series')
+        if (species in self.avail_species)==False:
+            species_list = '\n - '.join( self.avail_species )
+            raise OpenPMDException(
+                "The argument `species` is missing or erroneous.\n"
+                "The available species are: \n - %s\nPlease set the "
+                "argument `species` accordingly." %species_list)
+
+        # Check the list of variables
+        valid_var_list = True
+        if type(var_list) != list:
+            valid_var_list = False
+        else:
+            for quantity in var_list:
+                if (quantity in self.avail_ptcl_quantities) == False:
+                    valid_var_list = False
+        if valid_var_list == False:
+            quantity_list = '\n - '.join( self.avail_ptcl_quantities )
+            raise OpenPMDException(
+                "The argument `var_list` is missing or erroneous.\n"
+                "It should be a list of strings representing particle "
+                "quantities.\n The available quantities are: "
+                "\n - %s\nPlease set the argument `var_list` "
+                "accordingly." %quantity_list )
+
+        # Check the selection quantities
+        if select is not None:
+            valid_select_list = True
+            if type(select) != dict:
+                valid_select_list = False
+            else:
+                for quantity in select.keys():
+                    if (quantity in self.avail_ptcl_quantities) == False:
+                        valid_select_list = False
+            if valid_select_list == False:
+                quantity_list = '\n - '.join( self.avail_ptcl_quantities )
+                raise OpenPMDException(
+                    "The argument `select` is erroneous.\n"
+                    "It should be a dictionary whose keys represent particle "
+                    "quantities.\n The available quantities are: "
+                    "\n - %s\nPlease set the argument `select` "
+                    "accordingly." %quantity_list )
+
+    def _check_field_args( self, field, coord, m ):
+        """
+        Check that the arguments of `get_field` correspond to
+        a field that is available in the time series
         """
         # Check that the field required is present
         if self.avail_fields is None:
@@ -342,55 +1266,187 @@ class OpenPMDTimeSeries(parent_class) :
                     "The requested mode '%s' is not available.\n"
                     "The available modes are: \n - %s" %(m, mode_list))
 
-        # Find the output that corresponds to the requested time/iteration
-        # (Modifies self.current_i and self.current_t)
-        self._find_output( t, iteration )
-        # Get the corresponding filename
-        filename = self.h5_files[ self.current_i ]
+    def _read_particle_data( self, i, var_list, species, select,
+                             dtype=None, out=None ):
+        """
+        Extract a list of particle variables from the output `i`
+        (This does not modify the state of the time series.)
+
+        Parameters
+        ----------
+        i : int
+            The index of the output (in `self.iterations`)
+
+        var_list, species, select, dtype, out :
+            See the docstring of `get_particle`
+        """
+        filename = self.h5_files[i]
+        iteration = self.iterations[i]
+        dtype = self._get_dtype( dtype )
+
+        # Without cache (or when reading into buffers), extract the list
+        # of particle quantities (in one pass, and only for the selected
+        # particles, if a selection is given)
+        if (not self.particle_cache.enabled) or (out is not None):
+            return( read_particles( filename, species, var_list,
+                        self.file_pool, iteration, select, dtype, out ) )
+
+        # Otherwise, read only the quantities that are not in the cache
+        # (The stamps of the files are obtained before reading, so that
+        # the data of a file modified in the meantime is not used later.)
+        stamps = get_file_stamps( filename )
+        if dtype is not None:
+            dtype = np.dtype( dtype )
+        keys = [ ( get_file_key( filename ), iteration, species, quantity,
+                   dtype, get_selection_key( select ) ) \
+                 for quantity in var_list ]
+        data_list = [ self.particle_cache.get( key, stamps ) \
+                      for key in keys ]
+        missing = [ quantity for quantity, data in \
+                    zip( var_list, data_list ) if data is None ]
+        if len(missing) > 0:
+            missing = list( OrderedDict.fromkeys( missing ) )
+            read_data = dict( zip( missing, read_particles( filename,
+                species, missing, self.file_pool, iteration, select,
+                dtype ) ) )
+            for k, key in enumerate( keys ):
+                if data_list[k] is None:
+                    data_list[k] = read_data[ var_list[k] ]
+                    self.particle_cache.put( key, stamps, data_list[k] )
+        return( data_list )
+
+    def _check_pool_options( self, n_workers, pool_type ):
+        """
+        Check that `n_workers` is a positive integer and that `pool_type`
+        is either 'thread' or 'process' (see the docstring of the
+        constructor)
+        """
+        if (not isinstance( n_workers, (int, np.integer) )) or \
+                isinstance( n_workers, bool ) or (n_workers < 1):
+            raise OpenPMDException(
+                "`n_workers` should be a positive integer." )
+        if pool_type not in ['thread', 'process']:
+            raise OpenPMDException( "Invalid pool_type: %s (should be "
+                "either 'thread' or 'process')" %pool_type )
+
+    def _check_buffers( self, out, var_list ):
+        """
+        Check that `out` is either None or a list of buffers
+        (one per element of `var_list`)
+        """
+        if out is None:
+            return
+        if (type(out) != list) or (len(out) != len(var_list)):
+            raise OpenPMDException(
+                "The argument `out` should be a list with one buffer "
+                "(or None) per element of `var_list`." )
+        for buffer in out:
+            if (buffer is not None) and \
+                    ( (not isinstance( buffer, np.ndarray )) or
+                      (buffer.ndim != 1) ):
+                raise OpenPMDException(
+                    "The buffers of `out` should be 1darrays." )
+
+    def _get_dtype( self, dtype ):
+        """
+        Return the type in which the data is read: `dtype` if it is
+        not None, and otherwise the default type of the time series
+        """
+        if dtype is None:
+            return( self.dtype )
+        else:
+            return( dtype )
+
+    def _read_field_data( self, i, field, coord, m, theta,
+                          slicing, slicing_dir, dtype=None, out=None ):
+        """
+        Extract a given field from the output `i`
+        (This does not modify the state of the time series.)
+
+        Parameters
+        ----------
+        i : int
+            The index of the output (in `self.iterations`)
+
+        field, coord, m, theta, slicing, slicing_dir, dtype, out :
+            See the docstring of `get_field`
+        """
+        filename = self.h5_files[i]
+        iteration = self.iterations[i]
+        dtype = self._get_dtype( dtype )
 
         # Find the proper path for vector or scalar fields
         if self.avail_fields[field] == 'scalar':
             field_path = field
-            field_label = field
         elif self.avail_fields[field] == 'vector':
             field_path = os.path.join( field, coord )
-            field_label = field + coord
 
         # Get the field data
         # - For 2D
         if self.geometry == "2dcartesian":
-            F, info = read_field_2d( filename, field_path )
+            F, info = read_field_2d( filename, field_path,
+                                self.file_pool, iteration, dtype, out,
+                                self.field_cache )
         # - For 3D
         elif self.geometry == "3dcartesian":
-            F, info = read_field_3d(
-                filename, field_path, slicing, slicing_dir)
+            F, info = read_field_3d( filename, field_path, slicing,
+                        slicing_dir, self.file_pool, iteration, dtype, out,
+                        self.field_cache )
         # - For thetaMode
         elif self.geometry == "thetaMode":
             if (coord in ['x', 'y']) and (self.avail_fields[field]=='vector'):
                 # For Cartesian components, combine r and t components
-                Fr, info = read_field_circ( filename, field+'/r', m, theta )
-                Ft, info = read_field_circ( filename, field+'/t', m, theta )
+                Fr, info = read_field_circ( filename, field+'/r', m, theta,
+                                    self.file_pool, iteration, dtype, out,
+                                    self.field_cache )
+                Ft, info = read_field_circ( filename, field+'/t', m, theta,
+                                    self.file_pool, iteration, dtype,
+                                    field_cache=self.field_cache )
+                # (The combination is done in place in Fr. The coefficients
+                # have the type of the data, so that they do not promote it.)
+                cos = Fr.dtype.type( np.cos(theta) )
+                sin = Fr.dtype.type( np.sin(theta) )
                 if coord == 'x':
-                    F = np.cos(theta)*Fr - np.sin(theta)*Ft
+                    Fr *= cos
+                    Ft *= sin
+                    Fr -= Ft
                 elif coord == 'y':
-                    F = np.sin(theta)*Fr + np.cos(theta)*Ft
+                    Fr *= sin
+                    Ft *= cos
+                    Fr += Ft
+                F = Fr
                 # Revert the sign below the axis
-                F[:len(F)/2] *= -1
+                F[:len(F)//2] *= -1
             else:
                 # For cylindrical or scalar components, no special treatment
-                F, info = read_field_circ( filename, field_path, m, theta )
-
-        # Plot the resulting field
-        # Deactivate plotting when there is no slice selection
-        if (self.geometry=="3dcartesian") and (slicing is None):
-            plot = False
-        if plot==True:
-            self.plotter.show_field( F, info, slicing_dir, m,
-                        field_label, self.geometry, self.current_i, **kw )
-
-        # Return the result
+                F, info = read_field_circ( filename, field_path, m, theta,
+                                    self.file_pool, iteration, dtype, out,
+                                    self.field_cache )
+
+        # With the field cache, the fields are always returned read-only
+        # (including those that are computed from the cached data, e.g.
+        # by combining the azimuthal modes), for consistency
+        if self.field_cache.enabled and (out is None):
+            F.flags.writeable = False
         return( F, info )
 
+    def _find_iteration( self, iteration ):
+        """
+        Return the index of `iteration` in the series
+        (This does not modify the state of the time series.)
+
+        Parameter
+        ---------
+        iteration : int
+            Iteration requested
+        """
+        i = self._index.find_iteration( iteration )
+        if i is None:
+            iter_list = '\n - '.join([ str(it) for it in self.iterations])
+            raise OpenPMDException(
+                "The requested iteration '%s' is not available.\nThe "
+                "available iterations are: \n - %s" %(iteration, iter_list))
+        return( i )
 
     def _find_output(self, t, iteration ) :
         """
@@ -421,11 +1477,12 @@ class OpenPMDTimeSeries(parent_class) :
                 print('Reached last iteration')
             # Find the last existing output
             else :
-                self.current_i = self.t[ self.t <= t ].argmax()
+                self.current_i = self._time_index().find_time( t )
         # If an iteration is requested
         elif (iteration is not None):
-            if (iteration in self.iterations):
-                self.current_i = self.iterations.index(iteration)
+            i = self._index.find_iteration( iteration )
+            if i is not None:
+                self.current_i = i
             else:
                 iter_list = '\n - '.join([ str(it) for it in self.iterations])
                 print("The requested iteration '%s' is not available.\nThe "
@@ -436,10 +1493,14 @@ class OpenPMDTimeSeries(parent_class) :
             pass # self.current_i retains its previous value
 
         # Register the value in the object
-        self.current_t = self.t[ self.current_i ]
-
-def list_h5_files( path_to_dir ) :
-    """
+        # (Extract the time of this iteration, if it is not known yet)
+        if np.isnan( self._t[ self.current_i ] ):
+            self._scan_params( [ self.current_i ] )
+        self.current_t = self._t[ self.current_i ]
+
+def list_h5_files( path_to_dir, pattern=None, recursive=False,
+                   verbose=False ) :
+    r"""
     Return a list of the hdf5 files in this directory,
     and a list of the corresponding iterations
 
@@ -448,31 +1509,64 @@ def list_h5_files( path_to_dir ) :
     path_to_dir : string
         The path to the directory where the hdf5 files are.
 
+    pattern : string, optional
+        The pattern of the names of the files. Either a name in which
+        %T stands for the iteration (e.g. 'data%T.h5', as in the openPMD
+        attribute `iterationFormat`, or 'data%T_rank%R.h5' when each MPI
+        rank writes its own file, with %R standing for the rank), or a
+        regular expression whose first group is the iteration
+        (e.g. 'diag_(\d+)\.h5$'), and whose group named `rank`, if any,
+        is the rank (e.g. 'diag_(\d+)_(?P<rank>\d+)\.h5$').
+        The files that do not match the pattern are ignored.
+        If None, all the files that end with the iteration number followed
+        by '.h5' or '.hdf5' are used (with an optional rank suffix, as in
+        data00001000_r0003.h5).
+
+    recursive : bool, optional
+        Whether to also look for files in the subdirectories of
+        `path_to_dir` (e.g. for sharded layouts such as hdf5/000xx/*.h5)
+
+    verbose : bool, optional
+        Whether to print the number of files found and the time
+        that was spent listing them
+
     Returns
     -------
     A tuple with:
     - a list of strings which correspond to the absolute path of each file
     - a list of integers which correspond to the iteration of each file
     """
-    # Find all the files in the provided directory
-    all_files = os.listdir( path_to_dir )
+    start_time = time.time()
+    regex = get_file_regex( pattern )
 
-    # Select the hdf5 files
+    # Go through the provided directory (and its subdirectories if needed)
+    # and select the hdf5 files
     iters_and_names = []
-    for filename in all_files :
-        # Use only the name that end with .h5 or .hdf5
-        if filename[-3:] == '.h5' or filename[-5:] == '.hdf5':
+    n_entries = 0
+    dirs_to_scan = [ os.path.abspath( path_to_dir ) ]
+    while len(dirs_to_scan) > 0:
+        for entry in scandir( dirs_to_scan.pop() ):
+            n_entries += 1
+            if entry.is_dir():
+                if recursive:
+                    dirs_to_scan.append( entry.path )
+                continue
+            filename = entry.name
+            # By default, use only the name that end with .h5 or .hdf5
+            if (pattern is None) and not filename.endswith(('.h5', '.hdf5')):
+                continue
             # Extract the iteration, using regular expressions (regex)
-            regex_match = re.search('(\d+).h[df]*5', filename)
+            regex_match = regex.search( filename )
             if regex_match is None:
-                print('Ill-formated HDF5 file: %s\n File names should end '
-                      'with the iteration number, followed by ".h5"' %filename)
+                if pattern is None:
+                    print('Ill-formated HDF5 file: %s\n File names should '
+                      'end with the iteration number, followed by ".h5"'
+                      %filename)
             else:
-                iteration = int( regex_match.groups()[-1] )
-                full_name = os.path.join(
-                    os.path.abspath( path_to_dir ), filename)
+                iteration = get_iteration( regex_match )
                 # Create list of tuples (which can be sorted together)
-                iters_and_names.append( (iteration, full_name) )
+                # (entry.path is absolute, since the scanned path is)
+                iters_and_names.append( (iteration, entry.path) )
 
     # Sort the list of tuples according to the iteration
     iters_and_names.sort()
@@ -480,54 +1574,193 @@ def list_h5_files( path_to_dir ) :
     filenames = [ name for (it, name) in iters_and_names ]
     iterations = [ it for (it, name) in iters_and_names ]
 
+    if verbose:
+        print('Found %d files (among %d entries) in %.3f s' \
+            %(len(filenames), n_entries, time.time() - start_time) )
+
     return( filenames, iterations )
 
-def apply_selection( data_list, select, species, filename ):
+def get_file_regex( pattern=None ):
+    """
+    Return the compiled regular expression that corresponds to `pattern`
+    (see the docstring of `list_h5_files`)
     """
-    Select the elements of each particle quantities in data_list,
-    based on the selection rules in `select`
+    if pattern is None:
+        return( default_file_regex )
+    else:
+        return( compile_file_pattern( pattern ) )
 
-    Parameters
-    ----------
-    data_list: list of 1darrays
-        A list of arrays with one element per macroparticle, that represent
-        different particle quantities
+def compile_file_pattern( pattern ):
+    """
+    Return the compiled regular expression that corresponds to `pattern`
+    (see the docstring of `list_h5_files`), with the iteration as first group
+    """
+    if '%T' in pattern:
+        # Escape the rest of the name, and match the full name, where
+        # %T is the group `iteration` and %R (the index of the file within
+        # the iteration, e.g. the MPI rank) is the group `rank`
+        # (When they appear several times, they stand for the same number.)
+        regex = ''
+        for part in re.split( '(%T|%R)', pattern ):
+            if part in [ '%T', '%R' ]:
+                name = { '%T': 'iteration', '%R': 'rank' }[ part ]
+                if '(?P<%s>' %name in regex:
+                    regex += '(?P=%s)' %name
+                else:
+                    regex += r'(?P<%s>\d+)' %name
+            else:
+                regex += re.escape( part )
+        return( re.compile( '^' + regex + '$' ) )
+    else:
+        return( re.compile( pattern ) )
 
-    select: dict
-        A dictionary of rules to select the particles
-        'x' : [-4., 10.]   (Particles having x between -4 and 10 microns)
-        'ux' : [-0.1, 0.1] (Particles having ux between -0.1 and 0.1 mc)
-        'uz' : [5., None]  (Particles with uz above 5 mc)
+def get_iteration( regex_match ):
+    """
+    Return the iteration of a file, from the match of its name with
+    the regular expression of `get_file_regex`
+    """
+    if 'iteration' in regex_match.re.groupindex:
+        return( int( regex_match.group('iteration') ) )
+    else:
+        return( int( regex_match.group(1) ) )
 
-    species: string
-       Name of the species being requested
+def get_shard_key( filename, regex ):
+    """
+    Return the path of a file without its rank (the files of an iteration
+    that have the same key are the parts of the same output), or None if
+    the name of the file has no rank (see `get_file_regex`)
+    """
+    name = os.path.basename( filename )
+    regex_match = regex.search( name )
+    if (regex_match is None) or ('rank' not in regex.groupindex) \
+            or (regex_match.group('rank') is None):
+        return( None )
+    start, end = regex_match.span( 'rank' )
+    return( os.path.join( os.path.dirname( filename ),
+                          name[:start] + name[end:] ) )
+
+def group_files_by_iteration( filenames, iterations, pattern=None ):
+    """
+    Group the files that correspond to the same iteration (e.g. when
+    each MPI rank writes its own file, such as data00001000_r0003.h5)
 
-    filename: string
-       Name of the file (i.e. iteration) being requested
+    Only the files of the same directory whose names differ by their rank
+    are grouped. When other files correspond to the same iteration (e.g. a
+    copy of a file, or the output of a restarted simulation in another
+    subdirectory), only the first of these outputs is used, and a warning
+    lists the files that are ignored.
+
+    Parameters
+    ----------
+    filenames, iterations : lists
+        The output of `list_h5_files` (sorted by iteration)
+
+    pattern : string, optional
+        The pattern that was passed to `list_h5_files`
 
     Returns
     -------
-    A list of 1darrays that correspond to data_list, but were only the
-    macroparticles that meet the selection rules are kept
+    A tuple with:
+    - a list with one element per iteration: either a string (when the
+      iteration is in a single file) or a list of strings (when the
+      iteration is split across several files)
+    - a list of integers which correspond to each iteration
+      (without repetition)
+    """
+    regex = get_file_regex( pattern )
+    grouped_files = []
+    grouped_iterations = []
+    for iteration, group in groupby( zip( filenames, iterations ),
+                                     key=lambda item: item[1] ):
+        names = [ name for (name, it) in group ]
+        key = get_shard_key( names[0], regex )
+        if key is None:
+            output = names[:1]
+        else:
+            output = [ name for name in names \
+                       if get_shard_key( name, regex ) == key ]
+        ignored = [ name for name in names if name not in output ]
+        if len( ignored ) > 0:
+            print( "Warning: Several outputs correspond to iteration %d.\n"
+                   "Only %s is used, and the following files are ignored:"
+                   "\n%s\n(Use the argument `file_pattern` to select the "
+                   "files of one output.)" %( iteration,
+                   ', '.join( output ), '\n'.join( ignored ) ) )
+        if len( output ) == 1:
+            grouped_files.append( output[0] )
+        else:
+            grouped_files.append( output )
+        grouped_iterations.append( iteration )
+
+    return( grouped_files, grouped_iterations )
+
+def build_sorted_index_file( task, species, key, bin_size=default_bin_size ):
+    """
+    Write the sorted index of the quantity `key` of a species,
+    for the iterations of a file (see `write_sorted_index`)
+
+    Parameters
+    ----------
+    task : tuple (filename, iterations)
+        The path to the file, and the list of iterations to be indexed
+
+    species, key, bin_size :
+        See the docstring of `OpenPMDTimeSeries.build_sorted_index`
+    """
+    filename, iterations = task
+    stat = os.stat( filename )
+    for iteration in iterations:
+        values, = read_particles( filename, species, [ key ],
+                                  iteration=iteration )
+        write_sorted_index( filename, stat, iteration, species, key,
+                            values, bin_size )
+
+def build_zone_map_file( task, species, quantities ):
+    """
+    Write the zone maps of the particle quantities of a species,
+    for the iterations of a file (see `write_zone_map`)
+
+    Parameters
+    ----------
+    task : tuple (filename, iterations)
+        The path to the file, and the list of iterations to be mapped
+
+    species, quantities :
+        See the docstring of `OpenPMDTimeSeries.build_zone_maps`
+    """
+    filename, iterations = task
+    stat = os.stat( filename )
+    file_pool = FilePool( max_open_files=1 )
+    try:
+        for iteration in iterations:
+            block_sizes = get_block_sizes( filename, species, quantities,
+                                           iteration=iteration )
+            for quantity, block_size in zip( quantities, block_sizes ):
+                # Compute the statistics chunk by chunk (with chunks of
+                # whole blocks, read into the same buffer), so that only
+                # one chunk of one quantity is in memory at a time
+                chunk_size = block_size * \
+                    max( 1, default_chunk_size // block_size )
+                buffer = np.empty( chunk_size )
+                block_stats = [ get_block_stats( values, block_size ) \
+                    for values, in iter_particles( filename, species,
+                        [ quantity ], chunk_size, file_pool, iteration,
+                        out=[ buffer ] ) ]
+                if len( block_stats ) == 0:
+                    block_stats = [ get_block_stats( buffer[:0], block_size ) ]
+                block_stats = [ np.concatenate( stats ) \
+                                for stats in zip( *block_stats ) ]
+                write_zone_map( filename, stat, iteration, species, quantity,
+                                block_stats, block_size )
+    finally:
+        file_pool.close()
+
+def first_file( files ):
+    """
+    Return the first file of an iteration
+    (`files` is an element of the `h5_files` list of a time series)
     """
-    # Create the array that determines whether the particle
-    # should be selected or not.
-    Ntot = len(data_list[0])
-    select_array = np.ones( Ntot, dtype='bool')
-
-    # Loop through the selection rules, and aggregate results in select_array
-    for quantity in select.keys():
-        q = read_particle( filename, species, quantity )
-        # Check lower bound
-        if select[quantity][0] is not None:
-            select_array = np.logical_and(select_array, q>select[quantity][0])
-        # Check upper bound
-        if select[quantity][1] is not None:
-            select_array = np.logical_and(select_array, q<select[quantity][1])
-
-    # Use select_array to reduce each quantity
-    for i in range(len(data_list)):
-        if len(data_list[i]) >1:  # Do not apply selection on scalar records
-            data_list[i] = data_list[i][select_array]
-
-    return(data_list)
+    if isinstance( files, list ):
+        return( files[0] )
+    else:
+        return( files )
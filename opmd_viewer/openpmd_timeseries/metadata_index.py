@@ -0,0 +1,224 @@
+"""
+This file is part of the openPMD viewer.
+
+It defines the MetadataIndex class, which stores the openPMD parameters
+of each file of a time series on disk, so that they do not need to be
+extracted again when the time series is reopened.
+"""
+import os
+import json
+import hashlib
+from .data_reader.params_reader import scan_openPMD_params
+
+# Version of the format of the index files
+# (Index files with a different version are ignored and rewritten)
+INDEX_VERSION = 1
+# Name of the index file, when it is written next to the data
+SIDECAR_NAME = '.opmd_viewer_index.json'
+
+
+class MetadataIndex(object):
+    """
+    Persistent index of the openPMD parameters of the files of a time series
+
+    For each file, the index stores the iteration, the time and the
+    parameters returned by `read_openPMD_params` (geometry, available
+    fields and modes, species and particle quantities), along with the
+    inode, size and modification time of the file. An entry is only reused
+    when these are unchanged (i.e. when the file was neither modified nor
+    replaced on disk).
+    """
+
+    def __init__( self, path_to_dir, location='cache' ):
+        """
+        Initialize the index of the files in `path_to_dir`, and load
+        the existing index file, if any.
+
+        Parameters
+        ----------
+        path_to_dir : string
+            The path to the directory where the openPMD files are
+
+        location : string, optional
+            Either 'sidecar' (the index is written in the directory of
+            the data, as a hidden file) or 'cache' (the index is written
+            in the user cache directory, i.e. $XDG_CACHE_HOME/opmd_viewer
+            or ~/.cache/opmd_viewer)
+        """
+        self.path_to_dir = os.path.abspath( path_to_dir )
+        if location == 'sidecar':
+            self.index_file = os.path.join( self.path_to_dir, SIDECAR_NAME )
+        elif location == 'cache':
+            cache_dir = os.environ.get( 'XDG_CACHE_HOME',
+                            os.path.join( os.path.expanduser('~'), '.cache' ) )
+            dir_hash = hashlib.md5( self.path_to_dir.encode() ).hexdigest()
+            self.index_file = os.path.join( cache_dir, 'opmd_viewer',
+                                            'index_%s.json' %dir_hash )
+        else:
+            # (Deferred import, since the main module imports this one)
+            from .main import OpenPMDException
+            raise OpenPMDException(
+                "Invalid location for the metadata index: %s (should be "
+                "either 'sidecar' or 'cache')" %location )
+
+        # Dictionary of entries, with the path of each file (relative
+        # to path_to_dir) as key
+        self.entries = {}
+        self.modified = False
+        self.load()
+
+    def load( self ):
+        """
+        Read the index file (if it exists and has the proper format)
+        """
+        try:
+            with open( self.index_file ) as f:
+                content = json.load( f )
+        except (IOError, OSError, ValueError):
+            return
+        if content.get( 'version' ) == INDEX_VERSION:
+            self.entries = content['files']
+
+    def save( self ):
+        """
+        Write the index file, if some entries were modified
+
+        The file is first written to a temporary file and then renamed,
+        so that concurrent readers never see a partially written index.
+        If the index cannot be written (e.g. read-only filesystem),
+        it is silently skipped.
+        """
+        if not self.modified:
+            return
+        content = { 'version': INDEX_VERSION, 'files': self.entries }
+        tmp_file = self.index_file + '.%d.tmp' %os.getpid()
+        try:
+            index_dir = os.path.dirname( self.index_file )
+            if not os.path.isdir( index_dir ):
+                os.makedirs( index_dir )
+            with open( tmp_file, 'w' ) as f:
+                json.dump( content, f, default=to_builtin )
+            os.rename( tmp_file, self.index_file )
+            self.modified = False
+        except (IOError, OSError):
+            if os.path.exists( tmp_file ):
+                os.remove( tmp_file )
+
+    def lookup( self, filename ):
+        """
+        Return the tuple (t, params) stored for `filename`, or None if
+        this file is not in the index or was modified since it was indexed
+
+        Parameters
+        ----------
+        filename : string
+            The absolute path of the file
+        """
+        entry = self.entries.get( self._key(filename) )
+        if entry is None:
+            return( None )
+        stat = os.stat( filename )
+        if (entry.get('inode') != stat.st_ino) or \
+            (entry['size'] != stat.st_size) or \
+            (entry['mtime'] != stat.st_mtime):
+            return( None )
+        return( entry['t'], entry['params'] )
+
+    def update( self, filename, iteration, t, params ):
+        """
+        Register the parameters of `filename` in the index
+
+        Parameters
+        ----------
+        filename : string
+            The absolute path of the file
+
+        iteration : int
+            The iteration stored in this file
+
+        t, params : float and dict
+            The output of `read_openPMD_params` for this file
+        """
+        stat = os.stat( filename )
+        # Convert the numpy types (e.g. in the attributes read by h5py),
+        # so that the entry is identical to the one that is reloaded
+        self.entries[ self._key(filename) ] = json.loads( json.dumps(
+            { 'inode': stat.st_ino, 'size': stat.st_size,
+              'mtime': stat.st_mtime,
+              'iteration': iteration, 't': t, 'params': params },
+            default=to_builtin ) )
+        self.modified = True
+
+    def scan( self, filenames, iterations, n_workers=1, pool_type='process',
+              swmr=False, skip_errors=False, prune=True ):
+        """
+        Return the time and openPMD parameters of each file in `filenames`,
+        by reusing the valid entries of the index and by scanning only the
+        files that are new or that were modified.
+        The index file is updated accordingly.
+
+        Parameters
+        ----------
+        filenames : list of strings
+            The absolute paths of the files of the time series
+
+        iterations : list of ints
+            The iteration of each file
+
+        n_workers, pool_type, swmr, skip_errors :
+            See the docstring of `scan_openPMD_params`
+            (The files that cannot be read are not added to the index.)
+
+        prune : bool, optional
+            Whether to remove the entries of the files that are not
+            in `filenames` (should be False when scanning only a
+            subset of the series)
+
+        Returns
+        -------
+        A list of tuples (t, params), in the same order as `filenames`
+        """
+        results = [ self.lookup( filename ) for filename in filenames ]
+
+        # Scan the files that are not in the index (or are outdated)
+        stale = [ k for k in range(len(filenames)) if results[k] is None ]
+        if len(stale) > 0:
+            scanned = scan_openPMD_params( [ filenames[k] for k in stale ],
+                                n_workers=n_workers, pool_type=pool_type,
+                                swmr=swmr, skip_errors=skip_errors )
+            for k, result in zip( stale, scanned ):
+                results[k] = result
+                if result is not None:
+                    t, params = result
+                    self.update( filenames[k], iterations[k], t, params )
+
+        # Remove the entries of the files that are not in the series anymore
+        if prune:
+            keys = set([ self._key(filename) for filename in filenames ])
+            for key in list( self.entries.keys() ):
+                if key not in keys:
+                    del self.entries[key]
+                    self.modified = True
+
+        self.save()
+        return( results )
+
+    def _key( self, filename ):
+        """
+        Return the key of `filename` in the index (i.e. the path relative
+        to the directory of the series, so that the index remains valid
+        when the whole directory is moved)
+        """
+        return( os.path.relpath( filename, self.path_to_dir ) )
+
+
+def to_builtin( obj ):
+    """
+    Convert the numpy types (which are not JSON-serializable)
+    to the corresponding Python types
+    """
+    if hasattr( obj, 'tolist' ):
+        return( obj.tolist() )
+    if isinstance( obj, bytes ):
+        return( obj.decode() )
+    raise TypeError( "%r is not JSON-serializable" %obj )
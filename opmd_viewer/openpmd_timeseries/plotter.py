@@ -4,6 +4,7 @@ This file is part of the OpenPMD viewer.
 It defines a set of methods which are useful for plotting
 (and labeling the plots).
 """
+import numpy as np
 import matplotlib.pyplot as plt
 
 class Plotter(object):
@@ -33,21 +34,20 @@ class Plotter(object):
         self.iterations = iterations
 
 
-    def hist1d( self, q1, w, quantity1, species, current_i, nbins,
+    def hist1d( self, hist, edges, quantity1, species, current_i,
                 cmap='Blues', vmin=None, vmax=None, **kw ):
         """
-        Plot a 1D histogram of the particle quantity q1
+        Plot a 1D histogram of a particle quantity
         Sets the proper labels
 
         Parameters
         ----------
-        q1: 1darray of floats
-            An array with one element per macroparticle, representing
-            the quantity to be plotted.
+        hist: 1darray of floats
+            The (weighted) number of particles in each bin
+            (see `accumulate_histogram`)
 
-        w: 1darray of floats
-            An array with one element per macroparticle, representing
-            the number of real particles that correspond to each macroparticle
+        edges: list of one 1darray
+            The edges of the bins
 
         quantity1: string
             The name of the quantity to be plotted (for labeling purposes)
@@ -58,9 +58,6 @@ class Plotter(object):
         current_i: int
             The index of this iteration, within the iterations list
 
-        nbins : int, optional
-           Number of bins for the histograms
-
         **kw : dict, otional
            Additional options to be passed to matplotlib's hist
         """
@@ -69,27 +66,31 @@ class Plotter(object):
         time_fs = 1.e15*self.t[ current_i ]
 
         # Do the plot
-        plt.hist(q1, bins=nbins, weights=w, **kw )
+        # (Pass one point per bin to matplotlib's hist, at the center of
+        # the bin and weighted by its content, so that all the options of
+        # hist, e.g. `histtype` or `density`, apply to the histogram)
+        centers = 0.5*( edges[0][1:] + edges[0][:-1] )
+        plt.hist( centers, bins=edges[0], weights=hist, **kw )
         plt.xlabel(quantity1, fontsize=self.fontsize)
         plt.title("%s:   t =  %.0f fs    (iteration %d)" \
                 %(species, time_fs, iteration), fontsize=self.fontsize )
 
 
-    def hist2d( self, q1, q2, w, quantity1, quantity2, species, current_i,
-                nbins, cmap='Blues', vmin=None, vmax=None, **kw ):
+    def hist2d( self, hist, edges, quantity1, quantity2, species, current_i,
+                cmap='Blues', vmin=None, vmax=None, **kw ):
         """
-        Plot a 2D histogram of the particle quantity q1
+        Plot a 2D histogram of two particle quantities
         Sets the proper labels
 
         Parameters
         ----------
-        q1: 1darray of floats
-            An array with one element per macroparticle, representing
-            the quantity to be plotted.
+        hist: 2darray of floats
+            The (weighted) number of particles in each bin, with the bins
+            of the first quantity along the first axis
+            (see `accumulate_histogram`)
 
-        w: 1darray of floats
-            An array with one element per macroparticle, representing
-            the number of real particles that correspond to each macroparticle
+        edges: list of two 1darrays
+            The edges of the bins, for each quantity
 
         quantity1, quantity2: strings
             The name of the quantity to be plotted (for labeling purposes)
@@ -100,19 +101,19 @@ class Plotter(object):
         current_i: int
             The index of this iteration, within the iterations list
 
-        nbins : int, optional
-           Number of bins for the histograms
-
         **kw : dict, otional
-           Additional options to be passed to matplotlib's hist
+           Additional options to be passed to matplotlib's hist2d
         """
         # Find the iteration and time
         iteration = self.iterations[ current_i ]
         time_fs = 1.e15*self.t[ current_i ]
 
         # Do the plot
-        plt.hist2d(q1, q2, bins=nbins, cmap=cmap,
-                    vmin=vmin, vmax=vmax, weights=w, **kw )
+        # (One point per bin, weighted by its content, as in hist1d)
+        centers = [ 0.5*( e[1:] + e[:-1] ) for e in edges ]
+        q1, q2 = np.meshgrid( centers[0], centers[1], indexing='ij' )
+        plt.hist2d( q1.ravel(), q2.ravel(), bins=edges, cmap=cmap,
+            vmin=vmin, vmax=vmax, weights=hist.ravel(), **kw )
         plt.colorbar()
         plt.xlabel(quantity1, fontsize=self.fontsize)
         plt.ylabel(quantity2, fontsize=self.fontsize)
@@ -175,3 +176,88 @@ class Plotter(object):
         plt.imshow( F, extent=1.e6*info.imshow_extent, origin='lower',
             interpolation='nearest', aspect='auto', **kw )
         plt.colorbar()
+
+
+def get_block_ranges( blocks, n_quantities ):
+    """
+    Return the minimum and maximum of the first `n_quantities` quantities
+    of the blocks of particles, without keeping the blocks in memory
+
+    Parameters
+    ----------
+    blocks: iterable of lists of 1darrays
+        The blocks of particles (e.g. from `iter_particles`)
+
+    n_quantities: int
+        The number of quantities whose range is computed
+
+    Returns
+    -------
+    A list of tuples (min, max), with (nan, nan) for quantities without
+    any particle
+    """
+    mins = [ np.inf ] * n_quantities
+    maxs = [ -np.inf ] * n_quantities
+    for data_list in blocks:
+        for k in range( n_quantities ):
+            if len( data_list[k] ) > 0:
+                mins[k] = np.fmin( mins[k], np.nanmin( data_list[k] ) )
+                maxs[k] = np.fmax( maxs[k], np.nanmax( data_list[k] ) )
+    return( [ (q_min, q_max) if q_min <= q_max else (np.nan, np.nan) \
+              for (q_min, q_max) in zip( mins, maxs ) ] )
+
+
+def accumulate_histogram( blocks, ranges, nbins, weighted ):
+    """
+    Accumulate the 1D or 2D histogram of the blocks of particles,
+    without keeping the blocks in memory
+
+    Parameters
+    ----------
+    blocks: iterable of lists of 1darrays
+        The blocks of particles. Each block contains the quantities to be
+        histogrammed, followed by the weights when `weighted` is True.
+
+    ranges: list of tuples (min, max)
+        The range of the bins, for each quantity (see `get_block_ranges`)
+
+    nbins: int
+        The number of bins, along each quantity
+
+    weighted: bool
+        Whether the last array of each block contains the weights
+
+    Returns
+    -------
+    A tuple with
+        hist: 1darray or 2darray with the histogram
+        edges: list of 1darrays with the edges of the bins (one per quantity)
+    """
+    # (Bins between 0 and 1 when the range is unknown, e.g. no particles)
+    ranges = [ (q_min, q_max) if np.isfinite( [q_min, q_max] ).all() \
+               else (0., 1.) for (q_min, q_max) in ranges ]
+    def get_histogram( data_list, weights ):
+        "Histogram of the particles of one block"
+        if len(ranges) == 1:
+            hist, edges = np.histogram( data_list[0], bins=nbins,
+                                range=ranges[0], weights=weights )
+            return( hist, [ edges ] )
+        else:
+            hist, edges_1, edges_2 = np.histogram2d( data_list[0],
+                data_list[1], bins=nbins, range=ranges, weights=weights )
+            return( hist, [ edges_1, edges_2 ] )
+
+    # Initialize the histogram (empty) and the edges of the bins
+    hist, edges = get_histogram( [ np.zeros(0) ]*len(ranges), None )
+    hist = hist.astype( np.float64 )
+    # Add the particles of each block
+    for data_list in blocks:
+        if weighted:
+            weights = data_list[-1]
+        else:
+            weights = None
+        block_hist, _ = get_histogram( data_list, weights )
+        hist += block_hist
+
+    return( hist, edges )
+
@@ -0,0 +1,259 @@
+"""
+This file is part of the openPMD-viewer.
+
+It defines the fixtures of the tests, which write small synthetic
+openPMD series (with h5py) in temporary directories.
+"""
+import os
+import h5py
+import numpy as np
+import pytest
+from scipy import constants
+
+# Shape of the meshes, and components of the vector fields, for each geometry
+mesh_shapes = { 'thetaMode': (3, 16, 32), '2dcartesian': (16, 32),
+                '3dcartesian': (8, 10, 12) }
+axis_labels = { 'thetaMode': ['r', 'z'], '2dcartesian': ['x', 'z'],
+                '3dcartesian': ['x', 'y', 'z'] }
+components = { 'thetaMode': ['r', 't', 'z'], '2dcartesian': ['x', 'y', 'z'],
+               '3dcartesian': ['x', 'y', 'z'] }
+
+
+def write_root_attrs( f, encoding='fileBased' ):
+    """Write the root attributes of an openPMD file"""
+    f.attrs['openPMD'] = np.bytes_('1.0.0')
+    f.attrs['openPMDextension'] = np.uint32(1)
+    f.attrs['basePath'] = np.bytes_('/data/%T/')
+    f.attrs['meshesPath'] = np.bytes_('fields/')
+    f.attrs['particlesPath'] = np.bytes_('particles/')
+    f.attrs['iterationEncoding'] = np.bytes_( encoding )
+    if encoding == 'fileBased':
+        f.attrs['iterationFormat'] = np.bytes_('data%T.h5')
+    else:
+        f.attrs['iterationFormat'] = np.bytes_('/data/%T/')
+
+
+def make_iteration_data( iteration, geometry, n_particles, seed=0 ):
+    """
+    Return the fields (dictionary of arrays, with the record path as key)
+    and the particle quantities (dictionary of 1darrays, with the record
+    path as key) of one iteration, in SI units
+    """
+    rng = np.random.RandomState( seed + iteration )
+    shape = mesh_shapes[ geometry ]
+    fields = { 'rho': rng.randn( *shape ) }
+    for coord in components[ geometry ]:
+        fields[ 'E/%s' %coord ] = rng.randn( *shape )
+    # The particles are sorted along z (so that the patches are
+    # contiguous ranges of particles)
+    mc = constants.m_e * constants.c
+    particles = {
+        'position/x': 1.e-6 * rng.randn( n_particles ),
+        'position/y': 1.e-6 * rng.randn( n_particles ),
+        'position/z': 30.e-6 * np.sort( rng.rand( n_particles ) ),
+        'momentum/x': mc * rng.randn( n_particles ),
+        'momentum/y': mc * rng.randn( n_particles ),
+        'momentum/z': 100 * mc * rng.rand( n_particles ),
+        'weighting': rng.rand( n_particles ) }
+    return( fields, particles )
+
+
+def write_iteration( f, iteration, geometry, fields, particles,
+                     dtype='f8', chunks=None, patches=False, grid_offset=0. ):
+    """
+    Write the fields and particles of one iteration in the open file `f`
+    (`grid_offset` is the offset of the grid along the last axis, in
+    meters, for the files that contain one piece of the grid)
+    """
+    group = f.require_group( '/data/%d' %iteration )
+    group.attrs['time'] = 1.e-15 * iteration
+    group.attrs['dt'] = 1.e-15
+    group.attrs['timeUnitSI'] = 1.
+
+    # Fields
+    labels = axis_labels[ geometry ]
+    def set_mesh_attrs( mesh ):
+        if geometry == 'thetaMode':
+            mesh.attrs['geometry'] = np.bytes_('thetaMode')
+        else:
+            mesh.attrs['geometry'] = np.bytes_('cartesian')
+        mesh.attrs['axisLabels'] = np.array([ np.bytes_(l) for l in labels ])
+        mesh.attrs['gridSpacing'] = 1.e-6 * np.ones( len(labels) )
+        offset = np.zeros( len(labels) )
+        offset[-1] = grid_offset
+        mesh.attrs['gridGlobalOffset'] = offset
+        mesh.attrs['gridUnitSI'] = 1.
+    meshes = group.create_group( 'fields' )
+    E = meshes.create_group( 'E' )
+    set_mesh_attrs( E )
+    for path, data in fields.items():
+        dset = meshes.create_dataset( path, data=data.astype( dtype ) )
+        dset.attrs['position'] = np.zeros( len(labels) )
+        dset.attrs['unitSI'] = 1.
+    set_mesh_attrs( meshes['rho'] )
+
+    # Particles
+    n_particles = len( particles['weighting'] )
+    species = group.create_group( 'particles/electrons' )
+    kw = {}
+    if chunks is not None:
+        kw['chunks'] = ( chunks, )
+    for path, data in particles.items():
+        dset = species.create_dataset( path, data=data.astype( dtype ), **kw )
+        dset.attrs['unitSI'] = 1.
+    for path, value in [ ('positionOffset/x', 0.), ('positionOffset/y', 0.),
+            ('positionOffset/z', 0.), ('charge', -constants.e),
+            ('mass', constants.m_e) ]:
+        record = species.create_group( path )
+        record.attrs['value'] = value
+        record.attrs['shape'] = np.array( [ n_particles ], dtype=np.uint64 )
+        record.attrs['unitSI'] = 1.
+    if patches:
+        write_patches( species, particles['position/z'], 4 )
+
+
+def write_patches( species, z, n_patches ):
+    """
+    Write the particle patches of a species, which divide the particles
+    (sorted along `z`) in `n_patches` contiguous ranges
+    """
+    edges = np.linspace( 0, len(z), n_patches+1 ).astype( np.uint64 )
+    patches = species.create_group( 'particlePatches' )
+    patches['numParticles'] = np.diff( edges )
+    patches['numParticlesOffset'] = edges[:-1]
+    z_min = np.array([ z[edges[i]] for i in range(n_patches) ])
+    z_max = np.array([ z[edges[i+1]-1] for i in range(n_patches) ])
+    for quantity, offset, extent in [
+            ('x', -np.ones(n_patches), 2*np.ones(n_patches)),
+            ('y', -np.ones(n_patches), 2*np.ones(n_patches)),
+            ('z', z_min, z_max - z_min) ]:
+        patches[ 'offset/%s' %quantity ] = offset
+        patches[ 'extent/%s' %quantity ] = extent
+    for dset in patches.values():
+        if isinstance( dset, h5py.Dataset ):
+            dset.attrs['unitSI'] = 1.
+    for group in [ patches['offset'], patches['extent'] ]:
+        for dset in group.values():
+            dset.attrs['unitSI'] = 1.
+
+
+def write_series( path, n_iterations=3, geometry='thetaMode',
+                  n_particles=1000, dtype='f8', chunks=None, patches=False,
+                  group_based=False, n_shards=1 ):
+    """
+    Write a synthetic openPMD series in the directory `path`
+
+    Parameters
+    ----------
+    path : string
+        The directory of the series (created if needed)
+
+    n_iterations : int
+        The number of iterations (0, 100, 200, ...)
+
+    geometry : string
+        Either 'thetaMode', '2dcartesian' or '3dcartesian'
+
+    n_particles : int
+        The number of particles of the species 'electrons'
+
+    dtype : string
+        The type of the datasets
+
+    chunks : int or None
+        The size of the chunks of the particle datasets
+
+    patches : bool
+        Whether to write particle patches (along z)
+
+    group_based : bool
+        Whether to write all the iterations in a single file (data.h5)
+
+    n_shards : int
+        The number of files per iteration (one per MPI rank, with the
+        grid split along its last axis and the particles split evenly)
+
+    Returns
+    -------
+    The path to the series (the directory, or the file if `group_based`)
+    """
+    if not os.path.isdir( path ):
+        os.makedirs( path )
+    iterations = range( 0, 100*n_iterations, 100 )
+    if group_based:
+        filename = os.path.join( path, 'data.h5' )
+        with h5py.File( filename, 'w' ) as f:
+            write_root_attrs( f, 'groupBased' )
+            for iteration in iterations:
+                fields, particles = make_iteration_data(
+                    iteration, geometry, n_particles )
+                write_iteration( f, iteration, geometry, fields, particles,
+                                 dtype, chunks, patches )
+        return( filename )
+
+    for iteration in iterations:
+        fields, particles = make_iteration_data(
+            iteration, geometry, n_particles )
+        if n_shards == 1:
+            with h5py.File( os.path.join( path,
+                    'data%08d.h5' %iteration ), 'w' ) as f:
+                write_root_attrs( f )
+                write_iteration( f, iteration, geometry, fields, particles,
+                                 dtype, chunks, patches )
+            continue
+        # Split the grid along its last axis, and the particles evenly
+        n_cells = mesh_shapes[ geometry ][-1]
+        cell_edges = np.linspace( 0, n_cells, n_shards+1 ).astype( int )
+        particle_edges = np.linspace( 0, n_particles, n_shards+1 ).astype(int)
+        for rank in range( n_shards ):
+            cells = slice( cell_edges[rank], cell_edges[rank+1] )
+            ptcls = slice( particle_edges[rank], particle_edges[rank+1] )
+            with h5py.File( os.path.join( path,
+                    'data%08d_r%d.h5' %(iteration, rank) ), 'w' ) as f:
+                write_root_attrs( f )
+                write_iteration( f, iteration, geometry,
+                    dict( (k, v[...,cells]) for k, v in fields.items() ),
+                    dict( (k, v[ptcls]) for k, v in particles.items() ),
+                    dtype, chunks, patches=False,
+                    grid_offset=1.e-6 * cell_edges[rank] )
+    return( path )
+
+
+@pytest.fixture
+def series_factory( tmpdir ):
+    """
+    Return a function that writes a synthetic openPMD series in a new
+    subdirectory of the temporary directory of the test, and returns its
+    path (the arguments are those of `write_series`, except `path`)
+    """
+    counter = [ 0 ]
+    def make_series( **kw ):
+        counter[0] += 1
+        path = str( tmpdir.join( 'series%d' %counter[0] ) )
+        return( write_series( path, **kw ) )
+    return( make_series )
+
+
+def rewrite_file( filename, function ):
+    """
+    Replace a file on disk by a modified copy (written to a temporary file
+    and renamed, as is done by many simulation codes), keeping its size
+    and modification time, so that only its inode differs
+
+    Parameters
+    ----------
+    filename : string
+        The path to the file
+
+    function : callable
+        Function that modifies the copy (with the open h5py.File
+        object as argument)
+    """
+    tmp_name = filename + '.tmp'
+    with open( filename, 'rb' ) as src, open( tmp_name, 'wb' ) as dst:
+        dst.write( src.read() )
+    with h5py.File( tmp_name, 'r+' ) as f:
+        function( f )
+    file_stat = os.stat( filename )
+    os.utime( tmp_name, ns=( file_stat.st_atime_ns, file_stat.st_mtime_ns ) )
+    os.rename( tmp_name, filename )
@@ -0,0 +1,181 @@
+"""
+This test file is part of the openPMD-viewer.
+
+It makes sure that the caches of particles and fields (in the memory of
+the process, or in shared memory) return the same data as the files,
+including after a file was replaced on disk.
+
+Usage:
+This file is meant to be run from the root directory of openPMD-viewer,
+by any of the following commands
+$ py.test
+$ python setup.py test
+"""
+import numpy as np
+import pytest
+import matplotlib.pyplot as plt
+from opmd_viewer import OpenPMDTimeSeries
+from opmd_viewer.openpmd_timeseries.data_reader.shared_cache import \
+    shared_memory
+from conftest import rewrite_file
+
+backends = [ 'memory',
+    pytest.param( 'shared', marks=pytest.mark.skipif(
+        shared_memory is None, reason='requires Python 3.8 or later' ) ) ]
+
+
+def read_particles( ts, iteration ):
+    """Return some particle quantities of one iteration"""
+    return( ts.get_particle_at( iteration, ['z', 'uz', 'w'], 'electrons',
+                                select={ 'uz': [ 20., None ] } ) )
+
+
+def close_caches( ts, backend ):
+    """Unlink the shared-memory segments of the caches of `ts`"""
+    if backend == 'shared':
+        ts.particle_cache.close()
+        ts.field_cache.close()
+
+
+@pytest.mark.parametrize( 'backend', backends )
+def test_particle_cache( series_factory, backend ):
+    """Check that the cached particles are equal to those of the files,
+    and that the particles of a replaced file are read again"""
+    path = series_factory()
+    ref = OpenPMDTimeSeries( path )
+    ts = OpenPMDTimeSeries( path, particle_cache_size=10**7,
+                            cache_backend=backend )
+    try:
+        for iteration in ts.iterations:
+            first = read_particles( ts, iteration )
+            second = read_particles( ts, iteration )
+            for a, b, c in zip( first, second,
+                                read_particles( ref, iteration ) ):
+                assert np.array_equal( a, c )
+                assert np.array_equal( b, a )
+                assert not b.flags.writeable
+        stats = ts.particle_cache.stats()
+        assert stats['hits'] == 3 * len( ts.iterations )
+        assert stats['misses'] == 3 * len( ts.iterations )
+
+        # The buffers that are passed with `out` are still filled
+        buffer = np.zeros( 1000 )
+        z, = ts.get_particle_at( 100, ['z'], 'electrons', out=[ buffer ] )
+        assert np.shares_memory( z, buffer )
+        assert np.array_equal( z, ref.get_particle_at( 100, ['z'],
+                                                       'electrons' )[0] )
+
+        # Replace a file with a copy (with the same size and modification
+        # time) in which the data and the units are different
+        ts.close()
+        ref.close()
+        def modify( f ):
+            particles = f['data/100/particles/electrons']
+            particles['momentum/z'][...] *= 2
+            particles['position/z'].attrs['unitSI'] = 0.5
+        rewrite_file( ts.h5_files[1], modify )
+        for a, b in zip( read_particles( ts, 100 ),
+                         read_particles( ref, 100 ) ):
+            assert np.array_equal( a, b )
+        z, = ts.get_particle_at( 100, ['z'], 'electrons' )
+        assert z.max() <= 15.
+    finally:
+        close_caches( ts, backend )
+
+
+@pytest.mark.parametrize( 'backend', backends )
+def test_cached_plots( series_factory, backend ):
+    """Check that the histograms of the particles (without output, as in
+    the GUI) are obtained from the particle cache when they are plotted
+    again, including when the zone maps give the range of the bins"""
+    ts = OpenPMDTimeSeries( series_factory(), particle_cache_size=10**7,
+                            cache_backend=backend )
+    ts.build_zone_maps( 'electrons', [ 'z', 'uz' ] )
+    try:
+        for var_list in [ ['z'], ['z', 'uz'], ['uz'] ]:
+            plt.figure()
+            ts.get_particle( var_list, 'electrons', iteration=100,
+                             plot=True, output=False )
+        # (z, w and uz are each read once)
+        stats = ts.particle_cache.stats()
+        assert stats['misses'] == 3
+        assert stats['hits'] == 4
+        plt.close( 'all' )
+    finally:
+        close_caches( ts, backend )
+
+
+@pytest.mark.parametrize( 'backend', backends )
+def test_field_cache( series_factory, backend ):
+    """Check that the cached fields are equal to those of the files, and
+    that the fields of a replaced file are read again"""
+    path = series_factory()
+    ref = OpenPMDTimeSeries( path )
+    ts = OpenPMDTimeSeries( path, field_cache_size=10**7,
+                            cache_backend=backend )
+    try:
+        for theta in [ 0., 0.5, 0.5 ]:
+            F, info = ts.get_field_at( 100, 'E', 'z', theta=theta )
+            G, _ = ref.get_field_at( 100, 'E', 'z', theta=theta )
+            assert np.array_equal( F, G )
+            assert not F.flags.writeable
+        assert ts.field_cache.stats()['hits'] > 0
+
+        # Replace a file with a copy in which the sign of the field changed
+        ts.close()
+        ref.close()
+        def modify( f ):
+            f['data/100/fields/E/z'][...] *= -1
+        rewrite_file( ts.h5_files[1], modify )
+        F, _ = ts.get_field_at( 100, 'E', 'z', theta=0.5 )
+        assert np.array_equal( F, -G )
+    finally:
+        close_caches( ts, backend )
+
+
+@pytest.mark.parametrize( 'backend', backends )
+def test_cached_slices( series_factory, backend ):
+    """Check that the slices of a 3D field are taken from the full field,
+    once it is in the cache"""
+    path = series_factory( geometry='3dcartesian' )
+    ref = OpenPMDTimeSeries( path )
+    ts = OpenPMDTimeSeries( path, field_cache_size=10**7,
+                            cache_backend=backend )
+    try:
+        F, _ = ts.get_field_at( 0, 'rho', slicing=None )
+        assert F.ndim == 3
+        misses = ts.field_cache.stats()['misses']
+        for slicing_dir in [ 'x', 'y', 'z' ]:
+            for slicing in [ -1., -0.3, 0., 0.6, 1. ]:
+                S, info = ts.get_field_at( 0, 'rho', slicing=slicing,
+                                           slicing_dir=slicing_dir )
+                R, ref_info = ref.get_field_at( 0, 'rho', slicing=slicing,
+                                                slicing_dir=slicing_dir )
+                assert S.ndim == 2
+                assert np.array_equal( S, R )
+                assert np.array_equal( info.imshow_extent,
+                                       ref_info.imshow_extent )
+        stats = ts.field_cache.stats()
+        assert stats['misses'] == misses
+        assert stats['hits'] == 15
+    finally:
+        close_caches( ts, backend )
+
+
+def test_compressed_cache( series_factory ):
+    """Check the data of the second (compressed) tier of the cache"""
+    path = series_factory( n_iterations=4 )
+    ref = OpenPMDTimeSeries( path )
+    # The first tier only holds the particles of about one iteration
+    ts = OpenPMDTimeSeries( path, particle_cache_size=3*8*1000,
+                            compressed_cache_size=10**6 )
+    for _ in range( 2 ):
+        for iteration in ts.iterations:
+            for a, b in zip(
+                    ts.get_particle_at( iteration, ['z', 'w'], 'electrons' ),
+                    ref.get_particle_at( iteration, ['z', 'w'],
+                                         'electrons' ) ):
+                assert np.array_equal( a, b )
+    stats = ts.particle_cache.stats()
+    assert stats['evictions'] > 0
+    assert stats['compressed_hits'] > 0
@@ -0,0 +1,60 @@
+"""
+This test file is part of the openPMD-viewer.
+
+It makes sure that the pool of open files reopens the files that are
+modified or replaced on disk.
+
+Usage:
+This file is meant to be run from the root directory of openPMD-viewer,
+by any of the following commands
+$ py.test
+$ python setup.py test
+"""
+import os
+import h5py
+import numpy as np
+from opmd_viewer.openpmd_timeseries.data_reader.file_pool import FilePool
+
+
+def write_file( filename, value, n=10 ):
+    """Write a file with a single dataset, by writing a temporary file
+    and renaming it (as is done by many simulation codes)"""
+    tmp_name = filename + '.tmp'
+    with h5py.File( tmp_name, 'w' ) as f:
+        f['data'] = value * np.ones( n )
+    os.rename( tmp_name, filename )
+
+
+def test_replaced_file( tmpdir ):
+    """Check that a file that was replaced on disk is reopened"""
+    filename = str( tmpdir.join( 'data.h5' ) )
+    write_file( filename, 1. )
+    pool = FilePool( max_open_files=4 )
+    with pool.open( filename ) as dfile:
+        assert dfile['data'][0] == 1.
+
+    write_file( filename, 2. )
+    with pool.open( filename ) as dfile:
+        assert dfile['data'][0] == 2.
+    assert len( pool.entries ) == 1
+    pool.close()
+
+
+def test_replaced_file_while_read( tmpdir ):
+    """Check that a file that is replaced while it is being read is
+    reopened for the next readers, and closed after the last release"""
+    filename = str( tmpdir.join( 'data.h5' ) )
+    write_file( filename, 1. )
+    pool = FilePool( max_open_files=4 )
+    with pool.open( filename ) as old_file:
+        write_file( filename, 2., n=20 )
+        with pool.open( filename ) as new_file:
+            assert new_file['data'][0] == 2.
+            # The first reader can still use the previous file
+            assert old_file['data'][0] == 1.
+        assert len( pool.retired_entries ) == 1
+    assert len( pool.retired_entries ) == 0
+    assert not old_file.id.valid
+    assert pool.entries[ filename ][1] == 0
+    pool.close()
+
@@ -0,0 +1,252 @@
+"""
+This test file is part of the openPMD-viewer.
+
+It makes sure that the particles and fields are read consistently:
+block by block, histogrammed block by block, in single precision,
+as constant records and into buffers.
+
+Usage:
+This file is meant to be run from the root directory of openPMD-viewer,
+by any of the following commands
+$ py.test
+$ python setup.py test
+"""
+import h5py
+from functools import partial
+import numpy as np
+import pytest
+import matplotlib.pyplot as plt
+from scipy import constants
+from opmd_viewer import OpenPMDTimeSeries
+from opmd_viewer.openpmd_timeseries.main import OpenPMDException
+from opmd_viewer.openpmd_timeseries.data_reader import particle_reader
+from opmd_viewer.openpmd_timeseries.plotter import get_block_ranges, \
+    accumulate_histogram
+
+
+@pytest.mark.parametrize( 'n_shards', [ 1, 3 ] )
+def test_iter_particles( series_factory, n_shards ):
+    """Check that the blocks of `iter_particles` contain the particles
+    of `get_particle_at`, with and without selection"""
+    ts = OpenPMDTimeSeries( series_factory( n_shards=n_shards, chunks=50 ) )
+    var_list = [ 'z', 'uz', 'w' ]
+    full = ts.get_particle_at( 100, var_list, 'electrons' )
+    for select in [ None, {}, { 'uz': [ 20., 70. ] },
+                    { 'z': [ 3., 9. ], 'x': [ None, 0. ] } ]:
+        ref = ts.get_particle_at( 100, var_list, 'electrons', select )
+        if not select:
+            assert all( np.array_equal( a, b ) for a, b in zip( ref, full ) )
+        blocks = list( ts.iter_particles( var_list, 'electrons', 100,
+                                          chunk_size=64, select=select ) )
+        assert len( blocks ) >= 1000 // 64
+        for data_list in blocks:
+            assert all( len( data ) <= 64 for data in data_list )
+        for k in range( len( var_list ) ):
+            assert np.array_equal( np.concatenate(
+                [ data_list[k] for data_list in blocks ] ), ref[k] )
+
+    # Blocks read into buffers (which are overwritten by the next block)
+    buffers = [ np.empty( 64 ), np.empty( 64 ) ]
+    z_ref, w_ref = ts.get_particle_at( 100, [ 'z', 'w' ], 'electrons' )
+    start = 0
+    for z, w in ts.iter_particles( [ 'z', 'w' ], 'electrons', 100,
+                                   chunk_size=64, out=buffers ):
+        assert np.shares_memory( z, buffers[0] )
+        assert np.array_equal( z, z_ref[ start:start+len(z) ] )
+        assert np.array_equal( w, w_ref[ start:start+len(w) ] )
+        start += len( z )
+    assert start == len( z_ref )
+
+    with pytest.raises( OpenPMDException ):
+        ts.iter_particles( [ 'z' ], 'electrons', 100, chunk_size=0 )
+
+
+def test_block_histograms( series_factory ):
+    """Check that the histograms accumulated block by block are those
+    of numpy, for the full data"""
+    ts = OpenPMDTimeSeries( series_factory() )
+    var_list = [ 'z', 'uz', 'w' ]
+    x, y, w = ts.get_particle_at( 0, var_list, 'electrons' )
+    get_blocks = lambda: ts.iter_particles( var_list, 'electrons', 0,
+                                            chunk_size=100 )
+    ranges = get_block_ranges( get_blocks(), 2 )
+    assert ranges == [ ( x.min(), x.max() ), ( y.min(), y.max() ) ]
+
+    # 1D histograms, with and without weights
+    blocks_1d = lambda: ( [ z, w ] for z, _, w in get_blocks() )
+    hist, edges = accumulate_histogram( blocks_1d(), ranges[:1], 30, True )
+    ref_hist, ref_edges = np.histogram( x, bins=30, weights=w )
+    assert np.allclose( hist, ref_hist )
+    assert np.allclose( edges[0], ref_edges )
+    hist, _ = accumulate_histogram( blocks_1d(), ranges[:1], 30, False )
+    assert np.array_equal( hist, np.histogram( x, bins=30 )[0] )
+
+    # 2D histogram (with the bins of the first quantity along axis 0)
+    hist, edges = accumulate_histogram( get_blocks(), ranges, 20, True )
+    ref_hist, ref_x, ref_y = np.histogram2d( x, y, bins=20, weights=w )
+    assert np.allclose( hist, ref_hist )
+    assert np.allclose( edges[0], ref_x )
+    assert np.allclose( edges[1], ref_y )
+
+    # Without particles, the bins are between 0 and 1
+    hist, edges = accumulate_histogram( [], [ ( np.nan, np.nan ) ], 10,
+                                        False )
+    assert np.all( hist == 0 )
+    assert np.allclose( edges[0], np.linspace( 0., 1., 11 ) )
+
+
+def test_histogram_plots( series_factory ):
+    """Check that the options of matplotlib's hist and hist2d give the
+    same plots as when the particles are passed to matplotlib"""
+    ts = OpenPMDTimeSeries( series_factory() )
+    z, uz, w = ts.get_particle_at( 0, ['z', 'uz', 'w'], 'electrons' )
+    for output in [ True, False ]:
+        for kw in [ { 'histtype': 'step', 'density': True },
+                    { 'range': ( 5., 20. ), 'cumulative': True,
+                      'histtype': 'step' } ]:
+            plt.figure()
+            ts.get_particle( ['z'], 'electrons', iteration=0, plot=True,
+                             output=output, nbins=40, **kw )
+            plot = plt.gca().patches[0].get_xy()
+            plt.figure()
+            plt.hist( z, bins=40, weights=w, **kw )
+            assert np.allclose( plot, plt.gca().patches[0].get_xy() )
+        kw = { 'cmin': 1., 'range': [ [ 5., 20. ], None ] }
+        plt.figure()
+        ts.get_particle( ['z', 'uz'], 'electrons', iteration=0, plot=True,
+                         output=output, nbins=30, **kw )
+        plot = plt.gca().collections[0].get_array()
+        plt.figure()
+        kw['range'][1] = [ uz.min(), uz.max() ]
+        plt.hist2d( z, uz, bins=30, weights=w, **kw )
+        ref = plt.gca().collections[0].get_array()
+        # (The bins below `cmin` are masked)
+        mask = np.ma.getmaskarray( ref )
+        assert 0 < mask.sum() < mask.size
+        assert np.array_equal( np.ma.getmaskarray( plot ), mask )
+        assert np.allclose( plot[ ~mask ], ref[ ~mask ] )
+        plt.close( 'all' )
+
+
+@pytest.mark.parametrize( 'ranges', [ 'data', 'zone_maps', 'patches' ] )
+def test_histogram_reads( series_factory, monkeypatch, ranges ):
+    """Check that plotting the histogram of particles reads the data only
+    once, whether or not the range of the bins is known beforehand (from
+    the zone maps or from the particle patches)"""
+    ts = OpenPMDTimeSeries( series_factory( patches=( ranges=='patches' ) ) )
+    if ranges == 'zone_maps':
+        ts.build_zone_maps( 'electrons', [ 'z', 'uz' ] )
+    w, = ts.get_particle_at( 0, ['w'], 'electrons' )
+    reads = []
+    for name in [ 'get_data', 'get_data_range', 'get_selected_data' ]:
+        def counting_read( read, dset, *args, **kw ):
+            reads.append( dset.name )
+            return( read( dset, *args, **kw ) )
+        monkeypatch.setattr( particle_reader, name, partial( counting_read,
+                             getattr( particle_reader, name ) ) )
+    for var_list in [ ['z'], ['z', 'uz'] ]:
+        del reads[:]
+        ts.get_particle_at( 0, var_list + ['w'], 'electrons' )
+        n_reads = len( reads )
+        del reads[:]
+        plt.figure()
+        ts.get_particle( var_list, 'electrons', iteration=0, plot=True,
+                         output=False, nbins=20 )
+        # (The patches are small metadata, and are not counted)
+        assert len([ name for name in reads \
+                     if 'particlePatches' not in name ]) == n_reads
+        # All the particles are in the bins
+        if len( var_list ) == 1:
+            total = sum( bar.get_height() for bar in plt.gca().patches )
+        else:
+            total = plt.gca().collections[0].get_array().sum()
+        assert np.isclose( total, w.sum() )
+        plt.close( 'all' )
+
+
+@pytest.mark.parametrize( 'geometry',
+                          [ 'thetaMode', '2dcartesian', '3dcartesian' ] )
+def test_float32( series_factory, geometry ):
+    """Check that the data is returned in single precision, with the same
+    values as in double precision"""
+    path = series_factory( geometry=geometry, dtype='f4' )
+    double = OpenPMDTimeSeries( path )
+    single = OpenPMDTimeSeries( path, dtype='float32' )
+    F, _ = double.get_field_at( 100, 'E', 'z' )
+    G, _ = single.get_field_at( 100, 'E', 'z' )
+    assert F.dtype == np.float64
+    assert G.dtype == np.float32
+    assert np.allclose( F, G, rtol=1.e-5, atol=1.e-6 )
+    for a, b in zip(
+            double.get_particle_at( 100, ['x', 'uz', 'w'], 'electrons' ),
+            single.get_particle_at( 100, ['x', 'uz', 'w'], 'electrons' ) ):
+        assert b.dtype == np.float32
+        assert np.allclose( a, b, rtol=1.e-5 )
+    # The type can also be chosen for each read
+    H, _ = double.get_field_at( 100, 'E', 'z', dtype='float32' )
+    assert H.dtype == np.float32
+
+
+@pytest.mark.parametrize( 'n_shards', [ 1, 3 ] )
+def test_constant_records( series_factory, n_shards ):
+    """Check that the constant records are returned as broadcast arrays
+    of the right length, which do not allocate memory"""
+    path = series_factory( n_shards=n_shards )
+    ts = OpenPMDTimeSeries( path )
+    for select in [ None, { 'uz': [ 20., 70. ] } ]:
+        charge, mass, w = ts.get_particle_at( 0, ['charge', 'mass', 'w'],
+                                              'electrons', select )
+        for data, value in [ (charge, -constants.e), (mass, constants.m_e) ]:
+            assert len( data ) == len( w )
+            assert data.strides == (0,)
+            assert not data.flags.writeable
+            assert np.all( data == value )
+    charge, = OpenPMDTimeSeries( path, dtype='float32' ).get_particle_at(
+        0, ['charge'], 'electrons' )
+    assert charge.dtype == np.float32
+
+    # A constant position offset is added to the positions
+    x_ref, = ts.get_particle_at( 100, ['x'], 'electrons' )
+    filenames = ts.h5_files[1]
+    if n_shards == 1:
+        filenames = [ filenames ]
+    ts.close()
+    for filename in filenames:
+        with h5py.File( filename, 'r+' ) as f:
+            f['data/100/particles/electrons/positionOffset/x'].attrs[
+                'value'] = 2.e-6
+    x, = ts.get_particle_at( 100, ['x'], 'electrons' )
+    assert np.allclose( x, x_ref + 2. )
+
+
+def test_out_buffers( series_factory ):
+    """Check that the data is read into the buffers that are passed
+    with `out`, with the same values as in new arrays"""
+    ts = OpenPMDTimeSeries( series_factory( n_particles=500 ) )
+    buffers = [ np.empty( 1000 ), np.empty( 1000, dtype='float32' ) ]
+    for iteration in ts.iterations:
+        x, uz = ts.get_particle_at( iteration, ['x', 'uz'], 'electrons',
+                                    out=buffers )
+        ref_x, ref_uz = ts.get_particle_at( iteration, ['x', 'uz'],
+                                            'electrons' )
+        assert np.shares_memory( x, buffers[0] )
+        assert np.shares_memory( uz, buffers[1] )
+        assert uz.dtype == np.float32
+        assert np.array_equal( x, ref_x )
+        assert np.allclose( uz, ref_uz, rtol=1.e-6 )
+
+    # With a selection, only the first elements of the buffers are used
+    select = { 'uz': [ 50., None ] }
+    x, = ts.get_particle_at( 0, ['x'], 'electrons', select=select,
+                             out=[ buffers[0] ] )
+    ref_x, = ts.get_particle_at( 0, ['x'], 'electrons', select=select )
+    assert np.shares_memory( x, buffers[0] )
+    assert np.array_equal( x, ref_x )
+
+    F_ref, _ = ts.get_field_at( 100, 'E', 'x', theta=0.3 )
+    F_out = np.empty( F_ref.shape )
+    F, _ = ts.get_field_at( 100, 'E', 'x', theta=0.3, out=F_out )
+    assert np.shares_memory( F, F_out )
+    assert np.allclose( F, F_ref )
+    with pytest.raises( ValueError ):
+        ts.get_field_at( 100, 'rho', out=np.empty( (3, 3) ) )
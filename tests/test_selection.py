@@ -0,0 +1,140 @@
+"""
+This test file is part of the openPMD-viewer.
+
+It makes sure that the selections of particles (which are pushed down
+into the reader, and which use the particle patches, the sorted index or
+the zone maps to avoid reading all the particles) give the same particles
+as a selection on the full data.
+
+Usage:
+This file is meant to be run from the root directory of openPMD-viewer,
+by any of the following commands
+$ py.test
+$ python setup.py test
+"""
+import os
+import h5py
+import numpy as np
+from opmd_viewer import OpenPMDTimeSeries
+from opmd_viewer.openpmd_timeseries.data_reader.particle_reader import \
+    get_patch_candidates
+from opmd_viewer.openpmd_timeseries.data_reader.sorted_index import \
+    get_index_candidates, get_index_filename
+from opmd_viewer.openpmd_timeseries.data_reader.zone_map import \
+    get_zone_map_candidates
+from opmd_viewer.openpmd_timeseries.data_reader.utilities import \
+    get_candidates_mask
+from conftest import rewrite_file
+
+var_list = [ 'x', 'z', 'uz', 'w' ]
+
+
+def check_selection( ts, iteration, select ):
+    """Check that the selected particles are those of the full data that
+    satisfy the rules of `select`"""
+    full = dict( zip( var_list,
+                 ts.get_particle_at( iteration, var_list, 'electrons' ) ) )
+    mask = np.ones( len( full['w'] ), dtype='bool' )
+    for quantity, (lower, upper) in select.items():
+        if lower is not None:
+            mask = np.logical_and( mask, full[quantity] >= lower )
+        if upper is not None:
+            mask = np.logical_and( mask, full[quantity] <= upper )
+    selected = ts.get_particle_at( iteration, var_list, 'electrons', select )
+    assert 0 < mask.sum() < len( mask )
+    for quantity, data in zip( var_list, selected ):
+        assert np.array_equal( data, full[quantity][mask] )
+    # Same particles when they are read block by block (the candidates
+    # of the sorted index are only used when they fit in a block)
+    for chunk_size in [ 70, 400 ]:
+        blocks = list( ts.iter_particles( var_list, 'electrons', iteration,
+                                    chunk_size=chunk_size, select=select ) )
+        for k, quantity in enumerate( var_list ):
+            data = np.concatenate([ data_list[k] for data_list in blocks ])
+            assert np.array_equal( data, full[quantity][mask] )
+    return( mask )
+
+
+def test_selection( series_factory ):
+    """Check the selection on one or several quantities (including
+    quantities that are not requested, or requested twice)"""
+    ts = OpenPMDTimeSeries( series_factory( chunks=64 ) )
+    check_selection( ts, 0, { 'uz': [ 20., 60. ] } )
+    check_selection( ts, 0, { 'uz': [ None, 60. ], 'x': [ 0., None ] } )
+    z, uz, z_again = ts.get_particle_at( 0, ['z', 'uz', 'z'], 'electrons',
+                                         select={ 'ux': [ 0., 1. ] } )
+    ux, = ts.get_particle_at( 0, ['ux'], 'electrons' )
+    ref_z, = ts.get_particle_at( 0, ['z'], 'electrons' )
+    mask = (ux >= 0.) & (ux <= 1.)
+    assert np.array_equal( z, ref_z[mask] )
+    assert np.array_equal( z_again, z )
+    assert len( uz ) == mask.sum()
+
+
+def test_patches( series_factory ):
+    """Check the selection with particle patches"""
+    ts = OpenPMDTimeSeries( series_factory( patches=True ) )
+    select = { 'z': [ 12., 18. ], 'uz': [ 20., None ] }
+    mask = check_selection( ts, 100, select )
+    with h5py.File( ts.h5_files[1], 'r' ) as f:
+        species_grp = f['data/100/particles/electrons']
+        candidates = get_candidates_mask( 0, len( mask ),
+                        get_patch_candidates( species_grp, select ) )
+        # Only the patches that overlap with the selected range of z remain
+        assert candidates.sum() < len( candidates )
+        assert np.all( candidates[ mask ] )
+        assert get_patch_candidates( species_grp,
+                                     { 'uz': [ 20., None ] } ) is None
+
+
+def test_sorted_index( series_factory ):
+    """Check the selection with a sorted index, and that the index is
+    not used anymore once the data file is replaced"""
+    ts = OpenPMDTimeSeries( series_factory() )
+    ts.build_sorted_index( 'electrons', 'uz', bin_size=64 )
+    filename = ts.h5_files[2]
+    assert os.path.exists( get_index_filename( filename ) )
+
+    select = { 'uz': [ 30., 40. ] }
+    mask = check_selection( ts, 200, select )
+    # The candidates are exactly the particles in the selected range
+    candidates = get_index_candidates( filename, 200, 'electrons', select )
+    assert np.array_equal( candidates, np.flatnonzero( mask ) )
+    # (The index is not used when there are too many candidates)
+    assert get_index_candidates( filename, 200, 'electrons', select,
+                                 max_candidates=mask.sum()-1 ) is None
+    assert get_index_candidates( filename, 200, 'electrons',
+                                 { 'z': [ 1., 2. ] } ) is None
+
+    # Replace the file with different momenta
+    ts.close()
+    def scale_momenta( f ):
+        f['data/200/particles/electrons/momentum/z'][...] *= 0.5
+    rewrite_file( filename, scale_momenta )
+    assert get_index_candidates( filename, 200, 'electrons', select ) is None
+    new_mask = check_selection( ts, 200, select )
+    assert not np.array_equal( new_mask, mask )
+
+
+def test_zone_maps( series_factory ):
+    """Check the selection with zone maps, and the range of the
+    quantities that is obtained from them"""
+    ts = OpenPMDTimeSeries( series_factory( chunks=50 ) )
+    ref_range = ts.get_particle_range( 'z', 'electrons', 100 )
+    ts.build_zone_maps( 'electrons', [ 'z', 'uz' ], n_workers=2 )
+    filename = ts.h5_files[1]
+
+    select = { 'z': [ 5., 9. ] }
+    mask = check_selection( ts, 100, select )
+    candidates = get_candidates_mask( 0, len( mask ),
+        get_zone_map_candidates( filename, 100, 'electrons', select ) )
+    # Since the particles are sorted along z, only a few chunks remain
+    assert np.all( candidates[ mask ] )
+    assert candidates.sum() <= mask.sum() + 2*50
+    assert np.allclose( ts.get_particle_range( 'z', 'electrons', 100 ),
+                        ref_range )
+    z, = ts.get_particle_at( 100, ['z'], 'electrons' )
+    assert np.allclose( ref_range, [ z.min(), z.max() ] )
+
+    # Combined with a quantity that has no zone map
+    check_selection( ts, 100, { 'z': [ 5., 25. ], 'x': [ 0., None ] } )
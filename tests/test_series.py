@@ -0,0 +1,258 @@
+"""
+This test file is part of the openPMD-viewer.
+
+It makes sure that the outputs of a time series are found, scanned and
+looked up consistently, on small synthetic series.
+
+Usage:
+This file is meant to be run from the root directory of openPMD-viewer,
+by any of the following commands
+$ py.test
+$ python setup.py test
+"""
+import os
+import time
+import h5py
+import numpy as np
+import pytest
+from multiprocessing.pool import ThreadPool
+from opmd_viewer import OpenPMDTimeSeries
+from opmd_viewer.openpmd_timeseries.main import OpenPMDException
+from opmd_viewer.openpmd_timeseries import main, metadata_index
+from conftest import write_series, rewrite_file
+
+
+@pytest.mark.parametrize( 'pool_type', [ 'thread', 'process' ] )
+def test_parallel_scan( series_factory, pool_type ):
+    """Check that scanning the files concurrently gives the same
+    series as scanning them serially"""
+    path = series_factory( n_iterations=6 )
+    serial = OpenPMDTimeSeries( path )
+    parallel = OpenPMDTimeSeries( path, n_workers=3, pool_type=pool_type )
+    assert parallel.iterations == serial.iterations
+    assert np.array_equal( parallel.t, serial.t )
+    assert parallel.avail_fields == serial.avail_fields
+    assert parallel.avail_species == serial.avail_species
+
+
+def test_metadata_index( series_factory, monkeypatch ):
+    """Check that the metadata index is reused, and that the files that
+    are modified or replaced are scanned again"""
+    path = series_factory( n_iterations=4 )
+    ts = OpenPMDTimeSeries( path, metadata_index='sidecar' )
+    assert os.path.exists( os.path.join( path, metadata_index.SIDECAR_NAME ) )
+
+    # Count the files that are scanned when the series is reopened
+    scanned = []
+    scan = metadata_index.scan_openPMD_params
+    def counting_scan( filenames, **kw ):
+        scanned.extend( filenames )
+        return( scan( filenames, **kw ) )
+    monkeypatch.setattr( metadata_index, 'scan_openPMD_params',
+                         counting_scan )
+    reopened = OpenPMDTimeSeries( path, metadata_index='sidecar' )
+    assert len( scanned ) == 0
+    assert np.array_equal( reopened.t, ts.t )
+
+    # Modify the time of one iteration
+    filename = ts.h5_files[1]
+    with h5py.File( filename, 'r+' ) as f:
+        f['data/100'].attrs['time'] = 5.e-13
+    os.utime( filename, ( time.time() + 10, time.time() + 10 ) )
+    reopened = OpenPMDTimeSeries( path, metadata_index='sidecar' )
+    assert scanned == [ filename ]
+    assert reopened.t[1] == 5.e-13
+
+    # Replace a file by a copy with the same size and modification time
+    def set_time( f ):
+        f['data/200'].attrs['time'] = 7.e-13
+    rewrite_file( ts.h5_files[2], set_time )
+    reopened = OpenPMDTimeSeries( path, metadata_index='sidecar' )
+    assert scanned == [ filename, ts.h5_files[2] ]
+    assert reopened.t[2] == 7.e-13
+
+
+def test_lazy_scan( series_factory, monkeypatch ):
+    """Check that only the first file is scanned with
+    `check_all_files=False`, that the times of the other files are
+    extracted when needed, and that `validate` checks all the files"""
+    path = series_factory( n_iterations=4 )
+    ref = OpenPMDTimeSeries( path )
+    scanned = []
+    scan = main.scan_openPMD_params
+    def counting_scan( filenames, **kw ):
+        scanned.extend( filenames )
+        return( scan( filenames, **kw ) )
+    monkeypatch.setattr( main, 'scan_openPMD_params', counting_scan )
+
+    ts = OpenPMDTimeSeries( path, check_all_files=False )
+    assert scanned == [ ts.h5_files[0] ]
+    assert ts.iterations == ref.iterations
+    # Reading an iteration only scans its file
+    ts.get_particle( ['z'], 'electrons', iteration=200 )
+    assert scanned == [ ts.h5_files[0], ts.h5_files[2] ]
+    assert ts.current_t == ref.t[2]
+    # The other times are extracted when the times are accessed
+    assert np.array_equal( ts.t, ref.t )
+    assert sorted( scanned ) == sorted( ts.h5_files )
+    assert ts.validate()
+
+    # A file with different parameters is detected by `validate`
+    with h5py.File( ts.h5_files[3], 'r+' ) as f:
+        del f['data/300/fields/rho']
+    assert not OpenPMDTimeSeries( path, check_all_files=False ).validate()
+
+
+def test_refresh( series_factory ):
+    """Check that the new files of a series are added by `refresh`"""
+    path = series_factory( n_iterations=2 )
+    ts = OpenPMDTimeSeries( path )
+    assert ts.iterations == [ 0, 100 ]
+    assert ts.refresh() == 0
+
+    # Write a series with more iterations in the same directory
+    write_series( path, n_iterations=4 )
+    assert ts.refresh() == 2
+    assert ts.iterations == [ 0, 100, 200, 300 ]
+    assert len( ts.t ) == 4
+    rho, _ = ts.get_field( 'rho', iteration=300 )
+    ref_rho, _ = OpenPMDTimeSeries( path ).get_field( 'rho', iteration=300 )
+    assert np.array_equal( rho, ref_rho )
+
+
+def test_file_pattern( series_factory ):
+    """Check the listing of the files with a pattern (%T or regular
+    expression), which ignores the files that do not match it"""
+    path = series_factory( n_iterations=3 )
+    ref = OpenPMDTimeSeries( path )
+    for filename, iteration in zip( ref.h5_files, ref.iterations ):
+        os.rename( filename, os.path.join( path,
+                                           'fields_%d.h5' %iteration ) )
+    open( os.path.join( path, 'fields_0.h5.bak' ), 'w' ).close()
+    open( os.path.join( path, 'notes.txt' ), 'w' ).close()
+    for pattern in [ 'fields_%T.h5', r'fields_(\d+)\.h5$' ]:
+        ts = OpenPMDTimeSeries( path, file_pattern=pattern )
+        assert ts.iterations == ref.iterations
+        assert [ os.path.basename( name ) for name in ts.h5_files ] == \
+            [ 'fields_0.h5', 'fields_100.h5', 'fields_200.h5' ]
+        assert np.array_equal( ts.t, ref.t )
+
+
+def test_recursive_listing( series_factory ):
+    """Check that the files of the subdirectories are only found with
+    `recursive=True`"""
+    path = series_factory( n_iterations=4 )
+    ref = OpenPMDTimeSeries( path )
+    for k, (filename, iteration) in enumerate(
+            zip( ref.h5_files, ref.iterations ) ):
+        sub_dir = os.path.join( path, 'hdf5', '%05d' %(k//2) )
+        if not os.path.isdir( sub_dir ):
+            os.makedirs( sub_dir )
+        os.rename( filename, os.path.join( sub_dir,
+                                           os.path.basename( filename ) ) )
+    ts = OpenPMDTimeSeries( path, recursive=True )
+    assert ts.iterations == ref.iterations
+    assert np.array_equal( ts.t, ref.t )
+    F, _ = ts.get_field( 'E', 'z', iteration=300 )
+    G, _ = OpenPMDTimeSeries( os.path.join( path, 'hdf5', '00001' ) \
+                              ).get_field( 'E', 'z', iteration=300 )
+    assert np.array_equal( F, G )
+    assert OpenPMDTimeSeries( path ).iterations == []
+
+
+def test_recursive_restarts( series_factory, capsys ):
+    """Check that the outputs of different subdirectories that reuse the
+    same iterations (e.g. a restarted simulation) are not merged"""
+    path = series_factory( n_iterations=3 )
+    ref = OpenPMDTimeSeries( path )
+    ref_z, = ref.get_particle_at( 100, ['z'], 'electrons' )
+    for sub_dir in [ 'run0', 'run1' ]:
+        os.makedirs( os.path.join( path, sub_dir ) )
+        write_series( os.path.join( path, sub_dir ), n_iterations=2 )
+    capsys.readouterr()
+    ts = OpenPMDTimeSeries( path, recursive=True )
+    output = capsys.readouterr().out
+    assert output.count( 'Warning: Several outputs' ) == 2
+    assert ts.iterations == ref.iterations
+    # Each iteration is read from a single file
+    assert ts.h5_files == ref.h5_files
+    z, = ts.get_particle_at( 100, ['z'], 'electrons' )
+    assert np.array_equal( z, ref_z )
+
+
+def test_group_based( series_factory ):
+    """Check that a groupBased series gives the same data as the
+    corresponding fileBased series"""
+    file_based = OpenPMDTimeSeries( series_factory() )
+    group_based = OpenPMDTimeSeries( series_factory( group_based=True ) )
+    assert group_based.iterations == file_based.iterations
+    assert np.allclose( group_based.t, file_based.t )
+    for iteration in file_based.iterations:
+        for coord in [ 'x', 'z' ]:
+            F, _ = file_based.get_field_at( iteration, 'E', coord )
+            G, _ = group_based.get_field_at( iteration, 'E', coord )
+            assert np.array_equal( F, G )
+        for a, b in zip(
+                file_based.get_particle_at( iteration, ['z', 'uz', 'w'],
+                                            'electrons' ),
+                group_based.get_particle_at( iteration, ['z', 'uz', 'w'],
+                                             'electrons' ) ):
+            assert np.array_equal( a, b )
+
+
+def test_iterations_between( series_factory ):
+    """Check the lookup of the outputs by time, including when the times
+    are not sorted like the iterations"""
+    path = series_factory( n_iterations=10, n_particles=10 )
+    # (The first iteration gets the latest time)
+    with h5py.File( os.path.join( path, 'data00000000.h5' ), 'r+' ) as f:
+        f['data/0'].attrs['time'] = 9.5e-13
+    ts = OpenPMDTimeSeries( path )
+    assert ts.tmin == 1.e-13
+    assert ts.tmax == 9.5e-13
+
+    assert list( ts.iterations_between( 2.e-13, 5.e-13 ) ) == \
+        [ 200, 300, 400, 500 ]
+    assert list( ts.iterations_between( 2.5e-13, 5.e-13, stride=2 ) ) == \
+        [ 300, 500 ]
+    assert list( ts.iterations_between( 8.5e-13 ) ) == [ 900, 0 ]
+    assert list( ts.iterations_between( t1=1.5e-13 ) ) == [ 100 ]
+    assert len( ts.iterations_between() ) == 10
+    assert len( ts.iterations_between( 3.1e-13, 3.2e-13 ) ) == 0
+    with pytest.raises( OpenPMDException ):
+        ts.iterations_between( stride=0 )
+
+    # Outputs requested by time: the last output before `t`
+    ts.get_particle( ['z'], 'electrons', t=4.5e-13 )
+    assert ts.iterations[ ts.current_i ] == 400
+    ts.get_particle( ['z'], 'electrons', t=9.5e-13 )
+    assert ts.iterations[ ts.current_i ] == 0
+
+
+@pytest.mark.parametrize( 'cache_size', [ 0, 10**6 ] )
+def test_concurrent_reads( series_factory, cache_size ):
+    """Check that `get_field_at` and `get_particle_at` give the same data
+    when they are called concurrently from several threads, and that they
+    do not modify the current iteration"""
+    path = series_factory( n_iterations=4, n_particles=2000 )
+    ref = OpenPMDTimeSeries( path )
+    ts = OpenPMDTimeSeries( path, max_open_files=2,
+        particle_cache_size=cache_size, field_cache_size=cache_size )
+    ts.get_field( 'rho', iteration=100 )
+
+    def read( iteration ):
+        "Read a field and the particles of an iteration"
+        F, _ = ts.get_field_at( iteration, 'E', 'x', theta=0.2 )
+        return( [ F ] + ts.get_particle_at( iteration, ['z', 'uz'],
+                        'electrons', select={ 'uz': [ 30., None ] } ) )
+    pool = ThreadPool( 8 )
+    results = pool.map( read, 4 * ref.iterations )
+    pool.close()
+    for iteration, result in zip( 4 * ref.iterations, results ):
+        F, _ = ref.get_field_at( iteration, 'E', 'x', theta=0.2 )
+        expected = [ F ] + ref.get_particle_at( iteration, ['z', 'uz'],
+                        'electrons', select={ 'uz': [ 30., None ] } )
+        for a, b in zip( result, expected ):
+            assert np.array_equal( a, b )
+    assert ts.current_i == 1
+    assert ts.current_t == ref.t[1]
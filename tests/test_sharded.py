@@ -0,0 +1,109 @@
+"""
+This test file is part of the openPMD-viewer.
+
+It makes sure that the iterations that are written in several files
+(one per MPI rank) are stitched into the same data as single files.
+
+Usage:
+This file is meant to be run from the root directory of openPMD-viewer,
+by any of the following commands
+$ py.test
+$ python setup.py test
+"""
+import shutil
+import h5py
+import numpy as np
+import pytest
+from opmd_viewer import OpenPMDTimeSeries
+from opmd_viewer.openpmd_timeseries.data_reader.shards import ShardedDataset
+
+
+@pytest.mark.parametrize( 'geometry',
+                          [ 'thetaMode', '2dcartesian', '3dcartesian' ] )
+def test_sharded_series( series_factory, geometry ):
+    """Check that the fields and particles of a sharded series are equal
+    to those of the same series written in single files"""
+    single = OpenPMDTimeSeries( series_factory( geometry=geometry ) )
+    sharded = OpenPMDTimeSeries(
+        series_factory( geometry=geometry, n_shards=3 ), n_workers=2 )
+    assert sharded.iterations == single.iterations
+    assert all( len( files ) == 3 for files in sharded.h5_files )
+    assert np.allclose( sharded.t, single.t )
+
+    for iteration in single.iterations:
+        for field, coord in [ ('rho', None), ('E', 'x'), ('E', 'z') ]:
+            F, info_F = single.get_field_at( iteration, field, coord )
+            G, info_G = sharded.get_field_at( iteration, field, coord )
+            assert np.array_equal( F, G )
+            assert np.allclose( info_F.imshow_extent, info_G.imshow_extent )
+        for a, b in zip(
+                single.get_particle_at( iteration, ['x', 'z', 'uz', 'w'],
+                                        'electrons' ),
+                sharded.get_particle_at( iteration, ['x', 'z', 'uz', 'w'],
+                                         'electrons' ) ):
+            assert np.array_equal( a, b )
+
+    # Selection and slicing across the pieces
+    select = { 'z': [ 10., 20. ] }
+    for a, b in zip(
+            single.get_particle_at( 100, ['z', 'w'], 'electrons', select ),
+            sharded.get_particle_at( 100, ['z', 'w'], 'electrons', select ) ):
+        assert np.array_equal( a, b )
+    if geometry == '3dcartesian':
+        for slicing_dir in [ 'x', 'y', 'z' ]:
+            F, _ = single.get_field_at( 0, 'rho', slicing_dir=slicing_dir,
+                                        slicing=0.3 )
+            G, _ = sharded.get_field_at( 0, 'rho', slicing_dir=slicing_dir,
+                                         slicing=0.3 )
+            assert np.array_equal( F, G )
+
+
+def test_sharded_dataset_indexing( series_factory ):
+    """Check the indexing of a ShardedDataset with the keys of numpy
+    (integers, slices with steps, negative indices and Ellipsis)"""
+    path = series_factory( geometry='3dcartesian', n_iterations=1,
+                           n_shards=4 )
+    ts = OpenPMDTimeSeries( path )
+    files = [ h5py.File( name, 'r' ) for name in ts.h5_files[0] ]
+    records = [ ( f['data/0/fields/rho'], f['data/0/fields/rho'].attrs ) \
+                for f in files ]
+    full = np.concatenate( [ dset[...] for dset, _ in records ], axis=-1 )
+    for n_workers in [ 1, 3 ]:
+        dset = ShardedDataset( records, n_workers=n_workers )
+        assert dset.shape == full.shape
+        for key in [ Ellipsis, (2, Ellipsis), (Ellipsis, 5), (-1, 2, 3),
+                     (slice(1, 7, 2), Ellipsis, slice(2, 11, 3)),
+                     (Ellipsis, slice(None, None, -1)),
+                     (slice(None), -3, slice(10, 1, -4)),
+                     (Ellipsis, slice(4, 4)) ]:
+            assert np.array_equal( dset[ key ], full[ key ] )
+    for f in files:
+        f.close()
+
+
+def test_duplicate_outputs( series_factory, capsys ):
+    """Check that only the files that differ by their rank are grouped,
+    and that the other files of the same iteration are ignored"""
+    path = series_factory( n_shards=2 )
+    ref = OpenPMDTimeSeries( path )
+    ref_z, = ref.get_particle_at( 100, ['z'], 'electrons' )
+    # Copy the files of each iteration (e.g. a backup of the output)
+    for files in ref.h5_files:
+        for filename in files:
+            shutil.copy( filename, filename.replace( 'data', 'backup' ) )
+    capsys.readouterr()
+    ts = OpenPMDTimeSeries( path )
+    assert 'Warning: Several outputs' in capsys.readouterr().out
+    assert ts.iterations == ref.iterations
+    assert all( len( files ) == 2 for files in ts.h5_files )
+    z, = ts.get_particle_at( 100, ['z'], 'electrons' )
+    assert np.array_equal( z, ref_z )
+
+    # The files of a pattern with %R are grouped in the same way
+    ts = OpenPMDTimeSeries( path, file_pattern='data%T_r%R.h5' )
+    assert ts.h5_files == ref.h5_files
+    assert capsys.readouterr().out == ''
+    # Without rank, the files of an iteration are different outputs
+    ts = OpenPMDTimeSeries( path, file_pattern=r'data(\d+)_r\d+\.h5$' )
+    assert ts.h5_files == [ files[0] for files in ref.h5_files ]
+    assert 'Warning: Several outputs' in capsys.readouterr().out